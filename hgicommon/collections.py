@@ -24,9 +24,95 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import copy
-from collections import defaultdict
-from threading import Lock
-from typing import Any, Iterable, Mapping, Dict
+import operator
+from abc import abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from array import array
+from collections import defaultdict, OrderedDict
+from collections.abc import Set as AbstractSet
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice, compress
+from numbers import Real
+from threading import Condition, Lock, RLock
+from time import monotonic
+from typing import Any, Iterable, Mapping, MutableMapping, Sequence, List, Iterator, Dict, Set, Tuple, Union, \
+    Callable, Hashable, Optional
+from weakref import WeakValueDictionary
+
+from hgicommon.enums import ComparisonOperator
+from hgicommon.models import SearchCriterion, MetadataPatch
+from hgicommon.threading import CountingLock
+
+DEFAULT_LOCK_STRIPES = 16
+DEFAULT_SHARDS = 16
+DEFAULT_MAX_TRACKED_CHANGES = 100000
+
+_HAMT_BITS_PER_LEVEL = 5
+_HAMT_LEVEL_MASK = (1 << _HAMT_BITS_PER_LEVEL) - 1
+_HAMT_HASH_MASK = (1 << 64) - 1
+
+# Lock used when creating the locks in any `_LockStripes`
+_lock_stripes_creation_lock = Lock()
+
+_MISSING = object()
+
+_COMPARISON_FUNCTIONS = {
+    ComparisonOperator.EQUALS: operator.eq,
+    ComparisonOperator.LESS_THAN: operator.lt,
+    ComparisonOperator.GREATER_THAN: operator.gt
+}   # type: Dict[ComparisonOperator, Callable[[Any, Any], bool]]
+
+# Functions where `function(other, value)` is the comparison `value <operator> other`
+_REFLECTED_COMPARISON_FUNCTIONS = {
+    ComparisonOperator.EQUALS: operator.eq,
+    ComparisonOperator.LESS_THAN: operator.gt,
+    ComparisonOperator.GREATER_THAN: operator.lt
+}   # type: Dict[ComparisonOperator, Callable[[Any, Any], bool]]
+
+_EMPTY_COLUMN = "empty"
+_INT_COLUMN = "int"
+_FLOAT_COLUMN = "float"
+_STRING_COLUMN = "string"
+_OBJECT_COLUMN = "object"
+_COLUMN_TYPECODES = {
+    _INT_COLUMN: "q",
+    _FLOAT_COLUMN: "d",
+    _STRING_COLUMN: "L"
+}
+_COLUMN_PLACEHOLDERS = {
+    _INT_COLUMN: 0,
+    _FLOAT_COLUMN: 0.0,
+    _STRING_COLUMN: 0,
+    _OBJECT_COLUMN: None
+}
+_BYTE_STRING_CODE_TYPECODE = "B"
+_MAX_INT_COLUMN_VALUE = 2 ** 63 - 1
+
+
+class _RebuiltLock:
+    """
+    Stand-in for a lock when pickling, which is unpickled as a new (unheld) lock of the same type.
+    """
+    __slots__ = ("lock_factory", )
+
+    def __init__(self, lock_factory: Callable[[], Any]):
+        self.lock_factory = lock_factory
+
+    def __reduce__(self):
+        return self.lock_factory, ()
+
+
+def _get_pickleable_value(value: Any) -> Any:
+    """
+    Gets the given value in a form that can be pickled, where locks are replaced so that they are rebuilt when
+    unpickled.
+    :param value: the value
+    :return: the pickleable form of the value
+    """
+    lock_factory = _LOCK_FACTORIES.get(type(value))
+    return _RebuiltLock(lock_factory) if lock_factory is not None else value
 
 
 class ThreadSafeDefaultdict(defaultdict):
@@ -34,34 +120,1240 @@ class ThreadSafeDefaultdict(defaultdict):
     `defaultdict` (https://docs.python.org/3/library/collections.html#collections.defaultdict) implementation where the
     default value is created and set in a thread-safe way. This allows use of a default dict of locks, which is not
     thread-safe with `defaultdict(Lock)` (https://github.com/wtsi-hgi/python-common/issues/8#issuecomment-218996159).
+
+    Default values for different keys are created concurrently. Threads that get a key whilst its default value is being
+    created wait for that creation, and are given any exception raised by the default factory. A key is not set if its
+    default value could not be created, so the creation is tried again the next time the key is got.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._creation_lock = Lock()
+        self._creations = {}    # type: Dict[Any, Future]
 
     def __getitem__(self, key):
         if key in self:
             return super().__getitem__(key)
-        else:
+
+        with self._creation_lock:
+            if key in self:
+                # Value for key was created whilst this thread was waiting for the lock
+                return super().__getitem__(key)
+            creation = self._creations.get(key)
+            if creation is None:
+                creation = Future()
+                self._creations[key] = creation
+                is_creator = True
+            else:
+                is_creator = False
+
+        if not is_creator:
+            return creation.result()
+
+        try:
+            value = self.__missing__(key)
+        except BaseException as e:
             with self._creation_lock:
-                if key in self:
-                    # Value for key was created whilst this thread was waiting for the lock
-                    return super().__getitem__(key)
-                else:
-                    return self.__missing__(key)
+                del self._creations[key]
+            creation.set_exception(e)
+            raise
+        with self._creation_lock:
+            del self._creations[key]
+        creation.set_result(value)
+        return value
+
+    def __reduce__(self):
+        items = [(key, _get_pickleable_value(value)) for key, value in list(self.items())]
+        return type(self), (self.default_factory, ), None, None, iter(items)
+
+
+def _is_held_lock(value: Any) -> bool:
+    """
+    Gets whether the given value is a lock that is held or that threads are waiting to acquire. Only `CountingLock`
+    records waiting threads: a plain lock with waiting threads is momentarily not held when it is released.
+    :param value: the value
+    :return: whether the value is a lock that is in use
+    """
+    if isinstance(value, CountingLock):
+        return value.is_locked() or value.waiting_to_acquire() > 0
+    locked = getattr(value, "locked", None)
+    return callable(locked) and locked()
+
+
+class _BoundedThreadSafeDefaultdict(MutableMapping):
+    """
+    Mapping where default values are created in the same thread-safe way as `ThreadSafeDefaultdict` but where entries
+    can be removed by the mapping to bound its memory use.
+
+    An entry may be removed between getting its value and using it, e.g. between getting a lock and acquiring it. Use
+    `hold` to get and use a value without the entry being removed.
+    """
+    def __init__(self, default_factory: Callable[[], Any]=None):
+        """
+        Constructor.
+        :param default_factory: factory of the value for keys that are not in the mapping
+        """
+        self.default_factory = default_factory
+        self._lock = Lock()
+        self._creations = {}    # type: Dict[Any, Future]
+        self._pins = {}     # type: Dict[Any, int]
+
+    @abstractmethod
+    def _get_value(self, key: Any, touch: bool=True) -> Any:
+        """
+        Gets the value for the given key. Called whilst holding the lock.
+        :param key: the key
+        :param touch: whether the get counts as a use of the entry
+        :return: the value or `_MISSING` if the key is not in the mapping
+        """
+
+    @abstractmethod
+    def _set_value(self, key: Any, value: Any):
+        """
+        Sets the value for the given key. Called whilst holding the lock.
+        :param key: the key
+        :param value: the value
+        """
+
+    @abstractmethod
+    def _delete_value(self, key: Any):
+        """
+        Deletes the value for the given key. Called whilst holding the lock.
+        :param key: the key
+        :raises KeyError: if the key is not in the mapping
+        """
+
+    @abstractmethod
+    def _get_keys(self) -> List[Any]:
+        """
+        Gets the keys in the mapping. Called whilst holding the lock.
+        :return: the keys
+        """
+
+    @abstractmethod
+    def _evict(self):
+        """
+        Removes entries that are no longer to be kept. Called whilst holding the lock.
+        """
+
+    @contextmanager
+    def hold(self, key: Any) -> Iterator[Any]:
+        """
+        Context manager that gets the value for the given key, creating it if the key is not in the mapping, and enters
+        the value (e.g. acquires a lock) for the duration of the context. The entry is not removed from the mapping
+        until the context exits, therefore all threads holding a key hold the same value.
+        :param key: the key
+        """
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            value = self[key]
+            with value:
+                yield value
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if self._pins[key] == 0:
+                    del self._pins[key]
+                self._evict()
+
+    def get(self, key: Any, default=None) -> Any:
+        """
+        Gets the value for the given key, without creating a value if the key is not in the mapping.
+        :param key: the key
+        :param default: the value to return if the key is not in the mapping
+        :return: the value
+        """
+        with self._lock:
+            self._evict()
+            value = self._get_value(key)
+        return value if value is not _MISSING else default
+
+    def __getitem__(self, key: Any) -> Any:
+        with self._lock:
+            self._evict()
+            value = self._get_value(key)
+            if value is not _MISSING:
+                return value
+            creation = self._creations.get(key)
+            if creation is None:
+                creation = Future()
+                self._creations[key] = creation
+                is_creator = True
+            else:
+                is_creator = False
+
+        if not is_creator:
+            return creation.result()
+
+        try:
+            if self.default_factory is None:
+                raise KeyError(key)
+            value = self.default_factory()
+            with self._lock:
+                del self._creations[key]
+                self._set_value(key, value)
+                self._evict()
+        except BaseException as e:
+            with self._lock:
+                if self._creations.get(key) is creation:
+                    del self._creations[key]
+            creation.set_exception(e)
+            raise
+        creation.set_result(value)
+        return value
+
+    def __setitem__(self, key: Any, value: Any):
+        with self._lock:
+            self._set_value(key, value)
+            self._evict()
+
+    def __delitem__(self, key: Any):
+        with self._lock:
+            self._delete_value(key)
+
+    def __contains__(self, key: Any) -> bool:
+        with self._lock:
+            self._evict()
+            return self._get_value(key, touch=False) is not _MISSING
+
+    def __iter__(self) -> Iterator[Any]:
+        with self._lock:
+            self._evict()
+            return iter(self._get_keys())
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._evict()
+            return len(self._get_keys())
+
+    def items(self) -> Iterable[Tuple[Any, Any]]:
+        return self._get_snapshot().items()
+
+    def values(self) -> Iterable[Any]:
+        return self._get_snapshot().values()
+
+    def __repr__(self) -> str:
+        return "<%s object at %s: %s>" % (type(self), id(self), dict(self.items()))
+
+    def _get_snapshot(self) -> Dict[Any, Any]:
+        """
+        Gets a copy of the entries in the mapping, without counting as a use of them or creating any.
+        :return: the copy of the entries
+        """
+        with self._lock:
+            self._evict()
+            snapshot = {key: self._get_value(key, touch=False) for key in self._get_keys()}
+        return {key: value for key, value in snapshot.items() if value is not _MISSING}
+
+    def _is_pinned(self, key: Any) -> bool:
+        """
+        Gets whether the entry with the given key is held, so must not be removed. Called whilst holding the lock.
+        :param key: the key
+        :return: whether the entry is held
+        """
+        return key in self._pins
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        del state["_lock"]
+        del state["_creations"]
+        del state["_pins"]
+        with self._lock:
+            state["_data"] = [(key, _get_pickleable_value(value)) for key, value in self._data.items()]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._lock = Lock()
+        self._creations = {}
+        self._pins = {}
+
+
+class LruThreadSafeDefaultdict(_BoundedThreadSafeDefaultdict):
+    """
+    `ThreadSafeDefaultdict` equivalent that holds up to a maximum number of entries, removing the least recently used
+    entries when the maximum is exceeded. Entries with values that are in use (by default, locks that are held or being
+    waited on) are not removed, so the maximum may be temporarily exceeded.
+    """
+    def __init__(self, default_factory: Callable[[], Any]=None, max_size: int=1024,
+                 is_in_use: Callable[[Any], bool]=_is_held_lock):
+        """
+        Constructor.
+        :param default_factory: factory of the value for keys that are not in the mapping
+        :param max_size: the maximum number of entries to keep
+        :param is_in_use: gets whether a value is in use and must not be removed
+        """
+        super().__init__(default_factory)
+        if max_size < 1:
+            raise ValueError("Maximum size must be at least one")
+        self.max_size = max_size
+        self._is_in_use = is_in_use
+        self._data = OrderedDict()  # type: OrderedDict
+
+    def __setstate__(self, state: Dict[str, Any]):
+        super().__setstate__(state)
+        self._data = OrderedDict(self._data)
+
+    def _get_value(self, key: Any, touch: bool=True) -> Any:
+        value = self._data.get(key, _MISSING)
+        if touch and value is not _MISSING:
+            self._data.move_to_end(key)
+        return value
+
+    def _set_value(self, key: Any, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+    def _delete_value(self, key: Any):
+        del self._data[key]
+
+    def _get_keys(self) -> List[Any]:
+        return list(self._data.keys())
+
+    def _evict(self):
+        excess = len(self._data) - self.max_size
+        if excess <= 0:
+            return
+        evictable_keys = []
+        # The most recently used entry is never removed so that a value is not removed before it can be used
+        for key, value in islice(self._data.items(), len(self._data) - 1):
+            if not self._is_pinned(key) and not self._is_in_use(value):
+                evictable_keys.append(key)
+                if len(evictable_keys) == excess:
+                    break
+        for key in evictable_keys:
+            del self._data[key]
+
+
+class TtlThreadSafeDefaultdict(_BoundedThreadSafeDefaultdict):
+    """
+    `ThreadSafeDefaultdict` equivalent where entries are removed a given time after they were set. Entries with values
+    that are in use (by default, locks that are held or being waited on) are kept for another period instead.
+    """
+    def __init__(self, default_factory: Callable[[], Any]=None, ttl: float=60.0,
+                 is_in_use: Callable[[Any], bool]=_is_held_lock):
+        """
+        Constructor.
+        :param default_factory: factory of the value for keys that are not in the mapping
+        :param ttl: the number of seconds that entries are kept for
+        :param is_in_use: gets whether a value is in use and must not be removed
+        """
+        super().__init__(default_factory)
+        self.ttl = ttl
+        self._is_in_use = is_in_use
+        self._data = OrderedDict()  # type: OrderedDict
+        self._expiry_times = {}     # type: Dict[Any, float]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = super().__getstate__()
+        # Monotonic times are not comparable between processes so the remaining times are pickled
+        now = monotonic()
+        state["_expiry_times"] = {key: expiry_time - now for key, expiry_time in self._expiry_times.items()}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        super().__setstate__(state)
+        self._data = OrderedDict(self._data)
+        now = monotonic()
+        self._expiry_times = {key: now + remaining_time for key, remaining_time in self._expiry_times.items()}
+
+    def _get_value(self, key: Any, touch: bool=True) -> Any:
+        return self._data.get(key, _MISSING)
+
+    def _set_value(self, key: Any, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._expiry_times[key] = monotonic() + self.ttl
+
+    def _delete_value(self, key: Any):
+        del self._data[key]
+        del self._expiry_times[key]
+
+    def _get_keys(self) -> List[Any]:
+        return list(self._data.keys())
+
+    def _evict(self):
+        # Entries are ordered by expiry time
+        now = monotonic()
+        expired = []
+        for key in self._data:
+            if self._expiry_times[key] > now:
+                break
+            expired.append(key)
+        for key in expired:
+            value = self._data[key]
+            if self._is_pinned(key) or self._is_in_use(value):
+                self._set_value(key, value)
+            else:
+                self._delete_value(key)
+
+
+class WeakValueThreadSafeDefaultdict(_BoundedThreadSafeDefaultdict):
+    """
+    `ThreadSafeDefaultdict` equivalent where entries are removed when their values are no longer referenced elsewhere.
+    Values must support weak references, so use `CountingLock` rather than `Lock` for maps of locks. A held lock or one
+    being waited on is referenced by the threads using it, so it is not removed.
+
+    When unpickled, only entries with values that are also referenced by other unpickled objects are kept.
+    """
+    def __init__(self, default_factory: Callable[[], Any]=None):
+        """
+        Constructor.
+        :param default_factory: factory of the value for keys that are not in the mapping
+        """
+        super().__init__(default_factory)
+        self._data = WeakValueDictionary()  # type: WeakValueDictionary
+
+    def __setstate__(self, state: Dict[str, Any]):
+        super().__setstate__(state)
+        self._data = WeakValueDictionary(self._data)
+
+    def _get_value(self, key: Any, touch: bool=True) -> Any:
+        return self._data.get(key, _MISSING)
+
+    def _set_value(self, key: Any, value: Any):
+        self._data[key] = value
+
+    def _delete_value(self, key: Any):
+        del self._data[key]
+
+    def _get_keys(self) -> List[Any]:
+        return list(self._data.keys())
+
+    def _evict(self):
+        pass
+
+
+_LOCK_FACTORIES = {
+    type(Lock()): Lock,
+    type(RLock()): RLock,
+    CountingLock: CountingLock
+}   # type: Dict[type, Callable[[], Any]]
+
+
+class _BatchesLock:
+    """
+    Lock that is shared by any number of batches of changes or by any number of readers, but not by both at once. When
+    both are waiting, batches and readers take turns, such that neither can be starved by a steady stream of the other.
+    """
+    _BATCHES_TURN = 0
+    _READERS_TURN = 1
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._condition = Condition(Lock())
+        self._counts = {_BatchesLock._BATCHES_TURN: 0, _BatchesLock._READERS_TURN: 0}
+        self._waiting = {_BatchesLock._BATCHES_TURN: 0, _BatchesLock._READERS_TURN: 0}
+        self._turn = _BatchesLock._BATCHES_TURN
+
+    def __reduce__(self):
+        return type(self), ()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Context manager that holds this lock for a batch of changes.
+        """
+        self._acquire(_BatchesLock._BATCHES_TURN)
+        try:
+            yield
+        finally:
+            self._release(_BatchesLock._BATCHES_TURN)
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        """
+        Context manager that holds this lock for a reader.
+        """
+        self._acquire(_BatchesLock._READERS_TURN)
+        try:
+            yield
+        finally:
+            self._release(_BatchesLock._READERS_TURN)
+
+    def _acquire(self, side: int):
+        """
+        Acquires this lock for the given side.
+        :param side: the side acquiring the lock, i.e. batches or readers
+        """
+        other_side = 1 - side
+        with self._condition:
+            self._waiting[side] += 1
+            while self._counts[other_side] > 0 or (self._waiting[other_side] > 0 and self._turn == other_side):
+                self._condition.wait()
+            self._waiting[side] -= 1
+            self._counts[side] += 1
+            if self._waiting[other_side] > 0:
+                # Stopping more of this side from acquiring until the other side has had its turn
+                self._turn = other_side
+
+    def _release(self, side: int):
+        """
+        Releases this lock for the given side.
+        :param side: the side releasing the lock
+        """
+        with self._condition:
+            self._counts[side] -= 1
+            if self._counts[side] == 0:
+                self._condition.notify_all()
+
+
+class _LockStripes:
+    """
+    Fixed number of locks, where each lock guards the keys whose hashes map to it. Bounds the number of locks needed to
+    guard any number of keys. The locks are created when first needed.
+    """
+    def __init__(self, number_of_stripes: int):
+        """
+        Constructor.
+        :param number_of_stripes: the number of locks
+        """
+        if number_of_stripes < 1:
+            raise ValueError("Must have at least one lock stripe")
+        self.number_of_stripes = number_of_stripes
+        self._locks = None  # type: List[Lock]
+
+    def __reduce__(self):
+        return type(self), (self.number_of_stripes, )
+
+    def get_lock(self, key: Any) -> Lock:
+        """
+        Gets the lock that guards the given key.
+        :param key: the key
+        :return: the lock
+        """
+        return self._get_locks()[hash(key) % self.number_of_stripes]
+
+    @contextmanager
+    def hold(self, keys: Iterable[Any]=None) -> Iterator[None]:
+        """
+        Context manager that holds the locks that guard the given keys, acquiring them in a canonical order to prevent
+        deadlock.
+        :param keys: (optional) the keys. All locks are held if not given
+        """
+        locks = self._get_locks()
+        if keys is None:
+            indices = range(self.number_of_stripes)
+        else:
+            indices = sorted({hash(key) % self.number_of_stripes for key in keys})
+
+        acquired = []   # type: List[Lock]
+        try:
+            for index in indices:
+                locks[index].acquire()
+                acquired.append(locks[index])
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def _get_locks(self) -> List[Lock]:
+        """
+        Gets the locks, creating them if this is the first time they are needed.
+        :return: the locks
+        """
+        locks = self._locks
+        if locks is None:
+            with _lock_stripes_creation_lock:
+                if self._locks is None:
+                    self._locks = [Lock() for _ in range(self.number_of_stripes)]
+                locks = self._locks
+        return locks
+
+
+class _HamtBitmapNode:
+    """
+    Node in a hash array mapped trie. Each entry is either a `(key_hash, key, value)` leaf tuple or a child node. The
+    bitmap records which of the possible branches at the node's level are in use.
+    """
+    __slots__ = ("bitmap", "entries")
+
+    def __init__(self, bitmap: int, entries: tuple):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _HamtCollisionNode:
+    """
+    Node in a hash array mapped trie that holds the `(key, value)` items of different keys with the same hash.
+    """
+    __slots__ = ("key_hash", "items")
+
+    def __init__(self, key_hash: int, items: tuple):
+        self.key_hash = key_hash
+        self.items = items
+
+
+_EMPTY_HAMT_NODE = _HamtBitmapNode(0, ())
+
+
+def _hamt_hash(key: Any) -> int:
+    """
+    Gets the (non-negative) hash of the given key, as used in a hash array mapped trie.
+    :param key: the key
+    :return: the hash
+    """
+    return hash(key) & _HAMT_HASH_MASK
+
+
+def _hamt_index(bitmap: int, bit: int) -> int:
+    """
+    Gets the index of the entry for the given branch bit in a node with the given bitmap.
+    :param bitmap: the node's bitmap
+    :param bit: the branch bit
+    :return: the entry index
+    """
+    return bin(bitmap & (bit - 1)).count("1")
+
+
+def _hamt_get(node: _HamtBitmapNode, key_hash: int, key: Any) -> Any:
+    """
+    Gets the value associated to the given key in the trie with the given root.
+    :param node: the root node
+    :param key_hash: the hash of the key
+    :param key: the key
+    :return: the value
+    :raises KeyError: if the key is not in the trie
+    """
+    shift = 0
+    while True:
+        if type(node) is _HamtCollisionNode:
+            if node.key_hash == key_hash:
+                for item_key, item_value in node.items:
+                    if item_key is key or item_key == key:
+                        return item_value
+            raise KeyError(key)
+
+        bit = 1 << ((key_hash >> shift) & _HAMT_LEVEL_MASK)
+        if not node.bitmap & bit:
+            raise KeyError(key)
+        entry = node.entries[_hamt_index(node.bitmap, bit)]
+        if type(entry) is tuple:
+            if entry[0] == key_hash and (entry[1] is key or entry[1] == key):
+                return entry[2]
+            raise KeyError(key)
+        node = entry
+        shift += _HAMT_BITS_PER_LEVEL
+
+
+def _hamt_merge_leaves(shift: int, leaf_1: tuple, leaf_2: tuple):
+    """
+    Creates a node that holds the two given leaves, which have different keys.
+    :param shift: the hash bit shift of the level that the node is to be at
+    :param leaf_1: the first leaf
+    :param leaf_2: the second leaf
+    :return: the node
+    """
+    if leaf_1[0] == leaf_2[0]:
+        return _HamtCollisionNode(leaf_1[0], ((leaf_1[1], leaf_1[2]), (leaf_2[1], leaf_2[2])))
+    index_1 = (leaf_1[0] >> shift) & _HAMT_LEVEL_MASK
+    index_2 = (leaf_2[0] >> shift) & _HAMT_LEVEL_MASK
+    if index_1 == index_2:
+        return _HamtBitmapNode(1 << index_1, (_hamt_merge_leaves(shift + _HAMT_BITS_PER_LEVEL, leaf_1, leaf_2), ))
+    entries = (leaf_1, leaf_2) if index_1 < index_2 else (leaf_2, leaf_1)
+    return _HamtBitmapNode((1 << index_1) | (1 << index_2), entries)
+
+
+def _hamt_set(node, shift: int, key_hash: int, key: Any, value: Any) -> Tuple[Any, bool]:
+    """
+    Sets the value associated to the given key, without modifying the given node.
+    :param node: the node to set in
+    :param shift: the hash bit shift of the node's level
+    :param key_hash: the hash of the key
+    :param key: the key
+    :param value: the value
+    :return: tuple where the first element is the node with the value set (which shares unchanged nodes with the given
+    node and is the given node if nothing changed) and the second is whether the key was added
+    """
+    if type(node) is _HamtCollisionNode:
+        if node.key_hash == key_hash:
+            items = node.items
+            for i, (item_key, item_value) in enumerate(items):
+                if item_key is key or item_key == key:
+                    if item_value is value:
+                        return node, False
+                    return _HamtCollisionNode(key_hash, items[:i] + ((key, value), ) + items[i + 1:]), False
+            return _HamtCollisionNode(key_hash, items + ((key, value), )), True
+        node = _HamtBitmapNode(1 << ((node.key_hash >> shift) & _HAMT_LEVEL_MASK), (node, ))
+
+    bit = 1 << ((key_hash >> shift) & _HAMT_LEVEL_MASK)
+    index = _hamt_index(node.bitmap, bit)
+    entries = node.entries
+    if not node.bitmap & bit:
+        return _HamtBitmapNode(node.bitmap | bit, entries[:index] + ((key_hash, key, value), ) + entries[index:]), True
+
+    entry = entries[index]
+    if type(entry) is tuple:
+        if entry[0] == key_hash and (entry[1] is key or entry[1] == key):
+            if entry[2] is value:
+                return node, False
+            new_entry, added = (key_hash, key, value), False
+        else:
+            new_entry, added = _hamt_merge_leaves(shift + _HAMT_BITS_PER_LEVEL, entry, (key_hash, key, value)), True
+    else:
+        new_entry, added = _hamt_set(entry, shift + _HAMT_BITS_PER_LEVEL, key_hash, key, value)
+        if new_entry is entry:
+            return node, False
+    return _HamtBitmapNode(node.bitmap, entries[:index] + (new_entry, ) + entries[index + 1:]), added
+
+
+def _hamt_delete(node, shift: int, key_hash: int, key: Any):
+    """
+    Deletes the given key, without modifying the given node.
+    :param node: the node to delete from
+    :param shift: the hash bit shift of the node's level
+    :param key_hash: the hash of the key
+    :param key: the key
+    :return: the node without the key (which shares unchanged nodes with the given node), a leaf if only one item
+    remains below a non-root node or `None` if no items remain
+    :raises KeyError: if the key is not in the node
+    """
+    if type(node) is _HamtCollisionNode:
+        if node.key_hash != key_hash:
+            raise KeyError(key)
+        items = tuple(item for item in node.items if not (item[0] is key or item[0] == key))
+        if len(items) == len(node.items):
+            raise KeyError(key)
+        if len(items) == 1:
+            return key_hash, items[0][0], items[0][1]
+        return _HamtCollisionNode(key_hash, items)
+
+    bit = 1 << ((key_hash >> shift) & _HAMT_LEVEL_MASK)
+    if not node.bitmap & bit:
+        raise KeyError(key)
+    index = _hamt_index(node.bitmap, bit)
+    entries = node.entries
+    entry = entries[index]
+    if type(entry) is tuple:
+        if not (entry[0] == key_hash and (entry[1] is key or entry[1] == key)):
+            raise KeyError(key)
+        new_entry = None
+    else:
+        new_entry = _hamt_delete(entry, shift + _HAMT_BITS_PER_LEVEL, key_hash, key)
+
+    if new_entry is None:
+        remaining_entries = entries[:index] + entries[index + 1:]
+        if len(remaining_entries) == 0:
+            return None
+        if shift > 0 and len(remaining_entries) == 1 and type(remaining_entries[0]) is tuple:
+            return remaining_entries[0]
+        return _HamtBitmapNode(node.bitmap ^ bit, remaining_entries)
+    return _HamtBitmapNode(node.bitmap, entries[:index] + (new_entry, ) + entries[index + 1:])
+
+
+def _hamt_items(node) -> Iterator[Tuple[Any, Any]]:
+    """
+    Iterates the items in the given node.
+    :param node: the node
+    :return: iterator of `(key, value)` items
+    """
+    if type(node) is _HamtCollisionNode:
+        yield from node.items
+        return
+    for entry in node.entries:
+        if type(entry) is tuple:
+            yield entry[1], entry[2]
+        else:
+            yield from _hamt_items(entry)
+
+
+class FrozenMetadata(Mapping):
+    """
+    Immutable, hashable key-value metadata model.
+
+    Backed by a persistent hash array mapped trie: copies are free and modified versions share all unchanged structure
+    with the original.
+    """
+    def __init__(self, seq=()):
+        """
+        Constructor.
+        :param seq: metadata items
+        """
+        root = _EMPTY_HAMT_NODE
+        length = 0
+        for key, value in dict(seq).items():
+            root, added = _hamt_set(root, 0, _hamt_hash(key), key, value)
+            length += added
+        self._root = root
+        self._length = length
+        self._hash = None
+        self._items = None  # type: Optional[Dict[Any, Any]]
+
+    @classmethod
+    def _create(cls, root: _HamtBitmapNode, length: int) -> "FrozenMetadata":
+        """
+        Creates an instance with the given trie.
+        :param root: the root of the trie
+        :param length: the number of items in the trie
+        :return: the created instance
+        """
+        frozen = cls.__new__(cls)
+        frozen._root = root
+        frozen._length = length
+        frozen._hash = None
+        frozen._items = None
+        return frozen
+
+    def set(self, key: Any, value: Any) -> "FrozenMetadata":
+        """
+        Gets a version of this metadata with the given item set.
+        :param key: the item's key
+        :param value: the item's value
+        :return: the modified version
+        """
+        root, added = _hamt_set(self._root, 0, _hamt_hash(key), key, value)
+        if root is self._root:
+            return self
+        return self._create(root, self._length + added)
+
+    def update(self, items: Union[Mapping, Iterable[Tuple[Any, Any]]]) -> "FrozenMetadata":
+        """
+        Gets a version of this metadata with the given items set.
+        :param items: the items
+        :return: the modified version
+        """
+        root = self._root
+        length = self._length
+        for key, value in dict(items).items():
+            root, added = _hamt_set(root, 0, _hamt_hash(key), key, value)
+            length += added
+        if root is self._root:
+            return self
+        return self._create(root, length)
+
+    def delete(self, key: Any) -> "FrozenMetadata":
+        """
+        Gets a version of this metadata without the item with the given key.
+        :param key: the item's key
+        :return: the modified version
+        :raises KeyError: if the key does not exist
+        """
+        root = _hamt_delete(self._root, 0, _hamt_hash(key), key)
+        return self._create(root if root is not None else _EMPTY_HAMT_NODE, self._length - 1)
+
+    def thaw(self, lock_stripes: int=DEFAULT_LOCK_STRIPES) -> "Metadata":
+        """
+        Gets a mutable copy of this metadata.
+        :param lock_stripes: the number of locks used to guard changes to keys of the copy
+        :return: the mutable copy
+        """
+        if self._items is None:
+            self._items = dict(_hamt_items(self._root))
+        metadata = Metadata(self._items, lock_stripes)
+        metadata._frozen = self
+        return metadata
+
+    def get(self, key: Any, default=None) -> Any:
+        try:
+            return _hamt_get(self._root, _hamt_hash(key), key)
+        except KeyError:
+            return default
+
+    def __getitem__(self, key: Any) -> Any:
+        return _hamt_get(self._root, _hamt_hash(key), key)
+
+    def __contains__(self, key: Any) -> bool:
+        try:
+            _hamt_get(self._root, _hamt_hash(key), key)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self) -> Iterator[Any]:
+        for key, value in _hamt_items(self._root):
+            yield key
+
+    def __len__(self) -> int:
+        return self._length
+
+    def items(self) -> Iterable[Tuple[Any, Any]]:
+        return list(_hamt_items(self._root))
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            self._hash = hash(frozenset(_hamt_items(self._root)))
+        return self._hash
+
+    def __eq__(self, other: Any) -> bool:
+        if type(other) != type(self):
+            return False
+        if other._root is self._root:
+            return True
+        if other._length != self._length:
+            return False
+        if other._hash is not None and self._hash is not None and other._hash != self._hash:
+            return False
+        for key, value in _hamt_items(self._root):
+            if other.get(key, _MISSING) != value:
+                return False
+        return True
+
+    def __ne__(self, other: Any) -> bool:
+        return not self.__eq__(other)
+
+    def __str__(self) -> str:
+        return str(dict(_hamt_items(self._root)))
+
+    def __repr__(self) -> str:
+        return "<%s object at %s: %s>" % (type(self), id(self), str(self))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        deepcopy = self.__class__(copy.deepcopy(dict(_hamt_items(self._root)), memo))
+        memo[id(self)] = deepcopy
+        return deepcopy
+
+    def __reduce__(self):
+        return self.__class__, (dict(_hamt_items(self._root)), )
+
+
+def _compare(comparison_operator: ComparisonOperator, value: Any, other: Any) -> bool:
+    """
+    Compares the given value against another, where values that cannot be compared do not match.
+    :param comparison_operator: the comparison to make
+    :param value: the value
+    :param other: the value to compare against
+    :return: whether the comparison holds
+    """
+    try:
+        return bool(_COMPARISON_FUNCTIONS[comparison_operator](value, other))
+    except TypeError:
+        return False
+
+
+def _get_column_kind(value: Any) -> str:
+    """
+    Gets the kind of `MetadataTable` column that can store the given value.
+    :param value: the value
+    :return: the kind of column
+    """
+    value_type = type(value)
+    if value_type is int and -_MAX_INT_COLUMN_VALUE - 1 <= value <= _MAX_INT_COLUMN_VALUE:
+        return _INT_COLUMN
+    if value_type is float:
+        return _FLOAT_COLUMN
+    if value_type is str:
+        return _STRING_COLUMN
+    return _OBJECT_COLUMN
+
+
+def _and_masks(mask_1: bytearray, mask_2: bytearray) -> bytearray:
+    """
+    Combines the given masks of 0 and 1 bytes such that the result has 1 where both masks have 1.
+    :param mask_1: the first mask
+    :param mask_2: the second mask, which is the same length as the first
+    :return: the combined mask
+    """
+    combined = int.from_bytes(mask_1, "little") & int.from_bytes(mask_2, "little")
+    return bytearray(combined.to_bytes(len(mask_1), "little"))
+
+
+def _or_masks(mask_1: bytearray, mask_2: bytearray) -> bytearray:
+    """
+    Combines the given masks of 0 and 1 bytes such that the result has 1 where either mask has 1.
+    :param mask_1: the first mask
+    :param mask_2: the second mask, which is the same length as the first
+    :return: the combined mask
+    """
+    combined = int.from_bytes(mask_1, "little") | int.from_bytes(mask_2, "little")
+    return bytearray(combined.to_bytes(len(mask_1), "little"))
+
+
+def _get_ordering_family(value: Hashable) -> Optional[type]:
+    """
+    Gets the family of mutually ordered types that the given value belongs to.
+    :param value: the value
+    :return: the family or `None` if values of the type are not ordered
+    """
+    if isinstance(value, Real):
+        return Real
+    if isinstance(value, AbstractSet):
+        # Sets are only partially ordered
+        return None
+    value_type = type(value)
+    if value_type.__lt__ is object.__lt__:
+        return None
+    return value_type
+
+
+class _ValueIndex:
+    """
+    Secondary index of the keys that hold each value, with values that have an order also kept sorted. Unhashable values
+    (and values that do not equal themselves) are not indexed and are instead compared one-by-one when queried.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self._keys_by_value = {}    # type: Dict[Any, Dict[Any, None]]
+        self._sorted_values = {}    # type: Dict[type, List[Any]]
+        self._unordered_values = {}     # type: Dict[Any, None]
+        self._unindexed = {}    # type: Dict[Any, Any]
+
+    def replace_many(self, changes: Iterable[Tuple[Any, Any, Any]]):
+        """
+        Updates the index with the given changes as a single change.
+        :param changes: `(key, old_value, new_value)` changes, where `_MISSING` denotes no value
+        """
+        with self.lock:
+            for key, old_value, new_value in changes:
+                if old_value is not _MISSING:
+                    self._remove(key, old_value)
+                if new_value is not _MISSING:
+                    self._add(key, new_value)
+
+    def clear(self):
+        """
+        Removes everything from the index.
+        """
+        with self.lock:
+            self._keys_by_value.clear()
+            self._sorted_values.clear()
+            self._unordered_values.clear()
+            self._unindexed.clear()
+
+    def get_keys(self, value: Any, comparison_operator: ComparisonOperator) -> List[Any]:
+        """
+        Gets the keys of the values that compare to the given value.
+        :param value: the value to compare against
+        :param comparison_operator: the comparison to make
+        :return: the matching keys
+        """
+        with self.lock:
+            if comparison_operator == ComparisonOperator.EQUALS:
+                try:
+                    matched_values = [value] if value == value and value in self._keys_by_value else []
+                except TypeError:
+                    matched_values = []
+            else:
+                matched_values = []
+                for values in self._sorted_values.values():
+                    try:
+                        if comparison_operator == ComparisonOperator.LESS_THAN:
+                            matched_values.extend(values[:bisect_left(values, value)])
+                        else:
+                            matched_values.extend(values[bisect_right(values, value):])
+                    except TypeError:
+                        pass
+                matched_values.extend(other for other in self._unordered_values
+                                      if _compare(comparison_operator, other, value))
+
+            keys = [key for matched_value in matched_values for key in self._keys_by_value[matched_value]]
+            keys.extend(key for key, other in self._unindexed.items() if _compare(comparison_operator, other, value))
+            return keys
+
+    def _add(self, key: Any, value: Any):
+        try:
+            keys = self._keys_by_value.get(value) if value == value else _MISSING
+        except TypeError:
+            keys = _MISSING
+        if keys is _MISSING:
+            self._unindexed[key] = value
+        elif keys is not None:
+            keys[key] = None
+        else:
+            self._keys_by_value[value] = {key: None}
+            family = _get_ordering_family(value)
+            if family is None:
+                self._unordered_values[value] = None
+            else:
+                try:
+                    insort(self._sorted_values.setdefault(family, []), value)
+                except TypeError:
+                    # Value cannot be ordered against others of its type (e.g. tuples with different element types)
+                    self._unordered_values[value] = None
+
+    def _remove(self, key: Any, value: Any):
+        if key in self._unindexed:
+            del self._unindexed[key]
+            return
+        keys = self._keys_by_value[value]
+        del keys[key]
+        if len(keys) > 0:
+            return
+        del self._keys_by_value[value]
+        if value in self._unordered_values:
+            del self._unordered_values[value]
+            return
+        family = _get_ordering_family(value)
+        values = self._sorted_values[family]
+        del values[bisect_left(values, value)]
+        if len(values) == 0:
+            del self._sorted_values[family]
+
+
+class _ChangeJournal:
+    """
+    Journal of the keys changed in `Metadata`. The journal of a copy links to the journal of the metadata it was copied
+    from, which allows the keys that can differ between related metadata to be found.
+    """
+    def __init__(self, max_length: int, parent: "_ChangeJournal"=None, parent_version: int=0):
+        """
+        Constructor.
+        :param max_length: the maximum number of changes to keep, after which the oldest are discarded
+        :param parent: the journal of the metadata that the metadata was copied from
+        :param parent_version: the version of the parent journal when the copy was made
+        """
+        self.max_length = max_length
+        self.parent = parent
+        self.parent_version = parent_version
+        self._keys = []     # type: List[Any]
+        self._offset = 0
+        self._lock = Lock()
+
+    @property
+    def version(self) -> int:
+        """
+        The number of changes recorded in the journal.
+        """
+        return self._offset + len(self._keys)
+
+    def fork(self) -> "_ChangeJournal":
+        """
+        Creates a journal for a copy of the metadata with this journal.
+        :return: the journal for the copy
+        """
+        return _ChangeJournal(self.max_length, self, self.version)
+
+    def record(self, keys: Iterable[Any]):
+        """
+        Records that the given keys have changed.
+        :param keys: the changed keys
+        """
+        with self._lock:
+            self._keys.extend(keys)
+            if len(self._keys) > self.max_length:
+                discard = len(self._keys) - self.max_length // 2
+                self._keys = self._keys[discard:]
+                self._offset += discard
+
+    def get_changed_keys(self, start_version: int, end_version: int) -> Optional[List[Any]]:
+        """
+        Gets the keys changed between the given versions.
+        :param start_version: the start version (inclusive)
+        :param end_version: the end version (exclusive)
+        :return: the changed keys or `None` if the changes have been discarded
+        """
+        with self._lock:
+            if start_version < self._offset:
+                return None
+            return self._keys[start_version - self._offset:end_version - self._offset]
+
+    def get_versions(self) -> List[Tuple["_ChangeJournal", int]]:
+        """
+        Gets this journal and its ancestors, each with the version of that journal which the metadata was derived from.
+        :return: `(journal, version)` tuples, starting with this journal
+        """
+        versions = []
+        journal, version = self, self.version
+        while journal is not None:
+            versions.append((journal, version))
+            journal, version = journal.parent, journal.parent_version
+        return versions
+
+
+def _get_keys_that_can_differ(journal_1: _ChangeJournal, journal_2: _ChangeJournal) -> Optional[Set[Any]]:
+    """
+    Gets the keys that can differ between the metadata with the given journals.
+    :param journal_1: the journal of the first metadata
+    :param journal_2: the journal of the second metadata
+    :return: the keys or `None` if they cannot be determined from the journals
+    """
+    versions_1 = journal_1.get_versions()
+    versions_2 = journal_2.get_versions()
+    indices_2 = {id(journal): i for i, (journal, version) in enumerate(versions_2)}
+    for index_1, (ancestor, ancestor_version_1) in enumerate(versions_1):
+        index_2 = indices_2.get(id(ancestor))
+        if index_2 is None:
+            continue
+        ancestor_version_2 = versions_2[index_2][1]
+        ranges = [(journal, 0, version) for journal, version in versions_1[:index_1] + versions_2[:index_2]]
+        ranges.append((ancestor, min(ancestor_version_1, ancestor_version_2),
+                       max(ancestor_version_1, ancestor_version_2)))
+        keys = set()
+        for journal, start_version, end_version in ranges:
+            changed_keys = journal.get_changed_keys(start_version, end_version)
+            if changed_keys is None:
+                return None
+            keys.update(changed_keys)
+        return keys
+    return None
+
+
+class MetadataTransaction:
+    """
+    Changes to `Metadata` that are staged and then applied together.
+    """
+    def __init__(self, metadata: "Metadata"):
+        """
+        Constructor.
+        :param metadata: the metadata that the changes are to be applied to
+        """
+        self._metadata = metadata
+        self.updates = {}   # type: Dict[Any, Any]
+        self.deletions = set()  # type: Set[Any]
+
+    def update(self, items: Union[Mapping, Iterable[Tuple[Any, Any]]]):
+        """
+        Stages the setting of the given items.
+        :param items: the items to set
+        """
+        for key, value in dict(items).items():
+            self[key] = value
+
+    def __getitem__(self, key: Any) -> Any:
+        if key in self.deletions:
+            raise KeyError(key)
+        if key in self.updates:
+            return self.updates[key]
+        return self._metadata[key]
+
+    def __setitem__(self, key: Any, value: Any):
+        self.deletions.discard(key)
+        self.updates[key] = value
+
+    def __delitem__(self, key: Any):
+        self.updates.pop(key, None)
+        self.deletions.add(key)
+
+    def __contains__(self, key: Any) -> bool:
+        return key not in self.deletions and (key in self.updates or key in self._metadata)
 
 
 class Metadata(Mapping):
     """
     Generic key-value metadata model.
+
+    Changes to keys are thread-safe. Keys are guarded by a fixed number of "striped" locks, where the lock used for a
+    key is determined by the key's hash.
+
+    Batches of changes are seen by readers either all at once or not at all. Views of multiple items (e.g. `items`) are
+    of a copy of the items, taken when no batch is partially made.
+
+    Can optionally maintain an index of values so that the keys that hold values can be found without a linear scan.
+
+    Can optionally track changes, which are inherited by copies, so that the differences between related metadata can be
+    found without comparing every item.
     """
-    def __init__(self, seq=()):
+    def __init__(self, seq=(), lock_stripes: int=DEFAULT_LOCK_STRIPES, index_values: bool=False,
+                 track_changes: bool=False, max_tracked_changes: int=DEFAULT_MAX_TRACKED_CHANGES):
         """
         Constructor.
         :param seq: initial metadata items
+        :param lock_stripes: the number of locks used to guard changes to keys
+        :param index_values: whether to maintain an index of values, used when finding keys by value
+        :param track_changes: whether to track the keys that are changed, used when finding differences
+        :param max_tracked_changes: the maximum number of changes that are tracked, after which the oldest are forgotten
         """
         self._data = dict(seq)
-        self._key_locks = ThreadSafeDefaultdict(Lock)    # type: Dict[Any, Lock]
+        self._lock_stripes = _LockStripes(lock_stripes)
+        self._frozen = None     # type: FrozenMetadata
+        self._changed_since_frozen = set()  # type: Set[Any]
+        self._batches_lock = _BatchesLock()
+        self._journal = _ChangeJournal(max_tracked_changes) if track_changes else None  # type: Optional[_ChangeJournal]
+        self._value_index = self._create_value_index() if index_values else None   # type: Optional[_ValueIndex]
 
     def rename(self, key: Any, new_key: Any):
         """
@@ -74,45 +1366,261 @@ class Metadata(Mapping):
         if new_key == key:
             return
 
-        required_locks = [self._key_locks[key], self._key_locks[new_key]]
-        ordered_required_locks = sorted(required_locks, key=lambda x: id(x))
-        for lock in ordered_required_locks:
-            lock.acquire()
-
-        try:
+        with self._lock_stripes.hold((key, new_key)), self._batches_lock.batch():
             if key not in self._data:
                 raise KeyError("Attribute to rename \"%s\" does not exist" % key)
-            self._data[new_key] = self[key]
+            value = self[key]
+            replaced_value = self._data.get(new_key, _MISSING)
+            self._data[new_key] = value
             del self._data[key]
-        finally:
-            for lock in required_locks:
-                lock.release()
+            self._mark_changed((key, new_key))
+            if self._journal is not None:
+                self._journal.record((key, new_key))
+            if self._value_index is not None:
+                self._value_index.replace_many(((key, value, _MISSING), (new_key, replaced_value, value)))
+
+    def update_many(self, items: Union[Mapping, Iterable[Tuple[Any, Any]]]):
+        """
+        Sets the given items as a single change, which readers will either see all or none of.
+        :param items: the items to set
+        """
+        updates = dict(items)
+        if len(updates) == 0:
+            return
+        with self._lock_stripes.hold(updates.keys()):
+            if self._value_index is not None:
+                changes = [(key, self._data.get(key, _MISSING), value) for key, value in updates.items()]
+            # `dict.update` with a `dict` is a single operation for readers
+            self._data.update(updates)
+            self._mark_changed(updates.keys())
+            if self._journal is not None:
+                self._journal.record(updates.keys())
+            if self._value_index is not None:
+                self._value_index.replace_many(changes)
+
+    def delete_many(self, keys: Iterable[Any]):
+        """
+        Deletes the items with the given keys as a single change, which readers will either see all or none of. Keys
+        that do not exist are ignored.
+        :param keys: the keys of the items to delete
+        """
+        self._apply_changes({}, set(keys))
+
+    @contextmanager
+    def transaction(self) -> Iterator[MetadataTransaction]:
+        """
+        Context manager that stages changes made to the yielded transaction and then applies them as a single change
+        when the context exits. The changes are discarded if an exception is raised within the context. Deleted keys
+        that no longer exist when the changes are applied are ignored.
+
+        Only the atomicity of the changes is guaranteed: no locks are held whilst in the context, therefore values read
+        through the transaction may be changed by other threads before the transaction's changes are applied (and such
+        changes are then overwritten).
+        """
+        transaction = MetadataTransaction(self)
+        yield transaction
+        self._apply_changes(transaction.updates, transaction.deletions)
+
+    def freeze(self) -> FrozenMetadata:
+        """
+        Gets an immutable copy of this metadata.
+
+        Once frozen, the keys that are changed are remembered so that the next copy is got by applying the changes to
+        the previous one (sharing its unchanged structure), rather than by copying all the items.
+        :return: the immutable copy
+        """
+        frozen = self._frozen
+        if frozen is None or len(self._changed_since_frozen) > 0:
+            with self._lock_stripes.hold():
+                frozen = self._frozen
+                if frozen is None:
+                    frozen = FrozenMetadata(self._data)
+                else:
+                    for key in self._changed_since_frozen:
+                        value = self._data.get(key, _MISSING)
+                        if value is not _MISSING:
+                            frozen = frozen.set(key, value)
+                        elif key in frozen:
+                            frozen = frozen.delete(key)
+                self._changed_since_frozen.clear()
+                self._frozen = frozen
+        return frozen
+
+    def get_keys_with_value(self, value: Any, comparison_operator: ComparisonOperator=ComparisonOperator.EQUALS) \
+            -> List[Any]:
+        """
+        Gets the keys of the items with values that compare to the given value. Uses the index of values if this
+        metadata was created with `index_values`, otherwise the values are scanned.
+        :param value: the value to compare against
+        :param comparison_operator: the comparison between the items' values and the given value
+        :return: the matching keys
+        """
+        if self._value_index is not None:
+            return self._value_index.get_keys(value, comparison_operator)
+        return [key for key, other in self._get_snapshot().items() if _compare(comparison_operator, other, value)]
+
+    def find(self, *search_criteria: SearchCriterion) -> List[Any]:
+        """
+        Finds the keys of the items that match all of the given search criteria. The attribute of a criterion is the key
+        that it applies to, or `None` to apply to any key.
+        :param search_criteria: the search criteria
+        :return: the matching keys
+        """
+        matched_keys = None     # type: Optional[Dict[Any, None]]
+        for search_criterion in search_criteria:
+            if search_criterion.attribute is None:
+                keys = self.get_keys_with_value(search_criterion.value, search_criterion.comparison_operator)
+            else:
+                value = self._data.get(search_criterion.attribute, _MISSING)
+                matched = value is not _MISSING \
+                          and _compare(search_criterion.comparison_operator, value, search_criterion.value)
+                keys = [search_criterion.attribute] if matched else []
+            if matched_keys is None:
+                matched_keys = dict.fromkeys(keys)
+            else:
+                matched_keys = dict.fromkeys(key for key in keys if key in matched_keys)
+        return list(matched_keys) if matched_keys is not None else list(self._get_snapshot())
+
+    def diff(self, other: "Metadata") -> MetadataPatch:
+        """
+        Gets the differences between this and the given metadata, as a patch that changes this metadata into the given
+        metadata. If both track changes and one is derived from the other (or both are derived from the same metadata),
+        only the keys changed since they diverged are compared.
+        :param other: the metadata to compare against
+        :return: the patch
+        """
+        keys = None     # type: Optional[Set[Any]]
+        if self._journal is not None and other._journal is not None:
+            keys = _get_keys_that_can_differ(self._journal, other._journal)
+
+        patch = MetadataPatch()
+        if keys is None:
+            data = self._get_snapshot()
+            other_data = other._get_snapshot()
+            patch.added = {key: value for key, value in other_data.items() if key not in data}
+            patch.removed = {key for key in data if key not in other_data}
+            patch.changed = {key: value for key, value in other_data.items()
+                             if key in data and data[key] != value}
+        else:
+            for key in keys:
+                value = self._data.get(key, _MISSING)
+                other_value = other._data.get(key, _MISSING)
+                if value is _MISSING:
+                    if other_value is not _MISSING:
+                        patch.added[key] = other_value
+                elif other_value is _MISSING:
+                    patch.removed.add(key)
+                elif value != other_value:
+                    patch.changed[key] = other_value
+        return patch
+
+    def apply_patch(self, patch: MetadataPatch):
+        """
+        Applies the given patch as a single change, which readers will either see all or none of.
+        :param patch: the patch to apply
+        """
+        updates = dict(patch.added)
+        updates.update(patch.changed)
+        self._apply_changes(updates, patch.removed)
 
     def get(self, key: Any, default=None) -> Any:
         return self._data.get(key, default)
 
     def pop(self, key: Any, default=None) -> Any:
-        with self._key_locks[key]:
-            return self._data.pop(key, default)
+        with self._lock_stripes.get_lock(key):
+            value = self._data.pop(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._mark_changed((key, ))
+            if self._journal is not None:
+                self._journal.record((key, ))
+            if self._value_index is not None:
+                self._value_index.replace_many(((key, value, _MISSING), ))
+            return value
 
     def clear(self):
-        for key in self._key_locks.items():
-            self[key].acquire()
-        self._data.clear()
-        for key in self._key_locks.items():
-            self[key].release()
+        with self._lock_stripes.hold():
+            if self._journal is not None:
+                self._journal.record(list(self._data.keys()))
+            self._data.clear()
+            self._frozen = None
+            self._changed_since_frozen.clear()
+            if self._value_index is not None:
+                self._value_index.clear()
 
     def items(self) -> Iterable[Any]:
-        return self._data.items()
+        return self._get_snapshot().items()
 
     def keys(self) -> Iterable[Any]:
-        return self._data.keys()
+        return self._get_snapshot().keys()
 
     def values(self) -> Iterable[Any]:
-        return self._data.values()
+        return self._get_snapshot().values()
+
+    def _create_value_index(self) -> _ValueIndex:
+        """
+        Creates an index of the values in this metadata.
+        :return: the index
+        """
+        value_index = _ValueIndex()
+        value_index.replace_many((key, _MISSING, value) for key, value in self._data.items())
+        return value_index
+
+    def _apply_changes(self, updates: Dict[Any, Any], deletions: Set[Any]):
+        """
+        Applies the given changes as a single change.
+        :param updates: items to set
+        :param deletions: keys of items to delete
+        """
+        deletions = {key for key in deletions if key not in updates}
+        if len(deletions) == 0:
+            self.update_many(updates)
+            return
+
+        with self._lock_stripes.hold(deletions | updates.keys()), self._batches_lock.batch():
+            changes = [(key, self._data.pop(key, _MISSING), _MISSING) for key in deletions]
+            changes.extend((key, self._data.get(key, _MISSING), value) for key, value in updates.items())
+            self._data.update(updates)
+            self._mark_changed(deletions | updates.keys())
+            if self._journal is not None:
+                self._journal.record(key for key, old_value, new_value in changes)
+            if self._value_index is not None:
+                self._value_index.replace_many(changes)
+
+    def _get_snapshot(self) -> Dict[Any, Any]:
+        """
+        Gets a copy of the items in this metadata that does not include a partially made batch of changes.
+        :return: the copy of the items
+        """
+        # Copying a dictionary is a single operation for other threads
+        return self._read(dict.copy)
+
+    def _read(self, read: Callable[[Dict[Any, Any]], Any]) -> Any:
+        """
+        Reads the items in this metadata with the given function, waiting for any batch of changes, which cannot be made
+        with a single operation, to be made first so that a partially made batch is not read.
+        :param read: function that reads the items
+        :return: the result of the read
+        """
+        with self._batches_lock.reading():
+            return read(self._data)
+
+    def _mark_changed(self, keys: Iterable[Any]):
+        """
+        Remembers that the given keys have changed since this metadata was last frozen, if it has been frozen. Must be
+        called whilst holding the locks of the changed keys.
+        :param keys: the keys of the changed items
+        """
+        if self._frozen is None:
+            return
+        # Adding to a set is a single operation for other threads, so changes to different keys are not serialised
+        self._changed_since_frozen.update(keys)
+        if len(self._changed_since_frozen) > len(self._data):
+            # Copying all the items is then no slower than applying the changes
+            self._frozen = None
 
     def __str__(self) -> str:
-        return str(self._data)
+        return str(self._get_snapshot())
 
     def __repr__(self) -> str:
         return "<%s object at %s: %s>" % (type(self), id(self), str(self))
@@ -120,36 +1628,671 @@ class Metadata(Mapping):
     def __eq__(self, other: Any) -> bool:
         if type(other) != type(self):
             return False
-        return other._data == self._data
+        return other._get_snapshot() == self._get_snapshot()
 
     def __ne__(self, other: Any) -> bool:
         return not self.__eq__(other)
 
     def __iter__(self) -> Iterable[Any]:
-        return self._data.__iter__()
+        return iter(self._get_snapshot())
 
     def __len__(self) -> int:
-        return len(self._data)
+        return self._read(len)
 
     def __getitem__(self, key: Any) -> Any:
         return self._data[key]
 
     def __setitem__(self, key: Any, value: Any):
-        with self._key_locks[key]:
+        with self._lock_stripes.get_lock(key):
+            old_value = self._data.get(key, _MISSING)
             self._data[key] = value
+            self._mark_changed((key, ))
+            if self._journal is not None:
+                self._journal.record((key, ))
+            if self._value_index is not None:
+                self._value_index.replace_many(((key, old_value, value), ))
+
+    def __delitem__(self, key: Any):
+        with self._lock_stripes.get_lock(key):
+            value = self._data.pop(key)
+            self._mark_changed((key, ))
+            if self._journal is not None:
+                self._journal.record((key, ))
+            if self._value_index is not None:
+                self._value_index.replace_many(((key, value, _MISSING), ))
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._data
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The lock-holding index and change journal are rebuilt when unpickled, rather than pickled
+        state = dict(self.__dict__)
+        state["_data"] = self._get_snapshot()
+        state["_frozen"] = None
+        state["_changed_since_frozen"] = set()
+        state["_value_index"] = self._value_index is not None
+        state["_journal"] = self._journal.max_length if self._journal is not None else None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._journal = _ChangeJournal(state["_journal"]) if state["_journal"] is not None else None
+        self._value_index = self._create_value_index() if state["_value_index"] else None
+
+    def __copy__(self):
+        journal = self._journal.fork() if self._journal is not None else None
+        metadata_copy = self.__class__(
+            self._get_snapshot(), self._lock_stripes.number_of_stripes, self._value_index is not None)
+        metadata_copy._journal = journal
+        return metadata_copy
+
+    def __deepcopy__(self, memo):
+        journal = self._journal.fork() if self._journal is not None else None
+        data_deepcopy = copy.deepcopy(self._get_snapshot())
+        deepcopy = self.__class__(data_deepcopy, self._lock_stripes.number_of_stripes, self._value_index is not None)
+        deepcopy._journal = journal
+        memo[id(self)] = deepcopy
+        return deepcopy
+
+
+class MultiMetadata(Mapping):
+    """
+    Key-value metadata model where each key can have many values (e.g. iRODS AVUs with repeated attribute names).
+
+    The values of each key are a set that keeps the order in which values were added. Getting the values of a key
+    returns them as a tuple. Changes have the same locking guarantees as `Metadata`.
+    """
+    def __init__(self, seq=(), lock_stripes: int=DEFAULT_LOCK_STRIPES):
+        """
+        Constructor.
+        :param seq: initial metadata, as either a mapping of keys to collections of values or `(key, value)` pairs
+        :param lock_stripes: the number of locks used to guard changes to keys
+        """
+        self._data = {}     # type: Dict[Any, Dict[Any, None]]
+        self._lock_stripes = _LockStripes(lock_stripes)
+        for key, values in self._get_values_by_key(seq).items():
+            self._data[key] = values
+
+    def add(self, key: Any, value: Any) -> bool:
+        """
+        Adds the given value to the values of the given key.
+        :param key: the key
+        :param value: the value
+        :return: whether the value was added (it is not if the key already has the value)
+        """
+        with self._lock_stripes.get_lock(key):
+            values = self._data.get(key)
+            if values is None:
+                self._data[key] = {value: None}
+                return True
+            if value in values:
+                return False
+            values[value] = None
+            return True
+
+    def remove(self, key: Any, value: Any):
+        """
+        Removes the given value from the values of the given key. The key is removed if it has no other values.
+        :param key: the key
+        :param value: the value
+        :raises KeyError: if the key does not have the value
+        """
+        with self._lock_stripes.get_lock(key):
+            values = self._data.get(key)
+            if values is None or value not in values:
+                raise KeyError((key, value))
+            if len(values) == 1:
+                del self._data[key]
+            else:
+                del values[value]
+
+    def discard(self, key: Any, value: Any):
+        """
+        Removes the given value from the values of the given key, if the key has the value.
+        :param key: the key
+        :param value: the value
+        """
+        try:
+            self.remove(key, value)
+        except KeyError:
+            pass
+
+    def contains(self, key: Any, value: Any) -> bool:
+        """
+        Gets whether the given key has the given value.
+        :param key: the key
+        :param value: the value
+        :return: whether the key has the value
+        """
+        values = self._data.get(key)
+        return values is not None and value in values
+
+    def pairs(self) -> Iterable[Tuple[Any, Any]]:
+        """
+        Gets all `(key, value)` pairs.
+        :return: the pairs
+        """
+        return [(key, value) for key, values in list(self._data.items()) for value in tuple(values)]
+
+    def update(self, other):
+        """
+        Adds all of the values in the given metadata as a single change, which readers will either see all or none of.
+        :param other: the metadata to add, as either `MultiMetadata`, a mapping of keys to collections of values or
+        `(key, value)` pairs
+        """
+        additions = self._get_values_by_key(other)
+        if len(additions) == 0:
+            return
+        with self._lock_stripes.hold(additions.keys()):
+            for key, values in additions.items():
+                existing_values = self._data.get(key)
+                if existing_values is not None:
+                    # Values are replaced rather than changed so that they are updated along with all other keys
+                    additions[key] = dict(existing_values)
+                    additions[key].update(values)
+            self._data.update(additions)
+
+    def difference_update(self, other):
+        """
+        Removes all of the values in the given metadata as a single change, which readers will either see all or none
+        of. Values that do not exist are ignored.
+        :param other: the metadata to remove, as either `MultiMetadata`, a mapping of keys to collections of values or
+        `(key, value)` pairs
+        """
+        removals = self._get_values_by_key(other)
+        if len(removals) == 0:
+            return
+        with self._lock_stripes.hold():
+            # Keys may be removed, which cannot be done in a single operation so copy-on-write is used
+            data = dict(self._data)
+            for key, values in removals.items():
+                existing_values = data.get(key)
+                if existing_values is None:
+                    continue
+                remaining_values = {value: None for value in existing_values if value not in values}
+                if len(remaining_values) == 0:
+                    del data[key]
+                else:
+                    data[key] = remaining_values
+            self._data = data
+
+    def union(self, other) -> "MultiMetadata":
+        """
+        Gets new metadata with the values in both this and the given metadata.
+        :param other: the other metadata, as either `MultiMetadata`, a mapping of keys to collections of values or
+        `(key, value)` pairs
+        :return: the union
+        """
+        union = copy.copy(self)
+        union.update(other)
+        return union
+
+    def difference(self, other) -> "MultiMetadata":
+        """
+        Gets new metadata with the values in this metadata that are not in the given metadata.
+        :param other: the other metadata, as either `MultiMetadata`, a mapping of keys to collections of values or
+        `(key, value)` pairs
+        :return: the difference
+        """
+        difference = copy.copy(self)
+        difference.difference_update(other)
+        return difference
+
+    def clear(self):
+        with self._lock_stripes.hold():
+            self._data = {}
+
+    @staticmethod
+    def _get_values_by_key(seq) -> Dict[Any, Dict[Any, None]]:
+        """
+        Gets the values of each key, as insertion-ordered sets, in the given metadata.
+        :param seq: the metadata, as either `MultiMetadata`, a mapping of keys to collections of values or
+        `(key, value)` pairs
+        :return: the values by key
+        """
+        if isinstance(seq, MultiMetadata):
+            return {key: dict(values) for key, values in list(seq._data.items())}
+        values_by_key = {}  # type: Dict[Any, Dict[Any, None]]
+        if isinstance(seq, Mapping):
+            for key, values in seq.items():
+                if len(values) > 0:
+                    values_by_key.setdefault(key, {}).update(dict.fromkeys(values))
+        else:
+            for key, value in seq:
+                values_by_key.setdefault(key, {})[value] = None
+        return values_by_key
+
+    def __str__(self) -> str:
+        return str({key: list(values) for key, values in self._data.items()})
+
+    def __repr__(self) -> str:
+        return "<%s object at %s: %s>" % (type(self), id(self), str(self))
+
+    def __eq__(self, other: Any) -> bool:
+        if type(other) != type(self):
+            return False
+        return other._data == self._data
+
+    def __ne__(self, other: Any) -> bool:
+        return not self.__eq__(other)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __getitem__(self, key: Any) -> Tuple[Any, ...]:
+        return tuple(self._data[key])
 
     def __delitem__(self, key: Any):
-        with self._key_locks[key]:
+        with self._lock_stripes.get_lock(key):
             del self._data[key]
 
     def __contains__(self, key: Any) -> bool:
         return key in self._data
 
     def __copy__(self):
-        return self.__class__(self._data)
+        return self.__class__(self, self._lock_stripes.number_of_stripes)
 
     def __deepcopy__(self, memo):
         data_deepcopy = copy.deepcopy(self._data)
-        deepcopy = self.__class__(data_deepcopy)
+        deepcopy = self.__class__(lock_stripes=self._lock_stripes.number_of_stripes)
+        deepcopy._data = data_deepcopy
+        memo[id(self)] = deepcopy
+        return deepcopy
+
+
+class ShardedDict(MutableMapping):
+    """
+    Dictionary split into shards, each with its own lock, so that writers of keys in different shards do not contend.
+
+    Reads do not lock. Iteration is over a snapshot of each shard, so it is not affected by concurrent changes; use
+    `snapshot` to get a copy of all shards at a single point in time.
+    """
+    def __init__(self, seq=(), shards: int=DEFAULT_SHARDS):
+        """
+        Constructor.
+        :param seq: initial items
+        :param shards: the number of shards
+        """
+        if shards < 1:
+            raise ValueError("Must have at least one shard")
+        self._shards = [{} for _ in range(shards)]  # type: List[Dict[Any, Any]]
+        self._locks = [Lock() for _ in range(shards)]   # type: List[Lock]
+        self.update(seq)
+
+    def compute_if_absent(self, key: Any, factory: Callable[[Any], Any]) -> Any:
+        """
+        Gets the value for the given key, atomically setting it to the value created by the given factory if the key is
+        not in this dictionary. The factory is called whilst the key's shard is locked.
+        :param key: the key
+        :param factory: creates the value for the key, given the key
+        :return: the value for the key
+        """
+        index = hash(key) % len(self._shards)
+        shard = self._shards[index]
+        value = shard.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._locks[index]:
+            value = shard.get(key, _MISSING)
+            if value is _MISSING:
+                value = factory(key)
+                shard[key] = value
+            return value
+
+    def compute_if_present(self, key: Any, function: Callable[[Any, Any], Any]) -> Any:
+        """
+        Atomically sets the value for the given key to the value computed by the given function, if the key is in this
+        dictionary. The function is called whilst the key's shard is locked.
+        :param key: the key
+        :param function: computes the new value, given the key and its current value. The key is removed if it returns
+        `None`
+        :return: the new value or `None` if the key is not in this dictionary (or was removed)
+        """
+        index = hash(key) % len(self._shards)
+        shard = self._shards[index]
+        with self._locks[index]:
+            value = shard.get(key, _MISSING)
+            if value is _MISSING:
+                return None
+            value = function(key, value)
+            if value is None:
+                del shard[key]
+            else:
+                shard[key] = value
+            return value
+
+    def update(self, *args, **kwargs):
+        """
+        Sets the given items, locking each shard once.
+        :param args: optional mapping or iterable of `(key, value)` pairs, as accepted by `dict.update`
+        :param kwargs: items to set
+        """
+        items = dict(*args, **kwargs)
+        if len(items) == 0:
+            return
+        number_of_shards = len(self._shards)
+        items_by_shard = defaultdict(dict)  # type: Dict[int, Dict[Any, Any]]
+        for key, value in items.items():
+            items_by_shard[hash(key) % number_of_shards][key] = value
+        for index, shard_items in items_by_shard.items():
+            with self._locks[index]:
+                self._shards[index].update(shard_items)
+
+    def snapshot(self) -> Dict[Any, Any]:
+        """
+        Gets a copy of the items in this dictionary at a single point in time.
+        :return: the copy
+        """
+        snapshot = {}   # type: Dict[Any, Any]
+        for shard in self._get_shard_snapshots():
+            snapshot.update(shard)
+        return snapshot
+
+    def get(self, key: Any, default=None) -> Any:
+        return self._shards[hash(key) % len(self._shards)].get(key, default)
+
+    def _get_shard_snapshots(self) -> List[Dict[Any, Any]]:
+        """
+        Gets a copy of each shard, all taken at a single point in time.
+        :return: the copies of the shards
+        """
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            return [dict(shard) for shard in self._shards]
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+    def pop(self, key: Any, default=_MISSING) -> Any:
+        index = hash(key) % len(self._shards)
+        with self._locks[index]:
+            if default is _MISSING:
+                return self._shards[index].pop(key)
+            return self._shards[index].pop(key, default)
+
+    def setdefault(self, key: Any, default=None) -> Any:
+        return self.compute_if_absent(key, lambda key: default)
+
+    def clear(self):
+        for index, shard in enumerate(self._shards):
+            with self._locks[index]:
+                shard.clear()
+
+    def __getitem__(self, key: Any) -> Any:
+        return self._shards[hash(key) % len(self._shards)][key]
+
+    def __setitem__(self, key: Any, value: Any):
+        index = hash(key) % len(self._shards)
+        with self._locks[index]:
+            self._shards[index][key] = value
+
+    def __delitem__(self, key: Any):
+        index = hash(key) % len(self._shards)
+        with self._locks[index]:
+            del self._shards[index][key]
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._shards[hash(key) % len(self._shards)]
+
+    def __iter__(self) -> Iterator[Any]:
+        for index, shard in enumerate(self._shards):
+            with self._locks[index]:
+                keys = list(shard)
+            yield from keys
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    def __str__(self) -> str:
+        return str(self.snapshot())
+
+    def __repr__(self) -> str:
+        return "<%s object at %s: %s>" % (type(self), id(self), str(self))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        del state["_locks"]
+        state["_shards"] = [{key: _get_pickleable_value(value) for key, value in shard.items()}
+                            for shard in self._get_shard_snapshots()]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._locks = [Lock() for _ in range(len(self._shards))]
+
+    def __copy__(self):
+        return self.__class__(self.snapshot(), len(self._shards))
+
+    def __deepcopy__(self, memo):
+        deepcopy = self.__class__(copy.deepcopy(self.snapshot(), memo), len(self._shards))
         memo[id(self)] = deepcopy
         return deepcopy
+
+
+class _MetadataColumn:
+    """
+    Column of the values of a key in the records of a `MetadataTable`. Integers and floats are stored in arrays, strings
+    are dictionary-encoded and other values are stored in a list. Values are stored in a list if the column is given a
+    value that cannot be stored in the current way, so that values are never changed (e.g. from `int` to `float`).
+    """
+    def __init__(self, length: int):
+        """
+        Constructor.
+        :param length: the number of records before the first record with the key
+        """
+        self.present = bytearray(length)
+        self.kind = _EMPTY_COLUMN
+        self.values = None  # type: Union[array, List[Any]]
+        self.strings = None     # type: List[str]
+        self.string_codes = None    # type: Dict[str, int]
+
+    def append(self, value: Any):
+        """
+        Appends the value of the key in the next record.
+        :param value: the value
+        """
+        kind = _get_column_kind(value)
+        if self.kind == _EMPTY_COLUMN:
+            self._store_as(kind, [None] * len(self.present))
+        elif kind != self.kind and self.kind != _OBJECT_COLUMN:
+            self._store_as(_OBJECT_COLUMN, [self.get(row) for row in range(len(self.present))])
+
+        self.present.append(1)
+        if self.kind == _STRING_COLUMN:
+            code = self.string_codes.get(value)
+            if code is None:
+                code = len(self.strings)
+                self.strings.append(value)
+                self.string_codes[value] = code
+                if code == 256:
+                    # Too many distinct strings for the codes to be stored as bytes
+                    self.values = array(_COLUMN_TYPECODES[_STRING_COLUMN], self.values)
+            self.values.append(code)
+        else:
+            self.values.append(value)
+
+    def append_missing(self):
+        """
+        Appends that the next record does not have the key.
+        """
+        self.present.append(0)
+        if self.kind != _EMPTY_COLUMN:
+            self.values.append(_COLUMN_PLACEHOLDERS[self.kind])
+
+    def get(self, row: int) -> Any:
+        """
+        Gets the value of the key in the given record.
+        :param row: the index of the record
+        :return: the value or `_MISSING` if the record does not have the key
+        """
+        if not self.present[row]:
+            return _MISSING
+        if self.kind == _STRING_COLUMN:
+            return self.strings[self.values[row]]
+        return self.values[row]
+
+    def get_mask(self, value: Any, comparison_operator: ComparisonOperator) -> bytearray:
+        """
+        Gets the mask of the records with values that compare to the given value.
+        :param value: the value to compare against
+        :param comparison_operator: the comparison between the records' values and the given value
+        :return: mask with a byte for each record, which is 1 if the record matches else 0
+        """
+        if self.kind == _EMPTY_COLUMN:
+            return bytearray(len(self.present))
+        if self.kind == _STRING_COLUMN:
+            # Each distinct string is compared once, then the result is looked up for each record
+            matches = bytes(_compare(comparison_operator, string, value) for string in self.strings)
+            if self.values.typecode == _BYTE_STRING_CODE_TYPECODE:
+                mask = bytearray(self.values.tobytes().translate(matches.ljust(256, b"\x00")))
+            else:
+                mask = bytearray(map(matches.__getitem__, self.values))
+        elif self.kind == _OBJECT_COLUMN:
+            mask = bytearray(_compare(comparison_operator, other, value) for other in self.values)
+        else:
+            try:
+                # Comparisons are made in C, without evaluating Python code for each record
+                mask = bytearray(map(partial(_REFLECTED_COMPARISON_FUNCTIONS[comparison_operator], value), self.values))
+            except TypeError:
+                return bytearray(len(self.present))
+        return _and_masks(mask, self.present)
+
+    def _store_as(self, kind: str, values: List[Any]):
+        """
+        Stores the given values of the existing records as values of the given kind. The values of records without the
+        key are ignored.
+        :param kind: the kind of value to store as
+        :param values: the values, which are only strings if the kind is not string
+        """
+        self.kind = kind
+        placeholder = _COLUMN_PLACEHOLDERS[kind]
+        values = [value if present else placeholder for value, present in zip(values, self.present)]
+        if kind == _OBJECT_COLUMN:
+            self.values = values
+        elif kind == _STRING_COLUMN:
+            self.values = array(_BYTE_STRING_CODE_TYPECODE, values)
+        else:
+            self.values = array(_COLUMN_TYPECODES[kind], values)
+        self.strings = None
+        self.string_codes = None
+        if kind == _STRING_COLUMN:
+            self.strings = []
+            self.string_codes = {}
+
+
+class MetadataTable(Sequence):
+    """
+    Many metadata records stored by column, which uses much less memory than a `Metadata` for each record and allows the
+    records to be filtered in bulk. Records are converted to `Metadata` only when got.
+
+    Not thread-safe.
+    """
+    def __init__(self, records: Iterable[Mapping]=()):
+        """
+        Constructor.
+        :param records: initial records (e.g. `Metadata`), which are consumed one at a time
+        """
+        self._columns = OrderedDict()   # type: Dict[Any, _MetadataColumn]
+        self._length = 0
+        self.extend(records)
+
+    def append(self, record: Mapping):
+        """
+        Appends the given record.
+        :param record: the record
+        """
+        for key, value in record.items():
+            column = self._columns.get(key)
+            if column is None:
+                column = _MetadataColumn(self._length)
+                self._columns[key] = column
+            column.append(value)
+        self._length += 1
+        for column in self._columns.values():
+            if len(column.present) < self._length:
+                column.append_missing()
+
+    def extend(self, records: Iterable[Mapping]):
+        """
+        Appends the given records.
+        :param records: the records, which are consumed one at a time
+        """
+        for record in records:
+            self.append(record)
+
+    def keys(self) -> List[Any]:
+        """
+        Gets the keys in any of the records.
+        :return: the keys
+        """
+        return list(self._columns.keys())
+
+    def get_column(self, key: Any, default: Any=None) -> List[Any]:
+        """
+        Gets the value of the given key in each record.
+        :param key: the key
+        :param default: the value for records without the key
+        :return: the values
+        """
+        column = self._columns.get(key)
+        if column is None:
+            return [default] * self._length
+        values = [column.get(row) for row in range(self._length)]
+        return [value if value is not _MISSING else default for value in values]
+
+    def get_mask(self, *search_criteria: SearchCriterion) -> bytearray:
+        """
+        Gets the mask of the records that match all of the given search criteria. The attribute of a criterion is the
+        key that it applies to, or `None` to apply to any key.
+        :param search_criteria: the search criteria
+        :return: mask with a byte for each record, which is 1 if the record matches else 0
+        """
+        mask = bytearray(b"\x01" * self._length)
+        for search_criterion in search_criteria:
+            if search_criterion.attribute is None:
+                columns = self._columns.values()
+            else:
+                column = self._columns.get(search_criterion.attribute)
+                columns = [column] if column is not None else []
+            criterion_mask = bytearray(self._length)
+            for column in columns:
+                criterion_mask = _or_masks(
+                    criterion_mask, column.get_mask(search_criterion.value, search_criterion.comparison_operator))
+            mask = _and_masks(mask, criterion_mask)
+        return mask
+
+    def get_indices(self, mask: bytearray) -> List[int]:
+        """
+        Gets the indices of the records in the given mask.
+        :param mask: the mask
+        :return: the indices of the records
+        """
+        return list(compress(range(len(mask)), mask))
+
+    def find(self, *search_criteria: SearchCriterion) -> Iterator[Metadata]:
+        """
+        Finds the records that match all of the given search criteria.
+        :param search_criteria: the search criteria, as used in `get_mask`
+        :return: iterator of the matching records, which are converted to `Metadata` as they are iterated
+        """
+        for row in self.get_indices(self.get_mask(*search_criteria)):
+            yield self[row]
+
+    def __getitem__(self, index: int) -> Metadata:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Record index out of range")
+        metadata = Metadata()
+        for key, column in self._columns.items():
+            value = column.get(index)
+            if value is not _MISSING:
+                metadata._data[key] = value
+        return metadata
+
+    def __len__(self) -> int:
+        return self._length
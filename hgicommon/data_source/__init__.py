@@ -1,5 +1,8 @@
 from hgicommon.data_source.common import DataSource
 from hgicommon.data_source.basic import ListDataSource, MultiDataSource
-from hgicommon.data_source.static_from_file import FilesDataSource, SynchronisedFilesDataSource
+from hgicommon.data_source.static_from_file import FilesDataSource, SynchronisedFilesDataSource, open_data_file
 from hgicommon.data_source.dynamic_from_file import register, unregister, registration_event_listenable_map,\
-    RegisteringDataSource, RegistrationEvent
+    RegisteringDataSource, RegistrationEvent, register_many, unregister_many, registration_batch_event_listenable_map, \
+    RegistrationBatchEvent
+from hgicommon.data_source.formats import StreamingFilesDataSource, JsonLinesFilesDataSource, CsvFilesDataSource
+from hgicommon.data_source.chunked_from_file import ChunkedFilesDataSource
@@ -0,0 +1,300 @@
+"""
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import os
+import pickle
+from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from itertools import chain, islice
+from threading import Lock
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple, Optional
+
+from hgicommon.data_source.common import DataSourceType
+from hgicommon.data_source.static_from_file import FilesDataSource, open_data_file
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class ChunkedFilesDataSource(FilesDataSource):
+    """
+    Sources data from data files in a given directory, where each file is made up of records that are separated by a
+    delimiter (newline by default). Each file is split into chunks of whole records, which are extracted by a pool of
+    worker processes (by default) and then merged in order. The pool is created when first needed and is shared by all
+    files (see `shutdown_chunk_executor`). Files with only one chunk are extracted without the pool.
+
+    Worker processes extract chunks with a copy of the data source that only has its public attributes that can be
+    pickled, therefore `extract_data_from_chunk` must only rely on those. The data source's type must also be importable
+    by the workers.
+
+    The data extracted from each chunk is cached against a digest of the chunk, such that only the chunks that have
+    changed need to be extracted when a file is re-read. Chunk boundaries only depend on the contents of the file before
+    them, therefore this works best for files that are appended to. The caches of files that no longer exist are
+    removed.
+
+    Can be mixed into `SynchronisedFilesDataSource`, e.g.
+    `class X(ChunkedFilesDataSource, SynchronisedFilesDataSource)`.
+    """
+    __metaclass__ = ABCMeta
+
+    # The delimiter between records in the data files
+    record_delimiter = b"\n"
+
+    def __init__(self, directory_location: str, chunk_size: int=DEFAULT_CHUNK_SIZE, max_chunk_workers: int=None,
+                 cache_chunks: bool=True, chunk_executor_factory: Callable[[int], Executor]=ProcessPoolExecutor,
+                 **kwargs):
+        """
+        Constructor.
+        :param directory_location: the location of the directory that contains files holding data
+        :param chunk_size: the (approximate) size of the chunks, in bytes, that files are split into
+        :param max_chunk_workers: (optional) the maximum number of workers used to extract chunks of a file. Uses the
+        number of CPUs if not set
+        :param cache_chunks: whether to cache the data extracted from chunks so unchanged chunks are not re-extracted
+        :param chunk_executor_factory: creates the executor, given the maximum number of workers, that chunks are
+        extracted with. Defaults to a pool of processes, as extraction written in Python only uses one CPU at a time in
+        threads
+        :param kwargs: see `FilesDataSource.__init__`
+        """
+        super().__init__(directory_location, **kwargs)
+        self.chunk_size = chunk_size
+        self.max_chunk_workers = max_chunk_workers
+        self.cache_chunks = cache_chunks
+        self.chunk_executor_factory = chunk_executor_factory
+        self._chunk_caches = dict()     # type: Dict[str, Dict[bytes, Sequence[DataSourceType]]]
+        self._chunk_executor = None     # type: Optional[Executor]
+        self._chunk_executor_lock = Lock()
+
+    @abstractmethod
+    def extract_data_from_chunk(self, chunk: bytes) -> Iterable[DataSourceType]:
+        """
+        Extracts data from the given chunk of a data file.
+        :param chunk: the chunk, which is made up of whole records (including their delimiters)
+        :return: the extracted data
+        """
+
+    def extract_data_from_file(self, file_path: str) -> Iterable[DataSourceType]:
+        previous_chunk_cache = self._chunk_caches.get(file_path, dict())
+        chunk_cache = dict()    # type: Dict[bytes, Sequence[DataSourceType]]
+        extracted = []
+
+        # Bounding the number of chunks in memory at once
+        max_pending = 2 * self._get_max_chunk_workers()
+        pending = deque()
+        extractor = _ChunkExtractor(self)
+
+        with open_data_file(file_path, text=False) as file:
+            chunks = self._iterate_chunks(file)
+            first_chunks = list(islice(chunks, 2))
+            # Not worth sending the chunk of a file with only one chunk to a worker
+            submit = self._submit_chunk_extraction if len(first_chunks) > 1 else _extract_chunk_in_this_thread
+            for chunk in chain(first_chunks, chunks):
+                digest = hashlib.blake2b(chunk, digest_size=16).digest()
+                if digest in previous_chunk_cache:
+                    pending.append((digest, None, previous_chunk_cache[digest]))
+                else:
+                    pending.append((digest, submit(extractor, chunk), None))
+                while len(pending) >= max_pending:
+                    self._merge_chunk(pending.popleft(), extracted, chunk_cache)
+            while len(pending) > 0:
+                self._merge_chunk(pending.popleft(), extracted, chunk_cache)
+
+        if self.cache_chunks:
+            self._chunk_caches[file_path] = chunk_cache
+        return extracted
+
+    def clear_chunk_cache(self, file_path: str=None):
+        """
+        Clears the cache of data extracted from chunks.
+        :param file_path: (optional) the path of the file to clear the cache of. Clears the cache of all files if not
+        set
+        """
+        if file_path is None:
+            self._chunk_caches.clear()
+        else:
+            self._chunk_caches.pop(file_path, None)
+
+    def shutdown_chunk_executor(self):
+        """
+        Shuts down the executor that chunks are extracted with, if it has been created. A new executor is created if
+        more chunks are then extracted.
+        """
+        with self._chunk_executor_lock:
+            executor = self._chunk_executor
+            self._chunk_executor = None
+        if executor is not None:
+            executor.shutdown()
+
+    def _get_data_file_paths(self) -> List[str]:
+        file_paths = super()._get_data_file_paths()
+        existing_file_paths = set(file_paths)
+        for file_path in list(self._chunk_caches.keys()):
+            if file_path not in existing_file_paths:
+                self._chunk_caches.pop(file_path, None)
+        return file_paths
+
+    def _on_file_deleted(self, event):
+        """
+        Called when a file in the monitored directory has been deleted, if mixed into `SynchronisedFilesDataSource`.
+        :param event: the file system event
+        """
+        self._chunk_caches.pop(event.src_path, None)
+        super()._on_file_deleted(event)
+
+    def _on_file_moved(self, event):
+        """
+        Called when a file in the monitored directory has been moved, if mixed into `SynchronisedFilesDataSource`. The
+        cache of the file is moved with it.
+        :param event: the file system event
+        """
+        chunk_cache = self._chunk_caches.pop(event.src_path, None)
+        if chunk_cache is not None and not event.is_directory and self.is_data_file(event.dest_path):
+            self._chunk_caches[event.dest_path] = chunk_cache
+        super()._on_file_moved(event)
+
+    def _get_max_chunk_workers(self) -> int:
+        """
+        Gets the maximum number of workers used to extract chunks.
+        :return: the maximum number of workers
+        """
+        return self.max_chunk_workers if self.max_chunk_workers is not None else os.cpu_count() or 1
+
+    def _submit_chunk_extraction(self, extractor: "_ChunkExtractor", chunk: bytes) -> Future:
+        """
+        Submits the extraction of the given chunk to the executor, creating the executor if it does not exist.
+        :param extractor: the chunk extractor
+        :param chunk: the chunk
+        :return: the future of the extracted data
+        """
+        executor = self._chunk_executor
+        if executor is None:
+            with self._chunk_executor_lock:
+                if self._chunk_executor is None:
+                    self._chunk_executor = self.chunk_executor_factory(self._get_max_chunk_workers())
+                executor = self._chunk_executor
+        return executor.submit(extractor, chunk)
+
+    def _iterate_chunks(self, file: BinaryIO) -> Iterator[bytes]:
+        """
+        Iterates over the given file in chunks, made up of whole records, of about the chunk size.
+        :param file: the file opened in binary mode
+        :return: the chunks
+        """
+        delimiter = self.record_delimiter
+        remainder = b""
+        while True:
+            block = file.read(self.chunk_size)
+            if len(block) == 0:
+                if len(remainder) > 0:
+                    yield remainder
+                return
+            # Buffered reads only return less than requested at the end of the file
+            if len(block) < self.chunk_size:
+                yield remainder + block
+                return
+            block = remainder + block
+            end = block.rfind(delimiter)
+            if end == -1:
+                remainder = block
+            else:
+                end += len(delimiter)
+                remainder = block[end:]
+                yield block[:end]
+
+    @staticmethod
+    def _merge_chunk(pending_chunk: Tuple[bytes, Optional[Future], Optional[Sequence[DataSourceType]]],
+                     extracted: List[DataSourceType], chunk_cache: Dict[bytes, Sequence[DataSourceType]]):
+        """
+        Merges the data extracted from the given pending chunk into the given extracted data and chunk cache.
+        :param pending_chunk: tuple containing the chunk's digest, the future of the chunk's extraction (if it had to be
+        extracted) and the chunk's previously extracted data (if it did not)
+        :param extracted: the data extracted from the file so far
+        :param chunk_cache: the chunk cache for the file
+        """
+        digest, future, data = pending_chunk
+        if future is not None:
+            data = future.result()
+        chunk_cache[digest] = data
+        extracted.extend(data)
+
+
+class _ChunkExtractor:
+    """
+    Extracts data from chunks with a `ChunkedFilesDataSource`. When pickled, to be sent to worker processes, only the
+    public attributes of the data source that can be pickled are included.
+    """
+    def __init__(self, data_source: ChunkedFilesDataSource):
+        """
+        Constructor.
+        :param data_source: the data source
+        """
+        self._data_source = data_source
+        self._reduced = None    # type: Optional[Tuple[Callable, Tuple]]
+
+    def __call__(self, chunk: bytes) -> List[DataSourceType]:
+        """
+        Extracts the data from the given chunk into a list.
+        :param chunk: see `ChunkedFilesDataSource.extract_data_from_chunk`
+        :return: see `ChunkedFilesDataSource.extract_data_from_chunk`
+        """
+        return list(self._data_source.extract_data_from_chunk(chunk))
+
+    def __reduce__(self):
+        if self._reduced is None:
+            state = dict()  # type: Dict[str, Any]
+            for name, value in vars(self._data_source).items():
+                if name.startswith("_"):
+                    continue
+                try:
+                    pickle.dumps(value)
+                except Exception:
+                    continue
+                state[name] = value
+            self._reduced = (_create_chunk_extractor, (type(self._data_source), state))
+        return self._reduced
+
+
+def _extract_chunk_in_this_thread(extractor: _ChunkExtractor, chunk: bytes) -> Future:
+    """
+    Extracts the given chunk in this thread.
+    :param extractor: the chunk extractor
+    :param chunk: the chunk
+    :return: the (completed) future of the extracted data
+    """
+    future = Future()
+    try:
+        future.set_result(extractor(chunk))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _create_chunk_extractor(data_source_type: type, state: Dict[str, Any]) -> _ChunkExtractor:
+    """
+    Creates a chunk extractor with a data source of the given type and state, without calling its constructor.
+    :param data_source_type: the type of the data source
+    :param state: the attributes of the data source
+    :return: the chunk extractor
+    """
+    data_source = data_source_type.__new__(data_source_type)
+    data_source.__dict__.update(state)
+    return _ChunkExtractor(data_source)
@@ -20,32 +20,42 @@ General Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import ast
 import logging
 import os
+import sys
 from abc import ABCMeta
 from collections import defaultdict
-from importlib.util import module_from_spec, spec_from_file_location
+from importlib import invalidate_caches
+from importlib.machinery import ModuleSpec, SourceFileLoader
+from importlib.util import cache_from_source, module_from_spec, spec_from_file_location
 from multiprocessing import Lock
-from typing import Any, Iterable
+from types import CodeType
+from typing import Any, Iterable, Dict, Set, Optional, List, Sequence
+
+from watchdog.events import FileSystemEvent, FileSystemMovedEvent
 
 from hgicommon.data_source.basic import DataSourceType
-from hgicommon.data_source.static_from_file import SynchronisedFilesDataSource
+from hgicommon.data_source.packed import ModuleArchive
+from hgicommon.data_source.static_from_file import SynchronisedFilesDataSource, FileSystemChange
 from hgicommon.mixable import Listenable
-from hgicommon.models import RegistrationEvent
+from hgicommon.models import RegistrationEvent, RegistrationBatchEvent
 
 # Map where the key is the type of object the listener is interested is and the value is the listenable that will get
 # updates of registration events
 registration_event_listenable_map = defaultdict(Listenable)    # type: defaultdict[type, RegistrationEvent]
 
+# Map where the key is the type of object the listener is interested is and the value is the listenable that will get
+# updates of batches of registration events (including batches of one, from `register` and `unregister`)
+registration_batch_event_listenable_map = defaultdict(Listenable)    # type: defaultdict[type, RegistrationBatchEvent]
+
 
 def register(registerable: Any):
     """
     Registers an object, notifying any listeners that may be interested in it.
     :param registerable: the object to register
     """
-    listenable = registration_event_listenable_map[type(registerable)]
-    event = RegistrationEvent(registerable, RegistrationEvent.Type.REGISTERED)
-    listenable.notify_listeners(event)
+    _notify_registration_listeners(type(registerable), [registerable], RegistrationEvent.Type.REGISTERED)
 
 
 def unregister(registerable: Any):
@@ -53,9 +63,60 @@ def unregister(registerable: Any):
     Unregisters an object, notifying any listeners that may be interested in it.
     :param registerable: the object to unregister
     """
-    listenable = registration_event_listenable_map[type(registerable)]
-    event = RegistrationEvent(registerable, RegistrationEvent.Type.UNREGISTERED)
-    listenable.notify_listeners(event)
+    _notify_registration_listeners(type(registerable), [registerable], RegistrationEvent.Type.UNREGISTERED)
+
+
+def register_many(registerables: Iterable[Any]):
+    """
+    Registers a batch of objects, notifying batch listeners once per type of object in the batch.
+    :param registerables: the objects to register
+    """
+    for registerable_type, registerables_of_type in _group_by_type(registerables).items():
+        _notify_registration_listeners(registerable_type, registerables_of_type, RegistrationEvent.Type.REGISTERED)
+
+
+def unregister_many(registerables: Iterable[Any]):
+    """
+    Unregisters a batch of objects, notifying batch listeners once per type of object in the batch.
+    :param registerables: the objects to unregister
+    """
+    for registerable_type, registerables_of_type in _group_by_type(registerables).items():
+        _notify_registration_listeners(registerable_type, registerables_of_type, RegistrationEvent.Type.UNREGISTERED)
+
+
+def _group_by_type(objects: Iterable[Any]) -> Dict[type, List[Any]]:
+    """
+    Groups the given objects by their type, maintaining their order.
+    :param objects: the objects to group
+    :return: map where the key is the type and the value is the objects of that type
+    """
+    grouped = dict()    # type: Dict[type, List[Any]]
+    for obj in objects:
+        obj_type = type(obj)
+        if obj_type not in grouped:
+            grouped[obj_type] = []
+        grouped[obj_type].append(obj)
+    return grouped
+
+
+def _notify_registration_listeners(registerable_type: type, registerables: Sequence[Any],
+                                   event_type: RegistrationEvent.Type):
+    """
+    Notifies the listeners interested in the given type of object about a registration update of the given objects.
+
+    Batch listeners get a single event whilst other listeners get an event per object.
+    :param registerable_type: the type of the objects
+    :param registerables: the objects
+    :param event_type: the type of registration update
+    """
+    batch_listenable = registration_batch_event_listenable_map.get(registerable_type)
+    if batch_listenable is not None:
+        batch_listenable.notify_listeners(RegistrationBatchEvent(registerables, event_type))
+
+    listenable = registration_event_listenable_map[registerable_type]
+    if len(listenable.get_listeners()) > 0:
+        for registerable in registerables:
+            listenable.notify_listeners(RegistrationEvent(registerable, event_type))
 
 
 # TODO: signature should be:
@@ -66,6 +127,13 @@ class RegisteringDataSource(SynchronisedFilesDataSource):
     Data source where data are defined pragmatically in Python modules. After their definition, data are registered
     using `register`, which this class listens to in order to capture the definitions. The modules are put in a
     directory and are able to be changed on-the-fly.
+
+    Modules may import other (helper) modules in the directory (if the directory is on the Python path). When a helper
+    module changes, the modules that depend on it (directly or through other helper modules) are reloaded, whilst
+    unaffected modules are not.
+
+    To speed up starting with a large number of modules, the compiled modules can be loaded from an archive built using
+    `hgicommon.data_source.packed`. Modules that have changed since the archive was built are loaded from source.
     """
     __metaclass__ = ABCMeta
 
@@ -73,14 +141,20 @@ class RegisteringDataSource(SynchronisedFilesDataSource):
     # definitions loaded by other sources
     _load_locks = defaultdict(Lock)  # type: defaultdict[type, Lock]
 
-    def __init__(self, directory_location: str, data_type: type):
+    def __init__(self, directory_location: str, data_type: type, archive_location: str=None):
         """
         Constructor.
         :param directory_location: the location of the directory
         :param data_type: the type of data that is loaded from files in the given directory
+        :param archive_location: (optional) the location of an archive of the compiled modules in the directory, which
+        is used when starting
         """
         super().__init__(directory_location)
         self._data_type = data_type
+        self.archive_location = archive_location
+        self._archive = None    # type: Optional[ModuleArchive]
+        # Map where the key is the path of a module and the value is the paths of the local modules it may import
+        self._local_imports = dict()     # type: Dict[str, Set[str]]
 
     def extract_data_from_file(self, file_path: str) -> Iterable[DataSourceType]:
         assert self.is_data_file(file_path)
@@ -89,20 +163,25 @@ class RegisteringDataSource(SynchronisedFilesDataSource):
         if file_path.rsplit(".")[-1] != "py":
             raise RuntimeError("Can only import uncompiled python modules that have the extension \".py\"")
 
+        # Local imports are found lazily, as it requires reading the module's source
+        self._local_imports.pop(file_path, None)
+        archive = self._archive
+        # The identity of the file is recorded just before data is extracted from it, so need not be got again
+        code = archive.get_code(file_path, self._origin_identities.get(file_path)) if archive is not None else None
         loaded = []
 
-        def registration_event_listener(event: RegistrationEvent):
+        def registration_event_listener(event: RegistrationBatchEvent):
             assert event.event_type == RegistrationEvent.Type.REGISTERED
-            loaded.append(event.target)
+            loaded.extend(event.targets)
 
         RegisteringDataSource._load_locks[self._data_type].acquire()
-        registration_event_listenable_map[self._data_type].add_listener(registration_event_listener)
+        registration_batch_event_listenable_map[self._data_type].add_listener(registration_event_listener)
 
         try:
-            RegisteringDataSource._load_module(file_path)
+            RegisteringDataSource._load_module(file_path, code)
         finally:
             RegisteringDataSource._load_locks[self._data_type].release()
-            registration_event_listenable_map[self._data_type].remove_listener(registration_event_listener)
+            registration_batch_event_listenable_map[self._data_type].remove_listener(registration_event_listener)
 
         if len(loaded) == 0:
             raise RuntimeError(
@@ -110,12 +189,244 @@ class RegisteringDataSource(SynchronisedFilesDataSource):
         else:
             return loaded
 
+    def start(self, block: bool=True):
+        if self.archive_location is not None:
+            try:
+                self._archive = ModuleArchive(self.archive_location, self._directory_location)
+            except Exception as e:
+                logging.warning("Could not use module archive %s: %s" % (self.archive_location, e))
+        super().start(block)
+
+    def _load_all_into_origin_map(self, origin_mapped_data: Dict[str, Iterable[DataSourceType]]):
+        try:
+            super()._load_all_into_origin_map(origin_mapped_data)
+        finally:
+            # Changes after starting are loaded from source
+            self._archive = None
+
+    def _on_file_created(self, event: FileSystemEvent):
+        is_module = RegisteringDataSource._is_module_event(event)
+        if is_module:
+            self._unload_changed_modules(event.src_path)
+        super()._on_file_created(event)
+        if is_module:
+            self._reload_dependents(event.src_path)
+
+    def _on_file_modified(self, event: FileSystemEvent):
+        is_module = RegisteringDataSource._is_module_event(event)
+        if is_module:
+            self._unload_changed_modules(event.src_path)
+        super()._on_file_modified(event)
+        if is_module:
+            self._reload_dependents(event.src_path)
+
+    def _on_file_deleted(self, event: FileSystemEvent):
+        is_module = RegisteringDataSource._is_module_event(event)
+        if is_module:
+            self._unload_changed_modules(event.src_path)
+        super()._on_file_deleted(event)
+        if is_module:
+            self._reload_dependents(event.src_path)
+
+    def _on_file_moved(self, event: FileSystemMovedEvent):
+        # Moves of data files are broken down into deletes and creates, which handle dependents
+        super()._on_file_moved(event)
+        if not event.is_directory and not self.is_data_file(event.src_path):
+            for file_path in (event.src_path, event.dest_path):
+                if RegisteringDataSource._is_module_source(file_path):
+                    self._unload_changed_modules(file_path)
+                    self._reload_dependents(file_path)
+
+    def _unload_changed_modules(self, file_path: str):
+        """
+        Unloads the changed module, and the modules that depend on it, from the modules cache such that they are
+        re-executed when they are next imported.
+        :param file_path: the path of the changed module
+        """
+        file_paths = {file_path} | self._get_dependents(file_path)
+        # Data files are loaded without being put into the modules cache
+        loaded_file_paths = {path for path in file_paths if path in self._origin_identities}
+        RegisteringDataSource._unload_modules(file_paths, loaded_file_paths)
+
+    def _reload_dependents(self, file_path: str):
+        """
+        Reloads the data from the modules that depend on the changed module.
+        :param file_path: the path of the changed module
+        """
+        if os.path.exists(file_path):
+            self._update_local_imports(file_path, refresh=True)
+        else:
+            self._local_imports.pop(file_path, None)
+
+        for dependent in self._get_dependents(file_path):
+            if dependent in self._origin_mapped_data:
+                logging.info("Reloading \"%s\" as it depends on \"%s\"" % (dependent, file_path))
+                # The module has not changed itself so it would otherwise be skipped if it previously failed
+                self._forget_failure(dependent)
+                self._extract_into_origin_map(dependent, self._origin_mapped_data, self._origin_identities)
+                self.notify_listeners(FileSystemChange.MODIFY)
+
+    def _get_dependents(self, file_path: str) -> Set[str]:
+        """
+        Gets the paths of the modules that depend on the module at the given path, either directly or indirectly.
+        :param file_path: the path of the module
+        :return: the paths of the dependent modules (not including the module itself)
+        """
+        # Import of modules loaded from a snapshot will not be known
+        for origin in list(self._origin_mapped_data.keys()):
+            self._update_local_imports(origin)
+
+        importers = defaultdict(set)    # type: Dict[str, Set[str]]
+        for importer, imported in list(self._local_imports.items()):
+            for path in imported:
+                importers[path].add(importer)
+
+        dependents = set()
+        to_visit = [file_path]
+        while len(to_visit) > 0:
+            for importer in importers[to_visit.pop()]:
+                if importer not in dependents:
+                    dependents.add(importer)
+                    to_visit.append(importer)
+        dependents.discard(file_path)
+        return dependents
+
+    def _update_local_imports(self, file_path: str, refresh: bool=False):
+        """
+        Updates the known local imports of the module at the given path, and of the local modules it imports.
+        :param file_path: the path of the module
+        :param refresh: whether to refresh the imports of the module at the given path if they are already known
+        """
+        to_visit = [file_path]
+        while len(to_visit) > 0:
+            path = to_visit.pop()
+            if path in self._local_imports and not (refresh and path == file_path):
+                continue
+            self._local_imports[path] = self._find_local_imports(path)
+            to_visit.extend(imported for imported in self._local_imports[path] if os.path.exists(imported))
+
+    def _find_local_imports(self, file_path: str) -> Set[str]:
+        """
+        Finds the paths of the local modules that the module at the given path may import. Paths of modules that do not
+        (yet) exist are included so that their creation can be noticed.
+        :param file_path: the path of the module
+        :return: the paths of the local modules
+        """
+        try:
+            with open(file_path, "r") as file:
+                tree = ast.parse(file.read(), file_path)
+        except (OSError, SyntaxError, ValueError):
+            return set()
+
+        module_directory = os.path.dirname(file_path)
+        imports = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    imports |= self._get_module_paths(alias.name, module_directory)
+            elif isinstance(node, ast.ImportFrom):
+                if node.level == 0:
+                    search_directory = None
+                    module_name = node.module
+                else:
+                    search_directory = module_directory
+                    for _ in range(node.level - 1):
+                        search_directory = os.path.dirname(search_directory)
+                    module_name = node.module if node.module is not None else ""
+                for alias in node.names:
+                    # Names imported from a module may themselves be modules
+                    name = "%s.%s" % (module_name, alias.name) if module_name != "" else alias.name
+                    imports |= self._get_module_paths(name, module_directory, search_directory)
+        return imports
+
+    def _get_module_paths(self, module_name: str, module_directory: str, search_directory: str=None) -> Set[str]:
+        """
+        Gets the paths in the monitored directory that the module with the given name (and its parent packages) may be
+        loaded from.
+        :param module_name: the (dotted) name of the module
+        :param module_directory: the directory of the importing module
+        :param search_directory: (optional) the directory to look for the module in if the import is relative
+        :return: the possible paths of the module
+        """
+        if search_directory is not None:
+            search_directories = [search_directory]
+        else:
+            search_directories = {module_directory, self._directory_location}
+
+        paths = set()
+        name_parts = module_name.split(".")
+        for directory in search_directories:
+            for i in range(1, len(name_parts) + 1):
+                location = os.path.join(directory, *name_parts[:i])
+                paths.add("%s.py" % location)
+                paths.add(os.path.join(location, "__init__.py"))
+        return paths
+
+    @staticmethod
+    def _is_module_event(event: FileSystemEvent) -> bool:
+        """
+        Gets whether the given file system event is about the source of a Python module.
+        :param event: the file system event
+        :return: whether the event is about a module's source
+        """
+        return not event.is_directory and RegisteringDataSource._is_module_source(event.src_path)
+
+    @staticmethod
+    def _is_module_source(file_path: str) -> bool:
+        """
+        Gets whether the file at the given path is the source of a Python module.
+        :param file_path: the path of the file
+        :return: whether the file is a module's source
+        """
+        return file_path.endswith(".py")
+
     @staticmethod
-    def _load_module(path: str):
+    def _unload_modules(file_paths: Set[str], loaded_file_paths: Set[str]=frozenset()):
+        """
+        Removes the modules loaded from the given paths from the modules cache, along with their cached bytecode. The
+        bytecode is removed as it is reused if a module's size and modification time (in seconds) are unchanged.
+
+        Nothing is done if none of the modules have been loaded.
+        :param file_paths: the paths of the modules
+        :param loaded_file_paths: the paths of the modules that are known to have been loaded without being put into
+        the modules cache
+        """
+        file_names = {os.path.basename(file_path) for file_path in file_paths}
+        real_file_paths = {os.path.realpath(file_path) for file_path in file_paths}
+        loaded = dict()     # type: Dict[str, str]
+        for name, module in list(sys.modules.items()):
+            module_file_path = getattr(module, "__file__", None)
+            if module_file_path is not None and os.path.basename(module_file_path) in file_names \
+                    and os.path.realpath(module_file_path) in real_file_paths:
+                loaded[name] = module_file_path
+        if len(loaded) == 0 and len(loaded_file_paths) == 0:
+            return
+
+        for file_path in set(loaded.values()) | set(loaded_file_paths):
+            try:
+                os.remove(cache_from_source(file_path))
+            except (FileNotFoundError, NotImplementedError):
+                pass
+        invalidate_caches()
+        for name, module_file_path in loaded.items():
+            logging.debug("Unloading module \"%s\" loaded from: %s" % (name, module_file_path))
+            sys.modules.pop(name, None)
+
+    @staticmethod
+    def _load_module(path: str, code: CodeType=None):
         """
         Dynamically loads the python module at the given path.
         :param path: the path to load the module from
+        :param code: (optional) the compiled code of the module. Compiled from the module's source if not given
         """
-        spec = spec_from_file_location(os.path.basename(path), path)
-        module = module_from_spec(spec)
-        spec.loader.exec_module(module)
+        name = os.path.basename(path)
+        if code is None:
+            spec = spec_from_file_location(name, path)
+            module = module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            # Building the spec directly, as `spec_from_file_location` is relatively slow
+            spec = ModuleSpec(name, SourceFileLoader(name, path), origin=path)
+            spec.has_location = True
+            module = module_from_spec(spec)
+            exec(code, module.__dict__)
@@ -0,0 +1,157 @@
+"""
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import csv
+import json
+import logging
+import os
+from abc import ABCMeta, abstractmethod
+from typing import Any, Callable, Dict, Iterable, Iterator, Sequence, TextIO
+
+from hgicommon.data_source.common import DataSourceType
+from hgicommon.data_source.static_from_file import FilesDataSource, open_data_file, strip_compression_suffix
+
+DEFAULT_READ_BUFFER_SIZE = 64 * 1024
+
+
+class StreamingFilesDataSource(FilesDataSource):
+    """
+    Sources data from data files in a given directory, where the data in each file is made up of rows that can be parsed
+    one at a time. Data can be streamed using `iterate_all`, which only holds a buffer of each file in memory at a time.
+
+    Compressed data files (e.g. "data.csv.gz") are decompressed as they are read.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, directory_location: str, file_extensions: Sequence[str],
+                 row_mapper: Callable[[Any], DataSourceType]=None, read_buffer_size: int=DEFAULT_READ_BUFFER_SIZE,
+                 **kwargs):
+        """
+        Constructor.
+        :param directory_location: the location of the directory that contains files holding data
+        :param file_extensions: extensions of the files that hold data (e.g. ".csv")
+        :param row_mapper: (optional) function that maps each parsed row to a data item, e.g. to a `Model`. Rows are
+        not mapped if not set
+        :param read_buffer_size: the number of bytes to buffer when reading files
+        :param kwargs: see `FilesDataSource.__init__`
+        """
+        super().__init__(directory_location, **kwargs)
+        self.file_extensions = tuple(file_extensions)
+        self.row_mapper = row_mapper
+        self.read_buffer_size = read_buffer_size
+
+    @abstractmethod
+    def _parse_rows(self, file: TextIO, file_path: str) -> Iterator[Any]:
+        """
+        Parses the rows in the given open file, one at a time.
+        :param file: the open file
+        :param file_path: the path of the open file
+        :return: the parsed rows
+        """
+
+    def iterate_data_from_file(self, file_path: str) -> Iterator[DataSourceType]:
+        """
+        Iterates over the data in the file at the given path, reading and parsing it as it goes.
+        :param file_path: the path to the file to extract data from
+        :return: the data in the file
+        """
+        with open_data_file(file_path, buffer_size=self.read_buffer_size, newline="") as file:
+            rows = self._parse_rows(file, file_path)
+            if self.row_mapper is None:
+                yield from rows
+            else:
+                yield from map(self.row_mapper, rows)
+
+    def iterate_all(self) -> Iterator[DataSourceType]:
+        """
+        Iterates over the data in all of the data files in the directory, without loading all of it into memory.
+
+        Errors are suppressed, in line with `no_error_extract_data_from_file`, though data yielded from a file before an
+        error was encountered in it will not be retracted.
+        :return: the data at the source
+        """
+        for file_path in self._get_data_file_paths():
+            try:
+                yield from self.iterate_data_from_file(file_path)
+            except Exception as e:
+                logging.warning(e)
+
+    def extract_data_from_file(self, file_path: str) -> Iterable[DataSourceType]:
+        return list(self.iterate_data_from_file(file_path))
+
+    def is_data_file(self, file_path: str) -> bool:
+        return strip_compression_suffix(file_path).endswith(self.file_extensions) and os.path.isfile(file_path)
+
+
+class JsonLinesFilesDataSource(StreamingFilesDataSource):
+    """
+    Sources data from JSON Lines (http://jsonlines.org) files in a given directory. Blank lines are ignored.
+    """
+    def __init__(self, directory_location: str, file_extensions: Sequence[str]=(".jsonl", ".ndjson"),
+                 row_mapper: Callable[[Any], DataSourceType]=None, read_buffer_size: int=DEFAULT_READ_BUFFER_SIZE,
+                 **kwargs):
+        """
+        Constructor.
+        :param directory_location: see `StreamingFilesDataSource.__init__`
+        :param file_extensions: see `StreamingFilesDataSource.__init__`
+        :param row_mapper: see `StreamingFilesDataSource.__init__`
+        :param read_buffer_size: see `StreamingFilesDataSource.__init__`
+        :param kwargs: see `FilesDataSource.__init__`
+        """
+        super().__init__(directory_location, file_extensions, row_mapper, read_buffer_size, **kwargs)
+        self._decode = json.JSONDecoder().decode
+
+    def _parse_rows(self, file: TextIO, file_path: str) -> Iterator[Any]:
+        decode = self._decode
+        for line_number, line in enumerate(file, 1):
+            if line.isspace() or len(line) == 0:
+                continue
+            try:
+                yield decode(line)
+            except ValueError as e:
+                raise ValueError("Invalid JSON on line %d of \"%s\": %s" % (line_number, file_path, e)) from e
+
+
+class CsvFilesDataSource(StreamingFilesDataSource):
+    """
+    Sources data from CSV files in a given directory. Each row is parsed into a dictionary, keyed by the field names.
+    """
+    def __init__(self, directory_location: str, file_extensions: Sequence[str]=(".csv", ),
+                 row_mapper: Callable[[Dict[str, str]], DataSourceType]=None,
+                 read_buffer_size: int=DEFAULT_READ_BUFFER_SIZE, fieldnames: Sequence[str]=None, delimiter: str=",",
+                 **kwargs):
+        """
+        Constructor.
+        :param directory_location: see `StreamingFilesDataSource.__init__`
+        :param file_extensions: see `StreamingFilesDataSource.__init__`
+        :param row_mapper: see `StreamingFilesDataSource.__init__`
+        :param read_buffer_size: see `StreamingFilesDataSource.__init__`
+        :param fieldnames: (optional) the names of the fields. The first row of each file is used if not set
+        :param delimiter: the field delimiter
+        :param kwargs: see `FilesDataSource.__init__`
+        """
+        super().__init__(directory_location, file_extensions, row_mapper, read_buffer_size, **kwargs)
+        self.fieldnames = fieldnames
+        self.delimiter = delimiter
+
+    def _parse_rows(self, file: TextIO, file_path: str) -> Iterator[Dict[str, str]]:
+        return csv.DictReader(file, fieldnames=self.fieldnames, delimiter=self.delimiter)
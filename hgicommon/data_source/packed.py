@@ -0,0 +1,188 @@
+"""
+Packed Module Archives
+======================
+Archives of the compiled code of the Python modules in a directory, which
+`RegisteringDataSource` can load modules from using a single sequential
+read, opposed to a number of file system operations per module.
+
+An archive can be built from the command line:
+
+    python -m hgicommon.data_source.packed <directory_location> <archive_location>
+
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import glob
+import io
+import json
+import logging
+import marshal
+import os
+import tempfile
+import zipfile
+from importlib.util import MAGIC_NUMBER
+from types import CodeType
+from typing import Dict, Optional, Tuple
+
+from hgicommon.data_source.static_from_file import FileIdentity, get_file_identity
+
+_MANIFEST_NAME = "manifest.json"
+_ARCHIVE_VERSION = 1
+
+
+def build_module_archive(directory_location: str, archive_location: str) -> int:
+    """
+    Builds an archive of the compiled code of all of the Python modules in the given directory (and its
+    subdirectories).
+
+    Modules that cannot be compiled are left out of the archive (such that they are loaded from source).
+    :param directory_location: the location of the directory containing the modules
+    :param archive_location: the location to write the archive to
+    :return: the number of modules in the archive
+    """
+    modules = dict()    # type: Dict[str, Dict]
+    uncompiled = dict()     # type: Dict[str, Optional[FileIdentity]]
+    handle, temp_location = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(archive_location)))
+    try:
+        with os.fdopen(handle, "wb") as file, zipfile.ZipFile(file, "w", zipfile.ZIP_STORED) as archive:
+            module_paths = sorted(glob.iglob("%s/**/*.py" % directory_location, recursive=True))
+            for i, module_path in enumerate(module_paths):
+                # Getting identity before reading so that changes during the read are not missed
+                file_identity = get_file_identity(module_path)
+                relative_path = os.path.relpath(module_path, directory_location)
+                with open(module_path, "rb") as module_file:
+                    try:
+                        code = compile(module_file.read(), module_path, "exec", dont_inherit=True)
+                    except (SyntaxError, ValueError) as e:
+                        logging.warning("Not archiving module that could not be compiled: %s (%s)" % (module_path, e))
+                        uncompiled[relative_path] = file_identity
+                        continue
+                entry_name = "%d.code" % i
+                archive.writestr(entry_name, marshal.dumps(code))
+                modules[relative_path] = {
+                    "identity": file_identity,
+                    "entry": entry_name
+                }
+            archive.writestr(_MANIFEST_NAME, json.dumps({
+                "version": _ARCHIVE_VERSION,
+                "magic_number": MAGIC_NUMBER.hex(),
+                "modules": modules,
+                "uncompiled": uncompiled
+            }))
+        os.replace(temp_location, archive_location)
+    except BaseException:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+        raise
+    return len(modules)
+
+
+class ModuleArchive:
+    """
+    Archive of the compiled code of the Python modules in a directory.
+
+    The code of a module is only used if the module's source file has not changed since the archive was built.
+    """
+    def __init__(self, archive_location: str, directory_location: str):
+        """
+        Constructor.
+
+        Will raise a `ValueError` if the archive was built by an incompatible version of this library or of Python.
+        :param archive_location: the location of the archive
+        :param directory_location: the location of the directory containing the modules the archive was built from
+        """
+        with open(archive_location, "rb") as file:
+            self._archive = zipfile.ZipFile(io.BytesIO(file.read()))
+        self._directory_location = directory_location
+
+        manifest = json.loads(self._archive.read(_MANIFEST_NAME).decode())
+        if manifest["version"] != _ARCHIVE_VERSION:
+            raise ValueError("Unsupported module archive version: %s" % manifest["version"])
+        if manifest["magic_number"] != MAGIC_NUMBER.hex():
+            raise ValueError("Module archive was built by a different version of Python")
+
+        self._modules = dict()     # type: Dict[str, Tuple[Optional[FileIdentity], str]]
+        for relative_path, module in manifest["modules"].items():
+            file_identity = tuple(module["identity"]) if module["identity"] is not None else None
+            self._modules[relative_path] = (file_identity, module["entry"])
+        # Modules that could not be compiled when the archive was built
+        self._uncompiled = dict()     # type: Dict[str, Optional[FileIdentity]]
+        for relative_path, file_identity in manifest.get("uncompiled", dict()).items():
+            self._uncompiled[relative_path] = tuple(file_identity) if file_identity is not None else None
+
+    def get_code(self, file_path: str, file_identity: FileIdentity=None) -> Optional[CodeType]:
+        """
+        Gets the compiled code of the module at the given path.
+        :param file_path: the path of the module
+        :param file_identity: (optional) the current identity of the module's file, if already known. Got from the file
+        if not given
+        :return: the compiled code or `None` if the module is not in the archive or has changed since it was archived
+        """
+        module = self._modules.get(os.path.relpath(file_path, self._directory_location))
+        if module is None:
+            return None
+        archived_file_identity, entry_name = module
+        if archived_file_identity is None:
+            return None
+        if file_identity is None:
+            file_identity = get_file_identity(file_path)
+        if archived_file_identity != file_identity:
+            return None
+        return marshal.loads(self._archive.read(entry_name))
+
+    def is_stale(self) -> bool:
+        """
+        Gets whether any of the modules in the directory have changed, been added or been removed since the archive was
+        built.
+        :return: whether the archive is stale
+        """
+        module_paths = glob.glob("%s/**/*.py" % self._directory_location, recursive=True)
+        if len(module_paths) != len(self._modules) + len(self._uncompiled):
+            return True
+        for module_path in module_paths:
+            relative_path = os.path.relpath(module_path, self._directory_location)
+            module = self._modules.get(relative_path)
+            if module is not None:
+                file_identity = module[0]
+            elif relative_path in self._uncompiled:
+                file_identity = self._uncompiled[relative_path]
+            else:
+                return True
+            if file_identity != get_file_identity(module_path):
+                return True
+        return False
+
+
+def main():
+    """
+    Builds a module archive from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Builds an archive of the compiled Python modules in a directory")
+    parser.add_argument("directory_location", help="location of the directory containing the modules")
+    parser.add_argument("archive_location", help="location to write the archive to")
+    arguments = parser.parse_args()
+    number_of_modules = build_module_archive(arguments.directory_location, arguments.archive_location)
+    print("Archived %d modules to %s" % (number_of_modules, arguments.archive_location))
+
+
+if __name__ == "__main__":
+    main()
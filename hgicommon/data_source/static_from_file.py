@@ -20,12 +20,24 @@ General Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import bz2
 import glob
+import gzip
+import hashlib
+import io
 import logging
+import lzma
+import os
+import pickle
+import re
+import tempfile
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import unique, Enum
 from multiprocessing import Lock
-from typing import Iterable, Dict, Sequence
+from threading import Event, Thread, Timer
+from time import monotonic
+from typing import Iterable, Dict, Sequence, List, Tuple, Optional, IO, Callable, Any
 
 from watchdog.events import FileSystemEventHandler, FileSystemEvent, EVENT_TYPE_DELETED, EVENT_TYPE_CREATED, \
     FileSystemMovedEvent
@@ -34,21 +46,200 @@ from watchdog.observers import Observer
 from hgicommon.data_source import DataSource
 from hgicommon.data_source.basic import DataSourceType
 from hgicommon.mixable import Listenable
+from hgicommon.models import Model
+
+# Identity of a file's contents, as far as can be told without reading the file
+FileIdentity = Tuple[int, int, int]
+
+# Number of bytes read at a time when getting the digest of a file
+_DIGEST_BLOCK_SIZE = 1024 * 1024
+
+
+def get_file_identity(file_path: str) -> Optional[FileIdentity]:
+    """
+    Gets the identity of the file at the given path, which changes when the file is changed.
+    :param file_path: the path of the file
+    :return: the identity of the file or `None` if the file could not be accessed
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def get_file_digest(file_path: str) -> Optional[bytes]:
+    """
+    Gets a digest of the contents of the file at the given path.
+    :param file_path: the path of the file
+    :return: the digest of the file or `None` if the file could not be read
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(_DIGEST_BLOCK_SIZE), b""):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.digest()
+
+
+def _without_traceback(exception: BaseException) -> BaseException:
+    """
+    Removes the traceback from the given exception and from the exceptions that it was raised from or whilst handling.
+    :param exception: the exception
+    :return: the exception
+    """
+    seen = set()
+    chained = exception
+    while chained is not None and id(chained) not in seen:
+        seen.add(id(chained))
+        chained.__traceback__ = None
+        chained = chained.__cause__ if chained.__cause__ is not None else chained.__context__
+    return exception
+
+
+@unique
+class Compression(Enum):
+    """
+    Compression format of a file.
+    """
+    GZIP = 1
+    BZIP2 = 2
+    XZ = 3
+
+
+_COMPRESSION_SUFFIXES = {
+    ".gz": Compression.GZIP,
+    ".bz2": Compression.BZIP2,
+    ".xz": Compression.XZ
+}
+# Patterns of the headers of compressed files. A "weak" match of only the start of a header, which can also be the start
+# of an uncompressed file, is only trusted if the file's suffix agrees
+_COMPRESSION_HEADERS = {
+    Compression.GZIP: (re.compile(b"\x1f\x8b\x08"), re.compile(b"\x1f\x8b")),
+    # Block size, followed by the magic number of either a block or the end of the stream
+    Compression.BZIP2: (re.compile(b"BZh[1-9](?:1AY&SY|\x17rE8P\x90)"), re.compile(b"BZh[1-9]")),
+    Compression.XZ: (re.compile(b"\xfd7zXZ\x00"), None)
+}   # type: Dict[Compression, Tuple[Any, Optional[Any]]]
+_HEADER_LENGTH = 10
+_COMPRESSION_OPENERS = {
+    Compression.GZIP: gzip.open,
+    Compression.BZIP2: bz2.open,
+    Compression.XZ: lzma.open
+}
+
+
+def get_compression(file_path: str) -> Optional[Compression]:
+    """
+    Gets the compression format of the file at the given path, as determined by the file's header. If the header only
+    partly matches that of a compression format, the file must also have the format's suffix.
+    :param file_path: the path of the file
+    :return: the compression format or `None` if the file is not compressed (in a known format)
+    """
+    with open(file_path, "rb") as file:
+        header = file.read(_HEADER_LENGTH)
+    for compression, (header_pattern, _) in _COMPRESSION_HEADERS.items():
+        if header_pattern.match(header):
+            return compression
+    suffix_compression = _COMPRESSION_SUFFIXES.get(os.path.splitext(file_path)[1])
+    if suffix_compression is not None:
+        weak_header_pattern = _COMPRESSION_HEADERS[suffix_compression][1]
+        if weak_header_pattern is not None and weak_header_pattern.match(header):
+            return suffix_compression
+    return None
+
+
+def strip_compression_suffix(file_path: str) -> str:
+    """
+    Strips any compression suffix (e.g. ".gz") from the given file path.
+    :param file_path: the file path
+    :return: the file path without a compression suffix
+    """
+    root, suffix = os.path.splitext(file_path)
+    return root if suffix in _COMPRESSION_SUFFIXES else file_path
+
+
+def open_data_file(file_path: str, text: bool=True, buffer_size: int=io.DEFAULT_BUFFER_SIZE, encoding: str=None,
+                   newline: str=None) -> IO:
+    """
+    Opens the data file at the given path for reading. If the file is compressed, the returned file object decompresses
+    the contents of the file as it is read.
+    :param file_path: the path of the file to open
+    :param text: whether to open the file in text mode, opposed to binary mode
+    :param buffer_size: the number of bytes to buffer when reading the file
+    :param encoding: (optional) see `open`
+    :param newline: (optional) see `open`
+    :return: the open file
+    """
+    compression = get_compression(file_path)
+    if compression is None:
+        if text:
+            return open(file_path, "r", buffering=buffer_size, encoding=encoding, newline=newline)
+        return open(file_path, "rb", buffering=buffer_size)
+
+    file = io.BufferedReader(_COMPRESSION_OPENERS[compression](file_path, "rb"), buffer_size=buffer_size)
+    if text:
+        return io.TextIOWrapper(file, encoding=encoding, newline=newline)
+    return file
+
+
+class ExtractionFailure(Model):
+    """
+    Model of a failure to extract data from a file.
+    """
+    def __init__(self, file_identity: Optional[FileIdentity], exception: Exception, attempts: int=1,
+                 retry_after: float=None, file_digest: bytes=None):
+        """
+        Constructor.
+        :param file_identity: the identity of the file when the extraction failed
+        :param exception: the exception raised during the extraction, without its traceback (so that the frames of the
+        extraction are not kept alive)
+        :param attempts: the number of consecutive failed attempts to extract data from the file
+        :param retry_after: (optional) monotonic time before which extraction should not be re-attempted, even if the
+        file has changed
+        :param file_digest: (optional) digest of the contents of the file when the extraction failed
+        """
+        self.file_identity = file_identity
+        self.exception = exception
+        self.attempts = attempts
+        self.retry_after = retry_after
+        self.file_digest = file_digest
 
 
 class FilesDataSource(DataSource[DataSourceType]):
     """
     Sources data from data files in a given directory.
+
+    Files from which data cannot be extracted are not re-tried until they change. Files whose contents are unchanged
+    (e.g. files that have only been touched) do not count as changed. Optionally, consecutive failures on a file that
+    keeps changing can back off exponentially.
+
+    Implementations should use `open_data_file` to read data files so that compressed files are transparently
+    decompressed. As decompression does not hold the GIL, loading many files (compressed files in particular) may be
+    sped up by loading them in parallel.
     """
     __metaclass__ = ABCMeta
 
-    def __init__(self, directory_location: str):
+    def __init__(self, directory_location: str, failure_backoff: float=None, max_failure_backoff: float=3600.0,
+                 max_workers: int=None):
         """
         Default constructor.
         :param directory_location: the location of the directory that contains files holding data
+        :param failure_backoff: (optional) number of seconds to wait before re-attempting the extraction of data from a
+        file that has changed since a failed extraction. Doubles with each consecutive failure. Changed files are
+        re-attempted straight away if not set
+        :param max_failure_backoff: the maximum number of seconds to back off for
+        :param max_workers: (optional) the maximum number of threads to use to load data files in parallel. Files are
+        loaded one at a time if not set
         """
         super().__init__()
         self._directory_location = directory_location
+        self.max_workers = max_workers
+        self.failure_backoff = failure_backoff
+        self.max_failure_backoff = max_failure_backoff
+        self._failures = dict()     # type: Dict[str, ExtractionFailure]
+        self._failures_lock = Lock()
 
     @abstractmethod
     def extract_data_from_file(self, file_path: str) -> Iterable[DataSourceType]:
@@ -72,26 +263,132 @@ class FilesDataSource(DataSource[DataSourceType]):
     def no_error_extract_data_from_file(self, file_path: str) -> Iterable[DataSourceType]:
         """
         Proxy for `extract_data_from_file` that suppresses any errors and instead just returning an empty list.
+
+        Failures are remembered, with an empty list returned without re-attempting the extraction until the file changes
+        (and any backoff period has passed).
         :param file_path: see `extract_data_from_file`
         :return: see `extract_data_from_file`
         """
+        file_identity = get_file_identity(file_path)
+        with self._failures_lock:
+            failure = self._failures.get(file_path)
+
+        if failure is not None:
+            if self._is_unchanged_since_failure(file_path, file_identity, failure):
+                logging.debug("Not extracting data from unchanged file that previously failed: %s" % file_path)
+                return []
+            if failure.retry_after is not None and monotonic() < failure.retry_after:
+                logging.debug("Backing off extracting data from file that previously failed: %s" % file_path)
+                self._on_extraction_backed_off(file_path, failure.retry_after)
+                return []
+
         try:
-            return self.extract_data_from_file(file_path)
+            extracted = self.extract_data_from_file(file_path)
         except Exception as e:
             logging.warning(e)
+            attempts = failure.attempts + 1 if failure is not None else 1
+            retry_after = None
+            if self.failure_backoff is not None:
+                backoff = min(self.failure_backoff * 2 ** (attempts - 1), self.max_failure_backoff)
+                retry_after = monotonic() + backoff
+            file_digest = get_file_digest(file_path)
+            if get_file_identity(file_path) != file_identity:
+                # The digest may not be of the contents that the extraction failed on
+                file_digest = None
+            with self._failures_lock:
+                self._failures[file_path] = ExtractionFailure(
+                    file_identity, _without_traceback(e), attempts, retry_after, file_digest)
             return []
 
+        if failure is not None:
+            self._forget_failure(file_path)
+        return extracted
+
+    def get_failed_origins(self) -> Dict[str, ExtractionFailure]:
+        """
+        Gets the files from which data could not be extracted the last time extraction was attempted.
+        :return: map where the keys are the paths of the files and the values are details of the failures
+        """
+        with self._failures_lock:
+            return dict(self._failures)
+
+    def _is_unchanged_since_failure(self, file_path: str, file_identity: Optional[FileIdentity],
+                                    failure: ExtractionFailure) -> bool:
+        """
+        Gets whether the file at the given path is unchanged since the given failure to extract data from it.
+
+        The contents of the file are only compared if nothing but its modification time has changed, in which case the
+        identity recorded with the failure is updated so that they do not have to be compared again.
+        :param file_path: the path of the file
+        :param file_identity: the current identity of the file
+        :param failure: the failure
+        :return: whether the file is unchanged
+        """
+        if failure.file_identity == file_identity:
+            return True
+        if file_identity is None or failure.file_identity is None or failure.file_digest is None \
+                or file_identity[:2] != failure.file_identity[:2]:
+            return False
+        if get_file_digest(file_path) != failure.file_digest:
+            return False
+        with self._failures_lock:
+            if self._failures.get(file_path) is failure:
+                self._failures[file_path] = ExtractionFailure(
+                    file_identity, failure.exception, failure.attempts, failure.retry_after, failure.file_digest)
+        return True
+
+    def _on_extraction_backed_off(self, file_path: str, retry_after: float):
+        """
+        Called when the extraction of data from a changed file is not attempted as it is backing off from a failure.
+        :param file_path: the path of the file
+        :param retry_after: the monotonic time after which the extraction can be re-attempted
+        """
+
+    def _forget_failure(self, file_path: str):
+        """
+        Forgets about any failure to extract data from the file at the given path, such that extraction from it will be
+        attempted the next time it is requested.
+        :param file_path: the path of the file
+        """
+        with self._failures_lock:
+            self._failures.pop(file_path, None)
+
+    def _get_data_file_paths(self) -> List[str]:
+        """
+        Gets the paths of all of the data files in the directory location.
+        :return: the paths of the data files
+        """
+        return [file_path for file_path in glob.iglob("%s/**/*" % self._directory_location, recursive=True)
+                if self.is_data_file(file_path)]
+
     def _load_all_in_directory(self) -> Dict[str, Iterable[DataSourceType]]:
         """
         Loads all of the data from the files in directory location.
         :return: a origin map of all the loaded data
         """
         origin_mapped_data = dict()    # type: Dict[str, Iterable[DataSourceType]]
-        for file_path in glob.iglob("%s/**/*" % self._directory_location, recursive=True):
-            if self.is_data_file(file_path):
-                origin_mapped_data[file_path] = self.no_error_extract_data_from_file(file_path)
+
+        def load(file_path: str):
+            origin_mapped_data[file_path] = self.no_error_extract_data_from_file(file_path)
+
+        self._for_each_file(load, self._get_data_file_paths())
         return origin_mapped_data
 
+    def _for_each_file(self, function: Callable[[str], Any], file_paths: Iterable[str]):
+        """
+        Calls the given function with each of the given file paths, in parallel if set to use multiple workers.
+        :param function: the function to call
+        :param file_paths: the file paths to call the function with
+        """
+        if self.max_workers is None or self.max_workers <= 1:
+            for file_path in file_paths:
+                function(file_path)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # Consuming results to raise any exceptions
+                for _ in executor.map(function, file_paths):
+                    pass
+
     @staticmethod
     def _extract_data_from_origin_map(origin_mapped_data: Dict[str, Iterable[DataSourceType]]) \
             -> Iterable[DataSourceType]:
@@ -101,7 +398,8 @@ class FilesDataSource(DataSource[DataSourceType]):
         :return: the data contained within the map
         """
         data = []
-        for _, data_item in origin_mapped_data.items():
+        # Copying values as the map may be changed by another thread whilst the data is extracted
+        for data_item in list(origin_mapped_data.values()):
             data.extend(data_item)
         return data
 
@@ -126,19 +424,40 @@ class SynchronisedFilesDataSource(FilesDataSource, Listenable[FileSystemChange])
     changed. Does not have to read the data on every call to `get_all`.
 
     Can have listeners which are called when an update to the data is made.
+
+    The data can be snapshotted to a local file when stopped (and periodically) such that, when started again, only the
+    data files that have changed since the snapshot was taken need to be re-read. The snapshot is pickled, therefore the
+    data must be picklable and the snapshot file must be trusted.
     """
     __metaclass__ = ABCMeta
 
-    def __init__(self, directory_location: str):
+    _SNAPSHOT_VERSION = 1
+
+    def __init__(self, directory_location: str, failure_backoff: float=None, max_failure_backoff: float=3600.0,
+                 max_workers: int=None, snapshot_location: str=None, snapshot_period: float=None):
         """
         Default constructor.
         :param directory_location: the location of the directory that contains files holding data
+        :param failure_backoff: see `FilesDataSource.__init__`
+        :param max_failure_backoff: see `FilesDataSource.__init__`
+        :param max_workers: see `FilesDataSource.__init__`
+        :param snapshot_location: (optional) location of the file to snapshot the data to
+        :param snapshot_period: (optional) number of seconds between snapshots taken whilst running. Snapshots are only
+        taken when stopped if not set
         """
-        super().__init__(directory_location)
+        super().__init__(directory_location, failure_backoff, max_failure_backoff, max_workers)
         self._status_lock = Lock()
         self._running = False
         self._observer = None
         self._origin_mapped_data = dict()   # type: Dict[str, DataSourceType]
+        self._origin_identities = dict()   # type: Dict[str, Optional[FileIdentity]]
+        self._origins_lock = Lock()
+        self._retry_timers = dict()     # type: Dict[str, Timer]
+        self._ready = Event()
+        self._load_progress = (0, 0)
+        self._stop_event = Event()
+        self.snapshot_location = snapshot_location
+        self.snapshot_period = snapshot_period
 
         self._event_handler = FileSystemEventHandler()
         self._event_handler.on_created = self._on_file_created
@@ -153,25 +472,41 @@ class SynchronisedFilesDataSource(FilesDataSource, Listenable[FileSystemChange])
 
         return FilesDataSource._extract_data_from_origin_map(self._origin_mapped_data)
 
-    def start(self):
+    def start(self, block: bool=True):
         """
         Monitors data kept in files in the predefined directory in a new thread.
 
+        If not blocking, the data files that are already in the directory are loaded in a background thread. Until they
+        have all been loaded (see `is_ready` and `wait_until_ready`), `get_all` will only return the data loaded so far.
+
         Note: Due to the underlying library, it may take a few milliseconds after this method is started for changes to
         start to being noticed.
+        :param block: whether to block until all the data files already in the directory have been loaded
         """
         with self._status_lock:
             if self._running:
                 raise RuntimeError("Already running")
             self._running = True
+            self._ready.clear()
+            self._load_progress = (0, 0)
+            origin_mapped_data = dict()    # type: Dict[str, Iterable[DataSourceType]]
+            self._origin_mapped_data = origin_mapped_data
+            self._origin_identities = dict()
+            self._stop_event = Event()
 
         # Cannot re-use Observer after stopped
         self._observer = Observer()
         self._observer.schedule(self._event_handler, self._directory_location, recursive=True)
         self._observer.start()
 
+        if self.snapshot_location is not None and self.snapshot_period is not None:
+            Thread(target=self._snapshot_periodically, args=(self._stop_event, ), daemon=True).start()
+
         # Load all in directory afterwards to ensure no undetected changes between loading all and observing
-        self._origin_mapped_data = self._load_all_in_directory()
+        if block:
+            self._load_all_into_origin_map(origin_mapped_data)
+        else:
+            Thread(target=self._load_all_into_origin_map, args=(origin_mapped_data, ), daemon=True).start()
 
     def stop(self):
         """
@@ -181,8 +516,200 @@ class SynchronisedFilesDataSource(FilesDataSource, Listenable[FileSystemChange])
             if self._running:
                 assert self._observer is not None
                 self._observer.stop()
+                self._stop_event.set()
+                with self._origins_lock:
+                    for timer in self._retry_timers.values():
+                        timer.cancel()
+                    self._retry_timers.clear()
+                if self.snapshot_location is not None:
+                    self.save_snapshot()
                 self._running = False
+                self._ready.clear()
                 self._origin_mapped_data = dict()
+                self._origin_identities = dict()
+
+    def is_ready(self) -> bool:
+        """
+        Gets whether all of the data files that were in the directory when started have been loaded.
+        :return: whether the data source is ready
+        """
+        return self._running and self._ready.is_set()
+
+    def wait_until_ready(self, timeout: float=None) -> bool:
+        """
+        Blocks until all of the data files that were in the directory when started have been loaded.
+
+        Will raise a `RuntimeError` if not started.
+        :param timeout: (optional) the maximum number of seconds to wait for
+        :return: whether the data source is ready (will only be `False` if timed out)
+        """
+        if not self._running:
+            raise RuntimeError("Not started")
+        return self._ready.wait(timeout)
+
+    def get_load_progress(self) -> Tuple[int, int]:
+        """
+        Gets the progress of loading the data files that were in the directory when started.
+        :return: tuple where the first element is the number of files loaded and the second is the total number of
+        files to load
+        """
+        return self._load_progress
+
+    def _load_all_into_origin_map(self, origin_mapped_data: Dict[str, Iterable[DataSourceType]]):
+        """
+        Loads all of the data from the files in the directory location into the given origin map, updating the load
+        progress as it goes.
+
+        Gives up if the given origin map stops being the one in use (i.e. the data source has been stopped).
+        :param origin_mapped_data: the origin map to load the data into
+        """
+        origin_identities = self._origin_identities
+        snapshot = self._load_snapshot() if self.snapshot_location is not None else dict()
+
+        file_paths = self._get_data_file_paths()
+        number_of_files = len(file_paths)
+        number_loaded = 0
+        progress_lock = Lock()
+
+        def load(file_path: str):
+            nonlocal number_loaded
+            if origin_mapped_data is not self._origin_mapped_data:
+                return
+            self._extract_into_origin_map(file_path, origin_mapped_data, origin_identities, snapshot)
+            with progress_lock:
+                number_loaded += 1
+                self._load_progress = (number_loaded, number_of_files)
+
+        self._for_each_file(load, file_paths)
+
+        with self._status_lock:
+            if origin_mapped_data is self._origin_mapped_data:
+                self._load_progress = (number_of_files, number_of_files)
+                self._ready.set()
+
+    def save_snapshot(self):
+        """
+        Saves a snapshot of the data that has been loaded to the snapshot location.
+
+        Will raise a `RuntimeError` if no snapshot location has been set.
+        """
+        if self.snapshot_location is None:
+            raise RuntimeError("No snapshot location set")
+
+        origin_mapped_data = self._origin_mapped_data
+        origin_identities = self._origin_identities
+        failed_origins = self.get_failed_origins()
+        snapshot = dict()   # type: Dict[str, Tuple[FileIdentity, List[DataSourceType]]]
+        for file_path, data in list(origin_mapped_data.items()):
+            file_identity = origin_identities.get(file_path)
+            if file_identity is not None and file_path not in failed_origins:
+                snapshot[file_path] = (file_identity, list(data))
+
+        snapshot_directory = os.path.dirname(os.path.abspath(self.snapshot_location))
+        temp_location = None
+        try:
+            handle, temp_location = tempfile.mkstemp(dir=snapshot_directory)
+            with os.fdopen(handle, "wb") as file:
+                pickle.dump({
+                    "version": SynchronisedFilesDataSource._SNAPSHOT_VERSION,
+                    "directory_location": self._directory_location,
+                    "origins": snapshot
+                }, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_location, self.snapshot_location)
+        except Exception as e:
+            logging.warning("Could not save snapshot to %s: %s" % (self.snapshot_location, e))
+            if temp_location is not None and os.path.exists(temp_location):
+                os.remove(temp_location)
+
+    def _load_snapshot(self) -> Dict[str, Tuple[FileIdentity, List[DataSourceType]]]:
+        """
+        Loads the snapshot of the data from the snapshot location.
+        :return: map where the key is the origin of the data and the value is a tuple where the first element is the
+        identity of the origin when the snapshot was taken and the second element is the data. Empty if there is no
+        (usable) snapshot
+        """
+        try:
+            with open(self.snapshot_location, "rb") as file:
+                snapshot = pickle.load(file)
+        except FileNotFoundError:
+            return dict()
+        except Exception as e:
+            logging.warning("Could not load snapshot from %s: %s" % (self.snapshot_location, e))
+            return dict()
+
+        if snapshot.get("version") != SynchronisedFilesDataSource._SNAPSHOT_VERSION \
+                or snapshot.get("directory_location") != self._directory_location:
+            logging.info("Ignoring incompatible snapshot: %s" % self.snapshot_location)
+            return dict()
+        return snapshot["origins"]
+
+    def _snapshot_periodically(self, stop_event: Event):
+        """
+        Saves snapshots every snapshot period until the given event is set.
+        :param stop_event: event set when snapshots should stop being taken
+        """
+        while not stop_event.wait(self.snapshot_period):
+            self.save_snapshot()
+
+    def _extract_into_origin_map(
+            self, file_path: str, origin_mapped_data: Dict[str, Iterable[DataSourceType]],
+            origin_identities: Dict[str, Optional[FileIdentity]],
+            snapshot: Dict[str, Tuple[FileIdentity, List[DataSourceType]]]=None) -> bool:
+        """
+        Extracts data from the file at the given path into the given origin map.
+
+        The extracted data is not put into the origin map if the file has been reloaded or removed (by another thread)
+        since extraction started, as the data it holds is then newer than that extracted.
+        :param file_path: the path of the file to extract data from
+        :param origin_mapped_data: the origin map to put the extracted data into
+        :param origin_identities: map of the identities of the origins, updated with the identity of the file
+        :param snapshot: (optional) snapshot of the data, used instead of extracting if the file is unchanged since
+        :return: whether the data was put into the origin map
+        """
+        # Getting identity before extracting so that changes during the extraction are not missed
+        with self._origins_lock:
+            file_identity = get_file_identity(file_path)
+            origin_identities[file_path] = file_identity
+
+        snapshotted = snapshot.get(file_path) if snapshot is not None else None
+        if snapshotted is not None and snapshotted[0] == file_identity:
+            data = snapshotted[1]
+        else:
+            data = self.no_error_extract_data_from_file(file_path)
+
+        with self._origins_lock:
+            if file_path not in origin_identities or origin_identities[file_path] is not file_identity:
+                logging.debug("Not keeping data extracted from file that has since changed: %s" % file_path)
+                return False
+            origin_mapped_data[file_path] = data
+        return True
+
+    def _on_extraction_backed_off(self, file_path: str, retry_after: float):
+        """
+        Schedules the re-extraction of data from the file at the given path for when the backoff has ended, as the file
+        may not change again.
+        :param file_path: see `FilesDataSource._on_extraction_backed_off`
+        :param retry_after: see `FilesDataSource._on_extraction_backed_off`
+        """
+        origin_mapped_data = self._origin_mapped_data
+        origin_identities = self._origin_identities
+
+        def retry():
+            with self._origins_lock:
+                if self._retry_timers.get(file_path) is timer:
+                    del self._retry_timers[file_path]
+                if origin_mapped_data is not self._origin_mapped_data or file_path not in origin_identities:
+                    return
+            if self._extract_into_origin_map(file_path, origin_mapped_data, origin_identities):
+                self.notify_listeners(FileSystemChange.MODIFY)
+
+        with self._origins_lock:
+            if file_path in self._retry_timers:
+                return
+            timer = Timer(max(retry_after - monotonic(), 0.0), retry)
+            timer.daemon = True
+            self._retry_timers[file_path] = timer
+        timer.start()
 
     def _on_file_created(self, event: FileSystemEvent):
         """
@@ -190,8 +717,7 @@ class SynchronisedFilesDataSource(FilesDataSource, Listenable[FileSystemChange])
         :param event: the file system event
         """
         if not event.is_directory and self.is_data_file(event.src_path):
-            assert event.src_path not in self._origin_mapped_data
-            self._origin_mapped_data[event.src_path] = self.no_error_extract_data_from_file(event.src_path)
+            self._extract_into_origin_map(event.src_path, self._origin_mapped_data, self._origin_identities)
             self.notify_listeners(FileSystemChange.CREATE)
 
     def _on_file_modified(self, event: FileSystemEvent):
@@ -200,8 +726,8 @@ class SynchronisedFilesDataSource(FilesDataSource, Listenable[FileSystemChange])
         :param event: the file system event
         """
         if not event.is_directory and self.is_data_file(event.src_path):
-            assert event.src_path in self._origin_mapped_data
-            self._origin_mapped_data[event.src_path] = self.no_error_extract_data_from_file(event.src_path)
+            # Files may be modified before they have been loaded if loading in the background
+            self._extract_into_origin_map(event.src_path, self._origin_mapped_data, self._origin_identities)
             self.notify_listeners(FileSystemChange.MODIFY)
 
     def _on_file_deleted(self, event: FileSystemEvent):
@@ -210,8 +736,10 @@ class SynchronisedFilesDataSource(FilesDataSource, Listenable[FileSystemChange])
         :param event: the file system event
         """
         if not event.is_directory and self.is_data_file(event.src_path):
-            assert event.src_path in self._origin_mapped_data
-            del(self._origin_mapped_data[event.src_path])
+            with self._origins_lock:
+                self._origin_mapped_data.pop(event.src_path, None)
+                self._origin_identities.pop(event.src_path, None)
+            self._forget_failure(event.src_path)
             self.notify_listeners(FileSystemChange.DELETE)
 
     def _on_file_moved(self, event: FileSystemMovedEvent):
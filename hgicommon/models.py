@@ -22,28 +22,136 @@ General Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import copyreg
+import json
+import marshal
+import struct
+import sys
 from abc import ABCMeta
+from collections import OrderedDict
+from collections.abc import Mapping as AbstractMapping
 from enum import Enum, unique
-from typing import Generic, TypeVar, Set
+from inspect import Parameter, signature
+from operator import attrgetter
+from threading import Lock
+from typing import Generic, TypeVar, Set, Sequence, Dict, Any, Iterable, Callable, Tuple, List, Type
 
 from hgicommon.enums import ComparisonOperator
 
 
+# Name of the instance attribute in which the hash of models that cache their hash is stored
+_HASH_CACHE_ATTRIBUTE = "_Model__hash"
+
+# Name of the class attribute holding the names of all the fields of a `SlottedModel` type
+_FIELDS_ATTRIBUTE = "_SlottedModel__fields"
+
+_MISSING = object()
+
+# Types of values that are not collections, which `InterningCache` keys can hold as they are
+_SCALAR_TYPES = frozenset((type(None), bool, int, float, complex, str, bytes))
+
+_EQ_TEMPLATE = """
+def __eq__(self, other):
+    if self.__class__ is not model_type:
+        return Model.__eq__(self, other)
+    if other is self:
+        return True
+    if not isinstance(other, model_type):
+        return False
+    self_dict = self.__dict__
+    other_dict = other.__dict__
+    if {self_length} != {number_of_properties} or {other_length} != {number_of_properties}:
+        return _generic_eq(self, other)
+    try:
+        return ({self_values}) == ({other_values})
+    except KeyError:
+        return _generic_eq(self, other)
+"""
+
+_HASH_TEMPLATE = """
+def __hash__(self):
+    if self.__class__ is not model_type:
+        return Model.__hash__(self)
+    self_dict = self.__dict__
+    {get_cached_hash}
+    if {self_length} != {number_of_properties}:
+        return _generic_hash(self)
+    try:
+        values = ({self_values})
+    except KeyError:
+        return _generic_hash(self)
+    try:
+        model_hash = hash(values)
+    except TypeError:
+        model_hash = hash(_get_hashable(values))
+    {cache_hash}
+    return model_hash
+"""
+
+_SLOTTED_EQ_TEMPLATE = """
+def __eq__(self, other):
+    if self.__class__ is not model_type:
+        return Model.__eq__(self, other)
+    if other is self:
+        return True
+    if not isinstance(other, model_type):
+        return False
+    try:
+        return ({self_values}) == ({other_values})
+    except AttributeError:
+        return _generic_eq(self, other)
+"""
+
+_SLOTTED_HASH_TEMPLATE = """
+def __hash__(self):
+    if self.__class__ is not model_type:
+        return Model.__hash__(self)
+    {get_cached_hash}
+    try:
+        values = ({self_values})
+    except AttributeError:
+        return _generic_hash(self)
+    try:
+        model_hash = hash(values)
+    except TypeError:
+        model_hash = hash(_get_hashable(values))
+    {cache_hash}
+    return model_hash
+"""
+
+_GET_CACHED_HASH_SOURCE = """model_hash = self_dict.get("%s")
+    if model_hash is not None:
+        return model_hash""" % _HASH_CACHE_ATTRIBUTE
+
+_CACHE_HASH_SOURCE = """self_dict["%s"] = model_hash""" % _HASH_CACHE_ATTRIBUTE
+
+_GET_CACHED_SLOTTED_HASH_SOURCE = """model_hash = getattr(self, "%s", None)
+    if model_hash is not None:
+        return model_hash""" % _HASH_CACHE_ATTRIBUTE
+
+_CACHE_SLOTTED_HASH_SOURCE = """object.__setattr__(self, "%s", model_hash)""" % _HASH_CACHE_ATTRIBUTE
+
+
 class Model(metaclass=ABCMeta):
     """
     Superclass that POPOs (Plain Old Python Objects) can implement.
+
+    Equality and hashing methods that compare the tuple of a model's properties are generated for each subclass the
+    first time they are used, where the properties are those of the instance they are first used with. Instances with
+    other properties are compared property by property.
+
+    Subclasses of immutable models can set `_cache_hash` to `True` to compute their hash only once. The cached hash is
+    discarded if a property is then set.
     """
+    __slots__ = ()
+    _cache_hash = False
+
     def __eq__(self, other):
-        if not isinstance(other, self.__class__):
-            return False
-        for property_name, value in vars(self).items():
-            if other.__dict__[property_name] != self.__dict__[property_name]:
-                return False
-        return True
+        return _get_generated_method(type(self), "__eq__", self)(self, other)
 
     def __str__(self) -> str:
         string_builder = []
-        for property, value in vars(self).items():
+        for property, value in _get_properties(self).items():
             if isinstance(value, Set):
                 value = str(sorted(value, key=id))
             string_builder.append("%s: %s" % (property, value))
@@ -54,7 +162,310 @@ class Model(metaclass=ABCMeta):
         return "<%s object at %s: %s>" % (type(self), id(self), str(self))
 
     def __hash__(self):
-        return hash(str(self))
+        model_type = type(self)
+        if model_type._cache_hash and model_type.__setattr__ is object.__setattr__:
+            model_type.__setattr__ = _set_attribute_and_discard_cached_hash
+            model_type.__delattr__ = _delete_attribute_and_discard_cached_hash
+        return _get_generated_method(model_type, "__hash__", self)(self)
+
+    def __getstate__(self):
+        # The cached hash is left out as hashes of strings differ between processes
+        state = getattr(self, "__dict__", None)
+        if state is not None and _HASH_CACHE_ATTRIBUTE in state:
+            state = dict(state)
+            del state[_HASH_CACHE_ATTRIBUTE]
+        slots_state = {}
+        for name in copyreg._slotnames(type(self)):
+            value = getattr(self, name, _MISSING)
+            if name != _HASH_CACHE_ATTRIBUTE and value is not _MISSING:
+                slots_state[name] = value
+        if len(slots_state) == 0:
+            return state
+        return state or None, slots_state
+
+
+def _get_properties(model: Model) -> Dict[str, Any]:
+    """
+    Gets the properties of the given model.
+    :param model: the model
+    :return: the model's properties, by name
+    """
+    fields = getattr(type(model), _FIELDS_ATTRIBUTE, None)
+    if fields is not None:
+        properties = {}
+        for name in fields:
+            value = getattr(model, name, _MISSING)
+            if value is not _MISSING:
+                properties[name] = value
+        properties.update(getattr(model, "__dict__", {}))
+        return properties
+    properties = vars(model)
+    if _HASH_CACHE_ATTRIBUTE in properties:
+        properties = dict(properties)
+        del properties[_HASH_CACHE_ATTRIBUTE]
+    return properties
+
+
+def _generic_eq(model: Model, other: Any) -> bool:
+    """
+    Gets whether the given model equals the other object, comparing the model's properties one by one.
+    :param model: the model
+    :param other: the other object
+    :return: whether they are equal
+    """
+    if not isinstance(other, model.__class__):
+        return False
+    other_properties = _get_properties(other)
+    for property_name, value in _get_properties(model).items():
+        if property_name not in other_properties or other_properties[property_name] != value:
+            return False
+    return True
+
+
+def _generic_hash(model: Model) -> int:
+    """
+    Gets the hash of the given model from its properties, whichever they are.
+    :param model: the model
+    :return: the hash
+    """
+    return hash(frozenset((name, _get_hashable(value)) for name, value in _get_properties(model).items()))
+
+
+def _get_hashable(value: Any) -> Any:
+    """
+    Gets a hashable equivalent of the given value, where unhashable collections are converted to immutable ones and
+    other unhashable values are converted to their string representations.
+    :param value: the value
+    :return: the hashable equivalent
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_get_hashable(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_get_hashable(item) for item in value)
+    if isinstance(value, AbstractMapping):
+        return frozenset((key, _get_hashable(item)) for key, item in value.items())
+    if type(value).__hash__ is None:
+        return str(value)
+    return value
+
+
+def _get_typed_key(value: Any) -> Any:
+    """
+    Gets a key of the given value that includes the type of the value (and of the values in it if it is a collection),
+    such that values that are equal but of different types (e.g. `1`, `1.0` and `True`) have different keys.
+    Unhashable collections are converted to immutable ones.
+    :param value: the value
+    :return: the key
+    """
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(_get_typed_key(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return type(value), frozenset(_get_typed_key(item) for item in value)
+    if isinstance(value, dict):
+        return type(value), frozenset((_get_typed_key(key), _get_typed_key(item)) for key, item in value.items())
+    return type(value), value
+
+
+def _get_typed_values_key(values: tuple) -> Any:
+    """
+    Gets a key of the given values, as `_get_typed_key` does, that is quicker to get if all the values are scalars.
+    :param values: the values
+    :return: the key
+    """
+    types = tuple(map(type, values))
+    if _SCALAR_TYPES.issuperset(types):
+        # Cannot be equal to a key got from `_get_typed_key`, which starts with `tuple`
+        return types, values
+    return _get_typed_key(values)
+
+
+def _get_source_values(variable_name: str, property_names: Iterable[str]) -> str:
+    """
+    Gets the source code of a tuple of the given properties, got from the dictionary with the given variable name.
+    :param variable_name: the name of the properties dictionary variable
+    :param property_names: the names of the properties
+    :return: the source code
+    """
+    return "".join("%s[%r], " % (variable_name, property_name) for property_name in property_names)
+
+
+def _get_source_attributes(variable_name: str, property_names: Iterable[str]) -> str:
+    """
+    Gets the source code of a tuple of the given attributes of the object with the given variable name.
+    :param variable_name: the name of the object variable
+    :param property_names: the names of the attributes
+    :return: the source code
+    """
+    return "".join("%s.%s, " % (variable_name, property_name) for property_name in property_names)
+
+
+def _get_source_length(variable_name: str, cache_hash: bool) -> str:
+    """
+    Gets the source code of the number of properties in the dictionary with the given variable name.
+    :param variable_name: the name of the properties dictionary variable
+    :param cache_hash: whether the dictionary can hold a cached hash
+    :return: the source code
+    """
+    if cache_hash:
+        return "(len(%s) - (%r in %s))" % (variable_name, _HASH_CACHE_ATTRIBUTE, variable_name)
+    return "len(%s)" % variable_name
+
+
+def _compile_method(model_type: type, name: str, source: str) -> Callable:
+    """
+    Compiles the method with the given name from the given source code.
+    :param model_type: the type of model the method is for
+    :param name: the name of the method
+    :param source: the source code
+    :return: the compiled method
+    """
+    namespace = {
+        "Model": Model,
+        "model_type": model_type,
+        "_generic_eq": _generic_eq,
+        "_generic_hash": _generic_hash,
+        "_get_hashable": _get_hashable
+    }
+    exec(source, namespace)
+    method = namespace[name]
+    method.__qualname__ = "%s.%s" % (model_type.__qualname__, name)
+    method._is_generated = True
+    return method
+
+
+def _create_eq(model_type: type, model: Model) -> Callable[[Model, Any], bool]:
+    """
+    Creates an equality method for the given type of model, which compares the properties of the given model.
+    :param model_type: the type of model
+    :param model: model with the properties to compare
+    :return: the equality method
+    """
+    fields = getattr(model_type, _FIELDS_ATTRIBUTE, None)
+    if fields is not None:
+        return _compile_method(model_type, "__eq__", _SLOTTED_EQ_TEMPLATE.format(
+            self_values=_get_source_attributes("self", fields),
+            other_values=_get_source_attributes("other", fields)))
+    property_names = sorted(_get_properties(model).keys())
+    return _compile_method(model_type, "__eq__", _EQ_TEMPLATE.format(
+        self_length=_get_source_length("self_dict", model_type._cache_hash),
+        other_length=_get_source_length("other_dict", model_type._cache_hash),
+        number_of_properties=len(property_names),
+        self_values=_get_source_values("self_dict", property_names),
+        other_values=_get_source_values("other_dict", property_names)))
+
+
+def _create_hash(model_type: type, model: Model) -> Callable[[Model], int]:
+    """
+    Creates a hash method for the given type of model, which hashes the properties of the given model.
+    :param model_type: the type of model
+    :param model: model with the properties to hash
+    :return: the hash method
+    """
+    fields = getattr(model_type, _FIELDS_ATTRIBUTE, None)
+    if fields is not None:
+        return _compile_method(model_type, "__hash__", _SLOTTED_HASH_TEMPLATE.format(
+            self_values=_get_source_attributes("self", fields),
+            get_cached_hash=_GET_CACHED_SLOTTED_HASH_SOURCE if model_type._cache_hash else "",
+            cache_hash=_CACHE_SLOTTED_HASH_SOURCE if model_type._cache_hash else ""))
+    property_names = sorted(_get_properties(model).keys())
+    return _compile_method(model_type, "__hash__", _HASH_TEMPLATE.format(
+        self_length=_get_source_length("self_dict", model_type._cache_hash),
+        number_of_properties=len(property_names),
+        self_values=_get_source_values("self_dict", property_names),
+        get_cached_hash=_GET_CACHED_HASH_SOURCE if model_type._cache_hash else "",
+        cache_hash=_CACHE_HASH_SOURCE if model_type._cache_hash else ""))
+
+
+def _get_generated_method(model_type: type, name: str, model: Model) -> Callable:
+    """
+    Gets the generated method with the given name for the given type of model, generating it if this is the first time
+    it is needed. The generated method is set on the type, unless the type uses its own implementation.
+    :param model_type: the type of model
+    :param name: the name of the method (`__eq__` or `__hash__`)
+    :param model: model of the type, with the properties that the method is to use
+    :return: the generated method
+    """
+    generated_method_attribute = "_Model__generated%s" % name
+    method = model_type.__dict__.get(generated_method_attribute)
+    if method is None:
+        method = _create_eq(model_type, model) if name == "__eq__" else _create_hash(model_type, model)
+        setattr(model_type, generated_method_attribute, method)
+    current_method = getattr(model_type, name)
+    if current_method is getattr(Model, name) or getattr(current_method, "_is_generated", False):
+        setattr(model_type, name, method)
+    return method
+
+
+def _set_attribute_and_discard_cached_hash(model: Model, name: str, value: Any):
+    """
+    Sets an attribute of a model that caches its hash, discarding the cached hash.
+    :param model: the model
+    :param name: the name of the attribute
+    :param value: the value of the attribute
+    """
+    _discard_cached_hash(model)
+    object.__setattr__(model, name, value)
+
+
+def _delete_attribute_and_discard_cached_hash(model: Model, name: str):
+    """
+    Deletes an attribute of a model that caches its hash, discarding the cached hash.
+    :param model: the model
+    :param name: the name of the attribute
+    """
+    _discard_cached_hash(model)
+    object.__delattr__(model, name)
+
+
+def _discard_cached_hash(model: Model):
+    """
+    Discards the hash cached by the given model, if it has one.
+    :param model: the model
+    """
+    try:
+        object.__delattr__(model, _HASH_CACHE_ATTRIBUTE)
+    except AttributeError:
+        pass
+
+
+class _SlottedModelMeta(ABCMeta):
+    """
+    Metaclass of `SlottedModel`, which derives the `__slots__` of each class from its declared fields.
+    """
+    def __new__(mcs, name: str, bases: tuple, namespace: Dict[str, Any], **kwargs):
+        if "__slots__" in namespace:
+            fields = namespace["__slots__"]
+            fields = (fields, ) if isinstance(fields, str) else tuple(fields)
+        elif "_fields" in namespace:
+            fields = tuple(namespace["_fields"])
+        else:
+            fields = tuple(field for field in namespace.get("__annotations__", {}) if field not in namespace)
+        inherited_fields = []
+        for base in reversed(bases):
+            for field in getattr(base, _FIELDS_ATTRIBUTE, ()):
+                if field not in inherited_fields:
+                    inherited_fields.append(field)
+        slots = tuple(field for field in fields if field not in inherited_fields)
+
+        cache_hash = namespace.get("_cache_hash", any(getattr(base, "_cache_hash", False) for base in bases))
+        if cache_hash and not any(hasattr(base, _HASH_CACHE_ATTRIBUTE) for base in bases):
+            slots += (_HASH_CACHE_ATTRIBUTE, )
+
+        namespace = dict(namespace)
+        namespace["__slots__"] = slots
+        namespace[_FIELDS_ATTRIBUTE] = tuple(inherited_fields) + tuple(
+            field for field in fields if field not in inherited_fields)
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class SlottedModel(Model, metaclass=_SlottedModelMeta):
+    """
+    Memory-compact `Model` whose instances store their properties in slots rather than in a `__dict__`.
+
+    The properties of a subclass are declared with a `_fields` sequence of names or, in Python 3.6+, with annotations
+    of class variables without values. A subclass can instead declare `__slots__` itself. Properties that are not
+    declared cannot be set on instances.
+    """
 
 
 class SearchCriterion(Model):
@@ -67,6 +478,25 @@ class SearchCriterion(Model):
         self.comparison_operator = comparison_operator
 
 
+class MetadataPatch(Model):
+    """
+    Model of the differences between two sets of metadata.
+    """
+    def __init__(self, added: Dict[Any, Any]=None, changed: Dict[Any, Any]=None, removed: Iterable[Any]=()):
+        """
+        Constructor.
+        :param added: items that have been added
+        :param changed: items that have changed, mapped to their new values
+        :param removed: the keys of items that have been removed
+        """
+        self.added = added if added is not None else {}   # type: Dict[Any, Any]
+        self.changed = changed if changed is not None else {}     # type: Dict[Any, Any]
+        self.removed = set(removed)     # type: Set[Any]
+
+
+# The type of model
+_ModelType = TypeVar("ModelType", bound=Model)
+
 # The type of the object that is registered
 _RegistrationTarget = TypeVar("RegistrationTarget")
 
@@ -91,3 +521,428 @@ class RegistrationEvent(Generic[_RegistrationTarget], Model):
         """
         self.target = target
         self.event_type = event_type
+
+
+class RegistrationBatchEvent(Generic[_RegistrationTarget], Model):
+    """
+    A model of a registration update of a batch of objects.
+    """
+    def __init__(self, targets: Sequence[_RegistrationTarget], event_type: RegistrationEvent.Type):
+        """
+        Constructor.
+        :param targets: the objects the event refers to
+        :param event_type: the type of update event
+        """
+        self.targets = targets
+        self.event_type = event_type
+
+
+# Header of serialised binary models: magic, format version and number of models
+_BINARY_HEADER = struct.Struct("!4sBI")
+_BINARY_MAGIC = b"HGIM"
+_BINARY_FORMAT_VERSION = 1
+
+_ENCODE_TEMPLATE = """
+def encode(model):
+    return ({values})
+"""
+
+_TO_DICT_TEMPLATE = """
+def to_dict(model):
+    return {{{items}}}
+"""
+
+_DECODE_TEMPLATE = """
+def {name}({argument}):
+    model = _new(model_type)
+    {set_values}
+    return model
+"""
+
+_serialisers = {}    # type: Dict[Tuple[type, Tuple[str, ...]], ModelSerialiser]
+_serialisers_lock = Lock()
+
+
+class ModelSerialiser(Generic[_ModelType]):
+    """
+    Serialiser of models of a given type to dictionaries, JSON and a compact binary format.
+
+    The functions that encode and decode models are compiled for the model's fields when the serialiser is created.
+    Enum fields, identified from the type annotations of the model's constructor or fields, are encoded by name. Values
+    of other fields are encoded as they are, so must be JSON serialisable or marshallable for those formats.
+
+    The binary format uses `marshal` so is only suitable for exchanging data between the same version of Python.
+    """
+    def __init__(self, model_type: Type[_ModelType], fields: Sequence[str]=None):
+        """
+        Constructor.
+        :param model_type: the type of model to serialise
+        :param fields: the names of the fields of the model to serialise. Defaults to the fields of a `SlottedModel`
+        type or otherwise the names of the parameters of the model type's constructor
+        """
+        self.model_type = model_type
+        self.fields = tuple(fields) if fields is not None else _get_fields(model_type)
+        enum_types = _get_enum_types(model_type, self.fields)
+
+        namespace = {"model_type": model_type, "_new": object.__new__}
+        values = []
+        set_row_values = []
+        set_dict_values = []
+        uses_slots = getattr(model_type, _FIELDS_ATTRIBUTE, None) is not None
+        if not uses_slots:
+            set_row_values.append("model_dict = model.__dict__")
+            set_dict_values.append("model_dict = model.__dict__")
+        for i, field in enumerate(self.fields):
+            value = "model.%s" % field
+            row_value = "row[%d]" % i
+            dict_value = "values[%r]" % field
+            if field in enum_types:
+                namespace["_enum_%d" % i] = enum_types[field]
+                value = "(None if %s is None else %s.name)" % (value, value)
+                row_value = "(None if %s is None else _enum_%d[%s])" % (row_value, i, row_value)
+                dict_value = "(None if %s is None else _enum_%d[%s])" % (dict_value, i, dict_value)
+            values.append(value)
+            if uses_slots:
+                namespace["_set_%d" % i] = getattr(model_type, field).__set__
+                set_row_values.append("_set_%d(model, %s)" % (i, row_value))
+                set_dict_values.append("_set_%d(model, %s)" % (i, dict_value))
+            else:
+                set_row_values.append("model_dict[%r] = %s" % (field, row_value))
+                set_dict_values.append("model_dict[%r] = %s" % (field, dict_value))
+
+        self.encode = _compile_function(namespace, "encode", _ENCODE_TEMPLATE.format(
+            values="".join("%s, " % value for value in values)))    # type: Callable[[_ModelType], tuple]
+        self.to_dict = _compile_function(namespace, "to_dict", _TO_DICT_TEMPLATE.format(
+            items=", ".join("%r: %s" % (field, value) for field, value in zip(self.fields, values))))
+        self.decode = _compile_function(namespace, "decode", _DECODE_TEMPLATE.format(
+            name="decode", argument="row", set_values="\n    ".join(set_row_values)))
+        self.from_dict = _compile_function(namespace, "from_dict", _DECODE_TEMPLATE.format(
+            name="from_dict", argument="values", set_values="\n    ".join(set_dict_values)))
+
+    def encode_many(self, models: Iterable[_ModelType]) -> List[tuple]:
+        """
+        Encodes the given models to rows of their field values, in the order of `fields`.
+        :param models: the models to encode
+        :return: the encoded models
+        """
+        return list(map(self.encode, models))
+
+    def decode_many(self, rows: Iterable[Sequence]) -> List[_ModelType]:
+        """
+        Decodes the given rows of field values, in the order of `fields`, to models.
+        :param rows: the rows to decode
+        :return: the decoded models
+        """
+        return list(map(self.decode, rows))
+
+    def to_json(self, model: _ModelType) -> str:
+        """
+        Serialises the given model to a JSON object.
+        :param model: the model to serialise
+        :return: the JSON
+        """
+        return json.dumps(self.to_dict(model))
+
+    def from_json(self, serialised: str) -> _ModelType:
+        """
+        Deserialises a model from the given JSON object.
+        :param serialised: the JSON
+        :return: the deserialised model
+        """
+        return self.from_dict(json.loads(serialised))
+
+    def to_json_many(self, models: Iterable[_ModelType]) -> str:
+        """
+        Serialises the given models to JSON, where the models are stored as rows of field values.
+        :param models: the models to serialise
+        :return: the JSON
+        """
+        return json.dumps({"fields": self.fields, "rows": self.encode_many(models)})
+
+    def from_json_many(self, serialised: str) -> List[_ModelType]:
+        """
+        Deserialises the models from the given JSON, serialised by `to_json_many`.
+        :param serialised: the JSON
+        :return: the deserialised models
+        :raises ValueError: if the models were serialised with different fields
+        """
+        deserialised = json.loads(serialised)
+        self._check_fields(deserialised["fields"])
+        return self.decode_many(deserialised["rows"])
+
+    def to_bytes(self, model: _ModelType) -> bytes:
+        """
+        Serialises the given model to the binary format.
+        :param model: the model to serialise
+        :return: the serialised model
+        """
+        return self.to_bytes_many((model, ))
+
+    def from_bytes(self, serialised: bytes) -> _ModelType:
+        """
+        Deserialises a model from the given bytes, serialised by `to_bytes`.
+        :param serialised: the serialised model
+        :return: the deserialised model
+        :raises ValueError: if the bytes do not hold exactly one model serialised with the same fields
+        """
+        models = self.from_bytes_many(serialised)
+        if len(models) != 1:
+            raise ValueError("Expected one serialised model but got %d" % len(models))
+        return models[0]
+
+    def to_bytes_many(self, models: Iterable[_ModelType]) -> bytes:
+        """
+        Serialises the given models to the binary format.
+        :param models: the models to serialise
+        :return: the serialised models
+        """
+        rows = self.encode_many(models)
+        return _BINARY_HEADER.pack(_BINARY_MAGIC, _BINARY_FORMAT_VERSION, len(rows)) \
+               + marshal.dumps((self.fields, rows))
+
+    def from_bytes_many(self, serialised: bytes) -> List[_ModelType]:
+        """
+        Deserialises the models from the given bytes, serialised by `to_bytes_many`.
+        :param serialised: the serialised models
+        :return: the deserialised models
+        :raises ValueError: if the bytes are not in the binary format or the models were serialised with different
+        fields
+        """
+        try:
+            magic, format_version, number_of_models = _BINARY_HEADER.unpack_from(serialised)
+        except struct.error as e:
+            raise ValueError("Serialised models are too short to have a header") from e
+        if magic != _BINARY_MAGIC or format_version != _BINARY_FORMAT_VERSION:
+            raise ValueError("Serialised models are not in binary format version %d" % _BINARY_FORMAT_VERSION)
+        fields, rows = marshal.loads(memoryview(serialised)[_BINARY_HEADER.size:])
+        self._check_fields(fields)
+        if len(rows) != number_of_models:
+            raise ValueError("Expected %d serialised models but got %d" % (number_of_models, len(rows)))
+        return self.decode_many(rows)
+
+    def _check_fields(self, fields: Sequence[str]):
+        """
+        Checks that the given fields, which models were serialised with, are the fields of this serialiser.
+        :param fields: the fields that models were serialised with
+        :raises ValueError: if the fields differ
+        """
+        if tuple(fields) != self.fields:
+            raise ValueError("Models were serialised with fields %s, not %s" % (list(fields), list(self.fields)))
+
+
+def get_serialiser(model_type: Type[_ModelType], fields: Sequence[str]=None) -> ModelSerialiser[_ModelType]:
+    """
+    Gets the serialiser for the given type of model, which is created the first time it is needed.
+    :param model_type: the type of model
+    :param fields: the names of the fields of the model to serialise (see `ModelSerialiser`)
+    :return: the serialiser
+    """
+    key = (model_type, tuple(fields) if fields is not None else None)
+    serialiser = _serialisers.get(key)
+    if serialiser is None:
+        with _serialisers_lock:
+            serialiser = _serialisers.get(key)
+            if serialiser is None:
+                serialiser = ModelSerialiser(model_type, fields)
+                _serialisers[key] = serialiser
+    return serialiser
+
+
+class InterningCache(Generic[_ModelType]):
+    """
+    Bounded cache of instances of an immutable, value-like type of model, such that models with the same fields are
+    the same instance. The least recently used instances are removed when the maximum size is exceeded.
+
+    Models that are interned must not then be changed. Equality checks between interned models are quick as equal
+    models are identical. Models with field values that cannot be hashed are not cached (see `bypasses`).
+    """
+    def __init__(self, model_type: Type[_ModelType], max_size: int=1024, fields: Sequence[str]=None):
+        """
+        Constructor.
+        :param model_type: the type of model to intern
+        :param max_size: the maximum number of instances to keep
+        :param fields: the names of the fields that identify the model (see `ModelSerialiser`)
+        """
+        if max_size < 1:
+            raise ValueError("Maximum size must be at least one")
+        self.model_type = model_type
+        self.max_size = max_size
+        self.fields = tuple(fields) if fields is not None else _get_fields(model_type)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypasses = 0
+        self._get_values = _create_values_getter(self.fields)
+        self._model_size = None     # type: int
+        self._models = OrderedDict()    # type: OrderedDict
+        self._keys_by_arguments = OrderedDict()     # type: OrderedDict
+        self._lock = Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        The proportion of models got from the cache that were already in it.
+        :return: the hit rate, which is 0 if no models have been got
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    @property
+    def estimated_bytes_saved(self) -> int:
+        """
+        Estimate of the memory saved by returning cached models, based on the shallow size of a model.
+        :return: the estimated number of bytes saved
+        """
+        return self.hits * (self._model_size or 0)
+
+    def create(self, *args, **kwargs) -> _ModelType:
+        """
+        Gets the model created with the given constructor arguments, only creating it if an equal model created with
+        the same arguments is not in the cache.
+        :param args: positional constructor arguments
+        :param kwargs: keyword constructor arguments
+        :return: the model
+        """
+        arguments_key = (_get_typed_values_key(args), _get_typed_key(kwargs) if kwargs else ())
+        try:
+            with self._lock:
+                key = self._keys_by_arguments.get(arguments_key)
+                model = self._models.get(key) if key is not None else None
+                if model is not None:
+                    self._models.move_to_end(key)
+                    self._keys_by_arguments.move_to_end(arguments_key)
+                    self.hits += 1
+                    return model
+        except TypeError:
+            # Unhashable arguments
+            return self.intern(self.model_type(*args, **kwargs))
+        model, key = self._intern(self.model_type(*args, **kwargs))
+        if key is None:
+            return model
+        with self._lock:
+            self._keys_by_arguments[arguments_key] = key
+            self._keys_by_arguments.move_to_end(arguments_key)
+            if len(self._keys_by_arguments) > self.max_size:
+                self._keys_by_arguments.popitem(last=False)
+        return model
+
+    def intern(self, model: _ModelType) -> _ModelType:
+        """
+        Gets the cached model equal to the given model, caching the given model if there is no such model.
+        :param model: the model
+        :return: the cached model
+        """
+        return self._intern(model)[0]
+
+    def clear(self):
+        """
+        Removes all the models from the cache. Statistics are not reset.
+        """
+        with self._lock:
+            self._models.clear()
+            self._keys_by_arguments.clear()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, model: Any) -> bool:
+        if not isinstance(model, self.model_type):
+            return False
+        try:
+            return self._models.get(self._get_key(model)) is model
+        except (AttributeError, TypeError):
+            return False
+
+    def _intern(self, model: _ModelType) -> Tuple[_ModelType, Any]:
+        """
+        Gets the cached model equal to the given model, caching the given model if there is no such model.
+        :param model: the model
+        :return: tuple where the first element is the cached model and the second is its key, which is `None` if the
+        model could not be cached as its field values cannot be hashed
+        """
+        key = self._get_key(model)
+        with self._lock:
+            try:
+                cached_model = self._models.get(key)
+            except TypeError:
+                self.bypasses += 1
+                return model, None
+            if cached_model is not None and cached_model == model:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return cached_model, key
+            self.misses += 1
+            if self._model_size is None:
+                self._model_size = sys.getsizeof(model) + sys.getsizeof(getattr(model, "__dict__", {}))
+            self._models[key] = model
+            self._models.move_to_end(key)
+            if len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+                self.evictions += 1
+        return model, key
+
+    def _get_key(self, model: _ModelType) -> Any:
+        """
+        Gets the key of the given model in the cache, from the values of its fields.
+        :param model: the model
+        :return: the key
+        """
+        return _get_typed_values_key(self._get_values(model))
+
+
+def _create_values_getter(fields: Sequence[str]) -> Callable[[Model], tuple]:
+    """
+    Creates a function that gets the tuple of the values of the given fields of a model.
+    :param fields: the names of the fields
+    :return: the function
+    """
+    if len(fields) == 0:
+        return lambda model: ()
+    if len(fields) == 1:
+        get_value = attrgetter(fields[0])
+        return lambda model: (get_value(model), )
+    return attrgetter(*fields)
+
+
+def _get_fields(model_type: type) -> Tuple[str, ...]:
+    """
+    Gets the names of the fields of the given type of model: the declared fields of a `SlottedModel` type, otherwise
+    the names of the parameters of the type's constructor.
+    :param model_type: the type of model
+    :return: the names of the fields
+    """
+    fields = getattr(model_type, _FIELDS_ATTRIBUTE, None)
+    if fields is not None:
+        return fields
+    parameters = list(signature(model_type.__init__).parameters.values())[1:]
+    return tuple(parameter.name for parameter in parameters
+                 if parameter.kind in (Parameter.POSITIONAL_OR_KEYWORD, Parameter.KEYWORD_ONLY))
+
+
+def _get_enum_types(model_type: type, fields: Iterable[str]) -> Dict[str, Type[Enum]]:
+    """
+    Gets the enum types of the given fields of the given type of model, according to the annotations of the type's
+    constructor or fields.
+    :param model_type: the type of model
+    :param fields: the names of the fields
+    :return: the enum types of the fields that are enums, by field name
+    """
+    annotations = {}
+    for cls in reversed(model_type.__mro__):
+        annotations.update(cls.__dict__.get("__annotations__", {}))
+    annotations.update(getattr(model_type.__init__, "__annotations__", {}))
+    return {field: annotations[field] for field in fields
+            if isinstance(annotations.get(field), type) and issubclass(annotations[field], Enum)}
+
+
+def _compile_function(namespace: Dict[str, Any], name: str, source: str) -> Callable:
+    """
+    Compiles the function with the given name from the given source code.
+    :param namespace: the global namespace of the function
+    :param name: the name of the function
+    :param source: the source code
+    :return: the compiled function
+    """
+    namespace = dict(namespace)
+    exec(source, namespace)
+    return namespace[name]
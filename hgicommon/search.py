@@ -0,0 +1,166 @@
+"""
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+from operator import attrgetter
+from typing import Any, Callable, Iterable, List, Sequence, Dict, Tuple
+
+from hgicommon.enums import ComparisonOperator
+from hgicommon.models import SearchCriterion
+
+# Source code of the comparison of a record's value (on the left) against a criterion's value (on the right)
+_COMPARISON_SOURCES = {
+    ComparisonOperator.EQUALS: "==",
+    ComparisonOperator.LESS_THAN: "<",
+    ComparisonOperator.GREATER_THAN: ">"
+}   # type: Dict[ComparisonOperator, str]
+
+# Order in which criteria are checked if their selectivity is not measured, where equality is assumed to be the most
+# selective comparison
+_COMPARISON_ORDER = {
+    ComparisonOperator.EQUALS: 0,
+    ComparisonOperator.LESS_THAN: 1,
+    ComparisonOperator.GREATER_THAN: 1
+}   # type: Dict[ComparisonOperator, int]
+
+# Errors raised when getting or comparing a record's value, which mean that the record does not match
+_NOT_MATCHED_ERRORS = (AttributeError, LookupError, TypeError)
+
+_PREDICATE_TEMPLATE = """
+def predicate(record):
+    try:
+        return {conditions}
+    except _NOT_MATCHED_ERRORS:
+        return False
+"""
+
+_FILTER_TEMPLATE = """
+def filter_records(records):
+    try:
+        return [record for record in records if {conditions}]
+    except _NOT_MATCHED_ERRORS:
+        return [record for record in records if predicate(record)]
+"""
+
+
+class CompiledSearchCriteria:
+    """
+    Predicate, compiled from search criteria, that gets whether a record matches all of the criteria.
+
+    Records that do not have an attribute of a criterion, or with values that cannot be compared against a criterion's
+    value, do not match.
+    """
+    def __init__(self, search_criteria: Sequence[SearchCriterion], predicate: Callable[[Any], bool],
+                 filter_records: Callable[[Sequence[Any]], List[Any]]):
+        """
+        Constructor.
+        :param search_criteria: the search criteria, in the order that they are checked
+        :param predicate: the compiled predicate
+        :param filter_records: the compiled function that filters a sequence of records
+        """
+        self.search_criteria = search_criteria
+        self._predicate = predicate
+        self._filter_records = filter_records
+
+    def __call__(self, record: Any) -> bool:
+        """
+        Gets whether the given record matches the search criteria.
+        :param record: the record
+        :return: whether the record matches
+        """
+        return self._predicate(record)
+
+    def filter(self, records: Iterable[Any]) -> List[Any]:
+        """
+        Filters the given records to those that match the search criteria.
+        :param records: the records
+        :return: the matching records, in the order they were given
+        """
+        if not isinstance(records, Sequence):
+            records = list(records)
+        return self._filter_records(records)
+
+
+def compile_search_criteria(search_criteria: Iterable[SearchCriterion],
+                            get_value_factory: Callable[[str], Callable[[Any], Any]]=attrgetter,
+                            sample: Iterable[Any]=None) -> CompiledSearchCriteria:
+    """
+    Compiles the given search criteria into a predicate that gets whether a record matches all of them.
+
+    Criteria are checked in order of selectivity, so that records that do not match are rejected after as few checks as
+    possible. If a sample of records is given, the criteria that match the fewest records in the sample are checked
+    first. Otherwise equality criteria are checked before others.
+    :param search_criteria: the search criteria, where the attribute of each is the attribute of a record to compare
+    :param get_value_factory: creates the function that gets the value of the given attribute of a record. Defaults to
+    getting attributes of objects (`operator.attrgetter`); use `operator.itemgetter` for mappings
+    :param sample: sample of records used to measure the selectivity of the criteria
+    :return: the compiled predicate
+    :raises ValueError: if a criterion does not have an attribute
+    """
+    search_criteria = list(OrderedDict.fromkeys(search_criteria))
+    for search_criterion in search_criteria:
+        if search_criterion.attribute is None:
+            raise ValueError("Search criterion must have an attribute: %s" % search_criterion)
+
+    get_value_functions = {}    # type: Dict[str, Callable[[Any], Any]]
+    for search_criterion in search_criteria:
+        if search_criterion.attribute not in get_value_functions:
+            get_value_functions[search_criterion.attribute] = get_value_factory(search_criterion.attribute)
+
+    if sample is not None:
+        sample = list(sample)
+        match_counts = {}   # type: Dict[SearchCriterion, int]
+        for search_criterion in search_criteria:
+            predicate = _compile([search_criterion], get_value_functions)[0]
+            match_counts[search_criterion] = sum(map(predicate, sample))
+        search_criteria.sort(key=lambda search_criterion: match_counts[search_criterion])
+    else:
+        search_criteria.sort(key=lambda search_criterion: _COMPARISON_ORDER[search_criterion.comparison_operator])
+
+    predicate, filter_records = _compile(search_criteria, get_value_functions)
+    return CompiledSearchCriteria(tuple(search_criteria), predicate, filter_records)
+
+
+def _compile(search_criteria: Sequence[SearchCriterion], get_value_functions: Dict[str, Callable[[Any], Any]]) \
+        -> Tuple[Callable[[Any], bool], Callable[[Sequence[Any]], List[Any]]]:
+    """
+    Compiles the predicate and the filter function of the given search criteria, checked in the order given.
+    :param search_criteria: the search criteria
+    :param get_value_functions: functions that get the value of a record's attribute, by attribute
+    :return: tuple where the first element is the predicate and the second is the filter function
+    """
+    namespace = {"_NOT_MATCHED_ERRORS": _NOT_MATCHED_ERRORS}
+    attribute_names = {}    # type: Dict[str, str]
+    for attribute, get_value in get_value_functions.items():
+        attribute_names[attribute] = "_get_%d" % len(attribute_names)
+        namespace[attribute_names[attribute]] = get_value
+
+    conditions = []
+    for i, search_criterion in enumerate(search_criteria):
+        namespace["_value_%d" % i] = search_criterion.value
+        conditions.append("%s(record) %s _value_%d" % (
+            attribute_names[search_criterion.attribute], _COMPARISON_SOURCES[search_criterion.comparison_operator], i))
+    conditions = " and ".join(conditions) if len(conditions) > 0 else "True"
+
+    exec(_PREDICATE_TEMPLATE.format(conditions="bool(%s)" % conditions), namespace)
+    exec(_FILTER_TEMPLATE.format(conditions=conditions), namespace)
+    return namespace["predicate"], namespace["filter_records"]
@@ -22,6 +22,7 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 from typing import Iterable
 
+from hgicommon.data_source.chunked_from_file import ChunkedFilesDataSource
 from hgicommon.data_source.common import DataSourceType
 from hgicommon.data_source.dynamic_from_file import RegisteringDataSource
 from hgicommon.data_source.static_from_file import FilesDataSource, SynchronisedFilesDataSource
@@ -58,6 +59,17 @@ class StubSynchronisedInFileDataSource(SynchronisedFilesDataSource):
         pass
 
 
+class StubChunkedFilesDataSource(ChunkedFilesDataSource):
+    """
+    Stub `ChunkedFilesDataSource`.
+    """
+    def is_data_file(self, file_path: str) -> bool:
+        pass
+
+    def extract_data_from_chunk(self, chunk: bytes) -> Iterable[DataSourceType]:
+        pass
+
+
 class StubRegisteringDataSource(RegisteringDataSource):
     """
     Stub implementation of `RegisteringDataSource`.
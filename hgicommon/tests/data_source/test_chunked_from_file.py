@@ -0,0 +1,191 @@
+"""
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import gzip
+import os
+import shutil
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+from threading import Lock
+from typing import List, Iterable
+from unittest.mock import MagicMock
+
+from watchdog.events import FileDeletedEvent, FileMovedEvent
+
+from hgicommon.data_source.chunked_from_file import ChunkedFilesDataSource
+from hgicommon.data_source.static_from_file import SynchronisedFilesDataSource
+from hgicommon.tests.data_source._stubs import StubChunkedFilesDataSource
+
+
+class TestChunkedFilesDataSource(unittest.TestCase):
+    """
+    Tests for `ChunkedFilesDataSource`.
+    """
+    def setUp(self):
+        self.data = [i for i in range(1000)]
+        self.temp_directory = mkdtemp(suffix=TestChunkedFilesDataSource.__name__)
+        self.file_path = os.path.join(self.temp_directory, "data")
+        with open(self.file_path, "w") as file:
+            file.write("\n".join(str(i) for i in self.data))
+
+        def extract_adapter(chunk: bytes) -> List[int]:
+            return [int(line) for line in chunk.split(b"\n") if len(line) > 0]
+
+        # Threads are used so the mock extraction can be inspected
+        self.chunk_executor_factory = MagicMock(side_effect=ThreadPoolExecutor)
+        self.source = StubChunkedFilesDataSource(self.temp_directory, chunk_size=64, max_chunk_workers=4,
+                                                 chunk_executor_factory=self.chunk_executor_factory)
+        self.source.is_data_file = MagicMock(return_value=True)
+        self.source.extract_data_from_chunk = MagicMock(side_effect=extract_adapter)
+
+    def tearDown(self):
+        self.source.shutdown_chunk_executor()
+        shutil.rmtree(self.temp_directory)
+
+    def test_extract_data_from_file(self):
+        self.assertEqual(self.source.extract_data_from_file(self.file_path), self.data)
+        self.assertGreater(self.source.extract_data_from_chunk.call_count, 1)
+
+    def test_extract_data_from_file_with_single_chunk(self):
+        self.source.chunk_size = 1024 * 1024
+        self.assertEqual(self.source.extract_data_from_file(self.file_path), self.data)
+        self.assertEqual(self.source.extract_data_from_chunk.call_count, 1)
+        self.chunk_executor_factory.assert_not_called()
+
+    def test_extract_data_from_file_with_chunks_split_at_record_boundaries(self):
+        self.source.extract_data_from_file(self.file_path)
+        for call in self.source.extract_data_from_chunk.call_args_list[:-1]:
+            self.assertTrue(call[0][0].endswith(b"\n"))
+
+    def test_extract_data_from_compressed_file(self):
+        with gzip.open(self.file_path, "wt") as file:
+            file.write("\n".join(str(i) for i in self.data))
+        self.assertEqual(self.source.extract_data_from_file(self.file_path), self.data)
+
+    def test_extract_data_from_appended_file(self):
+        self.source.extract_data_from_file(self.file_path)
+        number_of_chunks = self.source.extract_data_from_chunk.call_count
+        self.source.extract_data_from_chunk.reset_mock()
+
+        with open(self.file_path, "a") as file:
+            file.write("\n1000\n1001")
+        self.assertEqual(self.source.extract_data_from_file(self.file_path), self.data + [1000, 1001])
+        self.assertLess(self.source.extract_data_from_chunk.call_count, number_of_chunks / 2)
+
+    def test_extract_data_from_files_with_same_executor(self):
+        other_file_path = os.path.join(self.temp_directory, "other")
+        shutil.copy(self.file_path, other_file_path)
+        self.source.extract_data_from_file(self.file_path)
+        self.source.extract_data_from_file(other_file_path)
+        self.chunk_executor_factory.assert_called_once_with(4)
+
+    def test_extract_data_from_unchanged_file_without_executor(self):
+        self.source.extract_data_from_file(self.file_path)
+        self.source.shutdown_chunk_executor()
+        self.chunk_executor_factory.reset_mock()
+        self.assertEqual(self.source.extract_data_from_file(self.file_path), self.data)
+        self.chunk_executor_factory.assert_not_called()
+
+    def test_extract_data_from_file_without_chunk_caching(self):
+        self.source.cache_chunks = False
+        self.source.extract_data_from_file(self.file_path)
+        number_of_chunks = self.source.extract_data_from_chunk.call_count
+        self.source.extract_data_from_file(self.file_path)
+        self.assertEqual(self.source.extract_data_from_chunk.call_count, 2 * number_of_chunks)
+
+    def test_clear_chunk_cache(self):
+        self.source.extract_data_from_file(self.file_path)
+        number_of_chunks = self.source.extract_data_from_chunk.call_count
+        self.source.clear_chunk_cache()
+        self.source.extract_data_from_file(self.file_path)
+        self.assertEqual(self.source.extract_data_from_chunk.call_count, 2 * number_of_chunks)
+
+    def test_get_all(self):
+        self.assertEqual(self.source.get_all(), self.data)
+
+    def test_get_all_removes_chunk_caches_of_deleted_files(self):
+        self.source.get_all()
+        self.assertIn(self.file_path, self.source._chunk_caches)
+        os.remove(self.file_path)
+        self.assertEqual(self.source.get_all(), [])
+        self.assertNotIn(self.file_path, self.source._chunk_caches)
+
+    def test_chunk_cache_removed_when_file_deleted(self):
+        source = _StubSynchronisedChunkedFilesDataSource(
+            self.temp_directory, chunk_size=64, chunk_executor_factory=ThreadPoolExecutor)
+        source.extract_data_from_file(self.file_path)
+        os.remove(self.file_path)
+        source._on_file_deleted(FileDeletedEvent(self.file_path))
+        self.assertEqual(len(source._chunk_caches), 0)
+        source.shutdown_chunk_executor()
+
+    def test_chunk_cache_moved_with_file(self):
+        source = _StubSynchronisedChunkedFilesDataSource(
+            self.temp_directory, chunk_size=64, chunk_executor_factory=ThreadPoolExecutor)
+        source.extract_data_from_file(self.file_path)
+        chunk_cache = source._chunk_caches[self.file_path]
+        moved_file_path = "%s_moved" % self.file_path
+        shutil.move(self.file_path, moved_file_path)
+        source.extract_data_from_chunk = MagicMock(side_effect=source.extract_data_from_chunk)
+        source._on_file_moved(FileMovedEvent(self.file_path, moved_file_path))
+        self.assertEqual(list(source._chunk_caches.keys()), [moved_file_path])
+        self.assertEqual(source._chunk_caches[moved_file_path], chunk_cache)
+        source.extract_data_from_chunk.assert_not_called()
+        source.shutdown_chunk_executor()
+
+    def test_extract_data_from_file_in_processes(self):
+        source = _IntegerChunkedFilesDataSource(self.temp_directory, chunk_size=64, max_chunk_workers=2)
+        source.multiplier = 2
+        self.assertEqual(source.extract_data_from_file(self.file_path), [2 * i for i in self.data])
+        self.assertEqual(len(source.extracted_in), 0)
+        source.shutdown_chunk_executor()
+
+
+class _IntegerChunkedFilesDataSource(ChunkedFilesDataSource):
+    """
+    `ChunkedFilesDataSource` of files of integers, which records the process that each chunk is extracted in.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.multiplier = 1
+        self.extracted_in = set()
+        # Not picklable, so not copied to worker processes
+        self.lock = Lock()
+
+    def is_data_file(self, file_path: str) -> bool:
+        return True
+
+    def extract_data_from_chunk(self, chunk: bytes) -> Iterable[int]:
+        # Changes to this attribute in worker processes are not seen by this process
+        self.extracted_in.add(os.getpid())
+        return [self.multiplier * int(line) for line in chunk.split(b"\n") if len(line) > 0]
+
+
+class _StubSynchronisedChunkedFilesDataSource(_IntegerChunkedFilesDataSource, SynchronisedFilesDataSource):
+    """
+    `_IntegerChunkedFilesDataSource` mixed into `SynchronisedFilesDataSource`.
+    """
+
+
+if __name__ == "__main__":
+    unittest.main()
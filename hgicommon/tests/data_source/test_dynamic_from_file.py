@@ -23,13 +23,18 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import logging
 import os
 import shutil
+import sys
 import unittest
 from tempfile import mkdtemp, mkstemp
-from unittest.mock import MagicMock, call
+from unittest.mock import MagicMock, call, patch
 
-from hgicommon.data_source.dynamic_from_file import register, unregister
-from hgicommon.data_source.dynamic_from_file import registration_event_listenable_map
-from hgicommon.models import RegistrationEvent
+from watchdog.events import FileModifiedEvent
+
+from hgicommon.data_source.dynamic_from_file import register, unregister, register_many, unregister_many
+from hgicommon.data_source.dynamic_from_file import registration_event_listenable_map, \
+    registration_batch_event_listenable_map
+from hgicommon.helpers import create_random_string
+from hgicommon.models import RegistrationEvent, RegistrationBatchEvent
 from hgicommon.tests.data_source._stubs import StubRegisteringDataSource
 
 
@@ -38,9 +43,10 @@ class TestRegister(unittest.TestCase):
     Tests for `register` and `unregister`.
     """
     def tearDown(self):
-        listeners = registration_event_listenable_map[int].get_listeners()
-        for listener in listeners:
-            registration_event_listenable_map[int].remove_listener(listener)
+        for listenable_map in (registration_event_listenable_map, registration_batch_event_listenable_map):
+            for listenable in listenable_map.values():
+                for listener in list(listenable.get_listeners()):
+                    listenable.remove_listener(listener)
 
     def test_register(self):
         listener_1 = MagicMock()
@@ -83,6 +89,36 @@ class TestRegister(unittest.TestCase):
 
         listener_2.assert_called_once_with(update_1)
 
+    def test_register_notifies_batch_listeners(self):
+        listener = MagicMock()
+        registration_batch_event_listenable_map[int].add_listener(listener)
+        register(123)
+        listener.assert_called_once_with(RegistrationBatchEvent([123], RegistrationEvent.Type.REGISTERED))
+
+    def test_register_many(self):
+        int_batch_listener = MagicMock()
+        registration_batch_event_listenable_map[int].add_listener(int_batch_listener)
+        str_batch_listener = MagicMock()
+        registration_batch_event_listenable_map[str].add_listener(str_batch_listener)
+        int_listener = MagicMock()
+        registration_event_listenable_map[int].add_listener(int_listener)
+
+        register_many([1, "a", 2, 3])
+        int_batch_listener.assert_called_once_with(
+            RegistrationBatchEvent([1, 2, 3], RegistrationEvent.Type.REGISTERED))
+        str_batch_listener.assert_called_once_with(RegistrationBatchEvent(["a"], RegistrationEvent.Type.REGISTERED))
+        int_listener.assert_has_calls([
+            call(RegistrationEvent(1, RegistrationEvent.Type.REGISTERED)),
+            call(RegistrationEvent(2, RegistrationEvent.Type.REGISTERED)),
+            call(RegistrationEvent(3, RegistrationEvent.Type.REGISTERED))
+        ])
+
+    def test_unregister_many(self):
+        listener = MagicMock()
+        registration_batch_event_listenable_map[int].add_listener(listener)
+        unregister_many([1, 2])
+        listener.assert_called_once_with(RegistrationBatchEvent([1, 2], RegistrationEvent.Type.UNREGISTERED))
+
 
 class TestRegisteringDataSource(unittest.TestCase):
     """
@@ -119,6 +155,16 @@ class TestRegisteringDataSource(unittest.TestCase):
         ])
         self.assertEqual(loaded, [123, 456])
 
+    def test_extract_data_from_file_with_batch_registration(self):
+        rule_file_location = self._create_data_file_in_temp_directory()
+        with open(rule_file_location, 'w') as file:
+            file.write("from hgicommon.data_source import register, register_many\n"
+                       "register_many(range(1000))\n"
+                       "register(1000)")
+
+        loaded = self.source.extract_data_from_file(rule_file_location)
+        self.assertEqual(loaded, [i for i in range(1001)])
+
     def test_extract_data_from_file_with_corrupted_file(self):
         rule_file_location = self._create_data_file_in_temp_directory()
         with open(rule_file_location, 'w') as file:
@@ -135,6 +181,78 @@ class TestRegisteringDataSource(unittest.TestCase):
         logging.root.setLevel(level=logging.ERROR)
         self.assertRaises(Exception, self.source.extract_data_from_file, new_rule_file_location)
 
+    def test_modifying_helper_reloads_dependent_modules(self):
+        self._test_modifying_helper_reloads_dependent_modules()
+
+    def test_modifying_helper_reloads_dependent_modules_when_bytecode_written(self):
+        with patch.object(sys, "dont_write_bytecode", False):
+            self._test_modifying_helper_reloads_dependent_modules()
+
+    def _test_modifying_helper_reloads_dependent_modules(self):
+        """
+        Tests that modifying a helper module reloads the modules that depend on it, where the helper is modified such
+        that its size and modification time (in seconds) are probably unchanged.
+        """
+        helper_name = "helper_%s" % create_random_string().replace("-", "")
+        helper_location = os.path.join(self.temp_directory, "%s.py" % helper_name)
+        with open(helper_location, "w") as file:
+            file.write("VALUE = 1")
+        dependent_location = os.path.join(self.temp_directory, "rule_dependent.py")
+        with open(dependent_location, "w") as file:
+            file.write("from hgicommon.data_source import register\n"
+                       "from %s import VALUE\n"
+                       "register(VALUE)" % helper_name)
+        independent_location = os.path.join(self.temp_directory, "rule_independent.py")
+        with open(independent_location, "w") as file:
+            file.write("from hgicommon.data_source import register\n"
+                       "register(100)")
+
+        self.source.is_data_file = MagicMock(side_effect=lambda path: os.path.basename(path).startswith("rule"))
+        sys.path.append(self.temp_directory)
+        try:
+            self.source.start()
+            # Calling event handler directly, opposed to via the file system monitor, to control the events
+            self.source._observer.unschedule_all()
+            self.assertCountEqual(self.source.get_all(), [1, 100])
+
+            extract_data_from_file = self.source.extract_data_from_file
+            self.source.extract_data_from_file = MagicMock(side_effect=extract_data_from_file)
+            with open(helper_location, "w") as file:
+                file.write("VALUE = 2")
+            self.source._on_file_modified(FileModifiedEvent(helper_location))
+
+            self.assertCountEqual(self.source.get_all(), [2, 100])
+            self.source.extract_data_from_file.assert_called_once_with(dependent_location)
+        finally:
+            sys.path.remove(self.temp_directory)
+            sys.modules.pop(helper_name, None)
+
+    def test_changes_to_files_that_are_not_loaded_modules_do_not_unload_modules(self):
+        self.source.is_data_file = MagicMock(side_effect=lambda path: os.path.basename(path).startswith("rule"))
+        rule_location = os.path.join(self.temp_directory, "rule.py")
+        with open(rule_location, "w") as file:
+            file.write("from hgicommon.data_source import register\n"
+                       "register(1)")
+        self.source.start()
+        # Calling event handler directly, opposed to via the file system monitor, to control the events
+        self.source._observer.unschedule_all()
+        self.source._get_dependents = MagicMock(side_effect=self.source._get_dependents)
+
+        with patch("hgicommon.data_source.dynamic_from_file.invalidate_caches") as invalidate_caches:
+            not_module_location = os.path.join(self.temp_directory, "notes.txt")
+            open(not_module_location, "w").close()
+            self.source._on_file_modified(FileModifiedEvent(not_module_location))
+            self.source._get_dependents.assert_not_called()
+
+            unloaded_module_location = os.path.join(self.temp_directory, "helper.py")
+            open(unloaded_module_location, "w").close()
+            self.source._on_file_modified(FileModifiedEvent(unloaded_module_location))
+            invalidate_caches.assert_not_called()
+
+            self.source._on_file_modified(FileModifiedEvent(rule_location))
+            invalidate_caches.assert_called_once_with()
+        self.assertCountEqual(self.source.get_all(), [1])
+
     def _create_data_file_in_temp_directory(self) -> str:
         """
         Creates a data file in the temp directory used by this test.
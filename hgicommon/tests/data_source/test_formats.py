@@ -0,0 +1,128 @@
+"""
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import gzip
+import logging
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from types import GeneratorType
+
+from hgicommon.data_source.formats import JsonLinesFilesDataSource, CsvFilesDataSource
+from hgicommon.models import SearchCriterion
+
+
+class TestJsonLinesFilesDataSource(unittest.TestCase):
+    """
+    Tests for `JsonLinesFilesDataSource`.
+    """
+    def setUp(self):
+        self.temp_directory = mkdtemp(suffix=TestJsonLinesFilesDataSource.__name__)
+        with open(os.path.join(self.temp_directory, "1.jsonl"), "w") as file:
+            file.write("{\"attribute\": \"a\", \"value\": 1}\n\n{\"attribute\": \"b\", \"value\": 2}\n")
+        with open(os.path.join(self.temp_directory, "2.jsonl"), "w") as file:
+            file.write("{\"attribute\": \"c\", \"value\": 3}")
+        with open(os.path.join(self.temp_directory, "other.txt"), "w") as file:
+            file.write("not data")
+        self.source = JsonLinesFilesDataSource(self.temp_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_get_all(self):
+        self.assertCountEqual(self.source.get_all(), [
+            {"attribute": "a", "value": 1}, {"attribute": "b", "value": 2}, {"attribute": "c", "value": 3}])
+
+    def test_get_all_with_row_mapper(self):
+        self.source.row_mapper = lambda row: SearchCriterion(**row)
+        self.assertCountEqual(self.source.get_all(), [
+            SearchCriterion("a", 1), SearchCriterion("b", 2), SearchCriterion("c", 3)])
+
+    def test_get_all_with_compressed_file(self):
+        with gzip.open(os.path.join(self.temp_directory, "3.jsonl.gz"), "wt") as file:
+            file.write("{\"attribute\": \"d\", \"value\": 4}\n")
+        self.assertCountEqual([row["value"] for row in self.source.get_all()], [1, 2, 3, 4])
+
+    def test_get_all_with_files_data_source_options(self):
+        source = JsonLinesFilesDataSource(
+            self.temp_directory, failure_backoff=60, max_failure_backoff=120, max_workers=2)
+        self.assertEqual(source.failure_backoff, 60)
+        self.assertEqual(source.max_failure_backoff, 120)
+        self.assertEqual(source.max_workers, 2)
+        self.assertCountEqual([row["value"] for row in source.get_all()], [1, 2, 3])
+
+    def test_iterate_all(self):
+        iterator = self.source.iterate_all()
+        self.assertIsInstance(iterator, GeneratorType)
+        self.assertCountEqual([row["value"] for row in iterator], [1, 2, 3])
+
+    def test_iterate_all_with_invalid_file(self):
+        with open(os.path.join(self.temp_directory, "3.jsonl"), "w") as file:
+            file.write("{")
+        logging.root.setLevel(level=logging.ERROR)
+        self.assertCountEqual([row["value"] for row in self.source.iterate_all()], [1, 2, 3])
+
+    def test_extract_data_from_invalid_file(self):
+        file_path = os.path.join(self.temp_directory, "3.jsonl")
+        with open(file_path, "w") as file:
+            file.write("{}\n{")
+        self.assertRaisesRegex(ValueError, "line 2", self.source.extract_data_from_file, file_path)
+
+
+class TestCsvFilesDataSource(unittest.TestCase):
+    """
+    Tests for `CsvFilesDataSource`.
+    """
+    def setUp(self):
+        self.temp_directory = mkdtemp(suffix=TestCsvFilesDataSource.__name__)
+        with open(os.path.join(self.temp_directory, "1.csv"), "w") as file:
+            file.write("attribute,value\na,1\nb,2\n")
+        self.source = CsvFilesDataSource(self.temp_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_get_all(self):
+        self.assertCountEqual(self.source.get_all(), [
+            {"attribute": "a", "value": "1"}, {"attribute": "b", "value": "2"}])
+
+    def test_get_all_with_files_data_source_options(self):
+        source = CsvFilesDataSource(self.temp_directory, delimiter=",", failure_backoff=60, max_workers=2)
+        self.assertEqual(source.failure_backoff, 60)
+        self.assertEqual(source.max_workers, 2)
+        self.assertCountEqual(source.get_all(), [{"attribute": "a", "value": "1"}, {"attribute": "b", "value": "2"}])
+
+    def test_get_all_with_fieldnames(self):
+        with open(os.path.join(self.temp_directory, "1.csv"), "w") as file:
+            file.write("a;1\n")
+        self.source.fieldnames = ["attribute", "value"]
+        self.source.delimiter = ";"
+        self.assertEqual(self.source.get_all(), [{"attribute": "a", "value": "1"}])
+
+    def test_get_all_with_row_mapper(self):
+        self.source.row_mapper = lambda row: SearchCriterion(row["attribute"], int(row["value"]))
+        self.assertCountEqual(self.source.get_all(), [SearchCriterion("a", 1), SearchCriterion("b", 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+"""
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+from hgicommon.data_source.dynamic_from_file import RegisteringDataSource
+from hgicommon.data_source.packed import build_module_archive, ModuleArchive, main
+from hgicommon.data_source.static_from_file import get_file_identity
+from hgicommon.tests.data_source._stubs import StubRegisteringDataSource
+
+_MODULE_SOURCE = "from hgicommon.data_source import register\nregister(%d)"
+
+
+class TestModuleArchive(unittest.TestCase):
+    """
+    Tests for `build_module_archive` and `ModuleArchive`.
+    """
+    def setUp(self):
+        self.temp_directory = mkdtemp(suffix=TestModuleArchive.__name__)
+        self.modules_directory = os.path.join(self.temp_directory, "modules")
+        os.makedirs(os.path.join(self.modules_directory, "nested"))
+        self.module_locations = [os.path.join(self.modules_directory, "1.py"),
+                                 os.path.join(self.modules_directory, "nested", "2.py")]
+        for i, module_location in enumerate(self.module_locations):
+            with open(module_location, "w") as file:
+                file.write(_MODULE_SOURCE % i)
+        self.archive_location = os.path.join(self.temp_directory, "modules.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_build_module_archive(self):
+        self.assertEqual(build_module_archive(self.modules_directory, self.archive_location), 2)
+        archive = ModuleArchive(self.archive_location, self.modules_directory)
+        for module_location in self.module_locations:
+            self.assertIsNotNone(archive.get_code(module_location))
+        self.assertFalse(archive.is_stale())
+
+    def test_build_module_archive_with_module_that_cannot_be_compiled(self):
+        broken_location = os.path.join(self.modules_directory, "broken.py")
+        with open(broken_location, "w") as file:
+            file.write("def broken(:")
+        logging.root.setLevel(level=logging.ERROR)
+        self.assertEqual(build_module_archive(self.modules_directory, self.archive_location), 2)
+        archive = ModuleArchive(self.archive_location, self.modules_directory)
+        self.assertIsNone(archive.get_code(broken_location))
+        for module_location in self.module_locations:
+            self.assertIsNotNone(archive.get_code(module_location))
+        self.assertFalse(archive.is_stale())
+
+        with open(broken_location, "w") as file:
+            file.write(_MODULE_SOURCE % 3)
+        self.assertTrue(archive.is_stale())
+
+    def test_get_code_when_module_not_in_archive(self):
+        build_module_archive(self.modules_directory, self.archive_location)
+        archive = ModuleArchive(self.archive_location, self.modules_directory)
+        self.assertIsNone(archive.get_code(os.path.join(self.modules_directory, "other.py")))
+
+    def test_get_code_with_known_file_identity(self):
+        build_module_archive(self.modules_directory, self.archive_location)
+        archive = ModuleArchive(self.archive_location, self.modules_directory)
+        file_identity = get_file_identity(self.module_locations[0])
+        with patch("hgicommon.data_source.packed.get_file_identity") as get_identity:
+            self.assertIsNotNone(archive.get_code(self.module_locations[0], file_identity))
+            self.assertIsNone(archive.get_code(self.module_locations[0], (0, 0, 0)))
+            get_identity.assert_not_called()
+
+    def test_get_code_when_module_changed(self):
+        build_module_archive(self.modules_directory, self.archive_location)
+        with open(self.module_locations[0], "w") as file:
+            file.write(_MODULE_SOURCE % 100)
+        archive = ModuleArchive(self.archive_location, self.modules_directory)
+        self.assertIsNone(archive.get_code(self.module_locations[0]))
+        self.assertIsNotNone(archive.get_code(self.module_locations[1]))
+        self.assertTrue(archive.is_stale())
+
+    def test_is_stale_when_module_added(self):
+        build_module_archive(self.modules_directory, self.archive_location)
+        with open(os.path.join(self.modules_directory, "3.py"), "w") as file:
+            file.write(_MODULE_SOURCE % 3)
+        self.assertTrue(ModuleArchive(self.archive_location, self.modules_directory).is_stale())
+
+    def test_main(self):
+        with patch("sys.argv", ["packed", self.modules_directory, self.archive_location]), patch("builtins.print"):
+            main()
+        self.assertFalse(ModuleArchive(self.archive_location, self.modules_directory).is_stale())
+
+
+class TestRegisteringDataSourceWithModuleArchive(unittest.TestCase):
+    """
+    Tests for `RegisteringDataSource` using a `ModuleArchive`.
+    """
+    def setUp(self):
+        self.temp_directory = mkdtemp(suffix=TestRegisteringDataSourceWithModuleArchive.__name__)
+        self.modules_directory = os.path.join(self.temp_directory, "modules")
+        os.makedirs(self.modules_directory)
+        for i in range(3):
+            with open(os.path.join(self.modules_directory, "%d.py" % i), "w") as file:
+                file.write(_MODULE_SOURCE % i)
+        self.archive_location = os.path.join(self.temp_directory, "modules.zip")
+        build_module_archive(self.modules_directory, self.archive_location)
+
+        self.source = StubRegisteringDataSource(self.modules_directory, int, archive_location=self.archive_location)
+        self.source.is_data_file = MagicMock(side_effect=lambda file_path: file_path.endswith(".py"))
+
+    def tearDown(self):
+        self.source.stop()
+        shutil.rmtree(self.temp_directory)
+
+    def test_start_loads_from_archive(self):
+        with patch.object(RegisteringDataSource, "_load_module", wraps=RegisteringDataSource._load_module) as load:
+            self.source.start()
+        self.assertCountEqual(self.source.get_all(), [0, 1, 2])
+        self.assertEqual(load.call_count, 3)
+        for call in load.call_args_list:
+            self.assertIsNotNone(call[0][1])
+
+    def test_start_does_not_get_identities_of_modules_again(self):
+        with patch("hgicommon.data_source.packed.get_file_identity") as get_identity:
+            self.source.start()
+        self.assertCountEqual(self.source.get_all(), [0, 1, 2])
+        get_identity.assert_not_called()
+
+    def test_start_loads_changed_modules_from_source(self):
+        changed_location = os.path.join(self.modules_directory, "0.py")
+        with open(changed_location, "w") as file:
+            file.write(_MODULE_SOURCE % 100)
+        with patch.object(RegisteringDataSource, "_load_module", wraps=RegisteringDataSource._load_module) as load:
+            self.source.start()
+        self.assertCountEqual(self.source.get_all(), [100, 1, 2])
+        self.assertIn(((changed_location, None), ), load.call_args_list)
+
+    def test_start_with_invalid_archive(self):
+        with open(self.archive_location, "w") as file:
+            file.write("invalid")
+        self.source.start()
+        self.assertCountEqual(self.source.get_all(), [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
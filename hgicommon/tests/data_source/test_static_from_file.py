@@ -20,25 +20,113 @@ General Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import bz2
+import gc
 import glob
+import gzip
 import logging
+import lzma
 import os
 import shutil
 import threading
 import unittest
+import weakref
 from multiprocessing import Lock
 from tempfile import mkdtemp
 from threading import Semaphore
-from typing import Any, List, Tuple
-from unittest.mock import MagicMock
+from typing import Any, List, Tuple, Callable
+from unittest.mock import MagicMock, patch
 
-from hgicommon.data_source.static_from_file import FileSystemChange
+from watchdog.events import FileCreatedEvent, FileModifiedEvent
+
+from hgicommon.data_source.static_from_file import FileSystemChange, Compression, get_compression, open_data_file, \
+    strip_compression_suffix
 from hgicommon.tests._helpers import write_data_to_files_in_temp_directory, extract_data_from_file
 from hgicommon.tests.data_source._helpers import block_until_synchronised_files_data_source_started
 from hgicommon.tests.data_source._stubs import StubFilesDataSource
 from hgicommon.tests.data_source._stubs import StubSynchronisedInFileDataSource
 
 
+class TestOpenDataFile(unittest.TestCase):
+    """
+    Tests for `open_data_file`, `get_compression` and `strip_compression_suffix`.
+    """
+    _CONTENTS = "1\n2\n3\n"
+
+    def setUp(self):
+        self.temp_directory = mkdtemp(suffix=TestOpenDataFile.__name__)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_open_uncompressed(self):
+        file_path = os.path.join(self.temp_directory, "data.txt")
+        with open(file_path, "w") as file:
+            file.write(TestOpenDataFile._CONTENTS)
+        self.assertIsNone(get_compression(file_path))
+        with open_data_file(file_path) as file:
+            self.assertEqual(file.read(), TestOpenDataFile._CONTENTS)
+
+    def test_open_gzip_compressed(self):
+        self._assert_opens_compressed(gzip.open, Compression.GZIP, ".gz")
+
+    def test_open_bzip2_compressed(self):
+        self._assert_opens_compressed(bz2.open, Compression.BZIP2, ".bz2")
+
+    def test_open_xz_compressed(self):
+        self._assert_opens_compressed(lzma.open, Compression.XZ, ".xz")
+
+    def test_open_compressed_without_suffix(self):
+        self._assert_opens_compressed(gzip.open, Compression.GZIP, "")
+
+    def test_open_empty_bzip2_compressed(self):
+        file_path = os.path.join(self.temp_directory, "data")
+        with bz2.open(file_path, "wb"):
+            pass
+        self.assertEqual(get_compression(file_path), Compression.BZIP2)
+
+    def test_open_uncompressed_starting_like_bzip2_header(self):
+        for name in ("data.csv", "data.bz2"):
+            file_path = os.path.join(self.temp_directory, name)
+            with open(file_path, "w") as file:
+                file.write("BZh,value\n1,2\n")
+            self.assertIsNone(get_compression(file_path))
+            with open_data_file(file_path) as file:
+                self.assertEqual(file.readline(), "BZh,value\n")
+
+    def test_partial_header_match_requires_suffix(self):
+        for name, compression in (("data.csv", None), ("data.csv.bz2", Compression.BZIP2)):
+            file_path = os.path.join(self.temp_directory, name)
+            with open(file_path, "wb") as file:
+                file.write(b"BZh9 - not a block")
+            self.assertEqual(get_compression(file_path), compression)
+
+    def test_open_compressed_in_binary_mode(self):
+        file_path = os.path.join(self.temp_directory, "data.gz")
+        with gzip.open(file_path, "wt") as file:
+            file.write(TestOpenDataFile._CONTENTS)
+        with open_data_file(file_path, text=False) as file:
+            self.assertEqual(file.read(), TestOpenDataFile._CONTENTS.encode())
+
+    def test_strip_compression_suffix(self):
+        self.assertEqual(strip_compression_suffix("data.csv.gz"), "data.csv")
+        self.assertEqual(strip_compression_suffix("data.csv"), "data.csv")
+
+    def _assert_opens_compressed(self, compressed_open: Callable, compression: Compression, suffix: str):
+        """
+        Asserts that a file, compressed in the given format, can be opened.
+        :param compressed_open: function to open a compressed file for writing
+        :param compression: the compression format
+        :param suffix: the suffix of the compressed file
+        """
+        file_path = os.path.join(self.temp_directory, "data.txt%s" % suffix)
+        with compressed_open(file_path, "wt") as file:
+            file.write(TestOpenDataFile._CONTENTS)
+        self.assertEqual(get_compression(file_path), compression)
+        with open_data_file(file_path) as file:
+            self.assertEqual(list(file), ["1\n", "2\n", "3\n"])
+
+
 class TestFilesDataSource(unittest.TestCase):
     """
     Tests for `FilesDataSource`.
@@ -67,6 +155,11 @@ class TestFilesDataSource(unittest.TestCase):
         retrieved_data = self.source.get_all()
         self.assertCountEqual(retrieved_data, self.data)
 
+    def test_get_all_in_parallel(self):
+        self.source.max_workers = 4
+        retrieved_data = self.source.get_all()
+        self.assertCountEqual(retrieved_data, self.data)
+
     def test_get_all_with_filter(self):
         def data_filter(file_path: str) -> bool:
             with open(file_path, 'r') as file:
@@ -76,10 +169,102 @@ class TestFilesDataSource(unittest.TestCase):
         retrieved_data = self.source.get_all()
         self.assertCountEqual(retrieved_data, [27, 28, 29])
 
+    def test_get_all_does_not_retry_unchanged_failed_file(self):
+        failed_file_path = self._create_unparsable_file()
+        self.source.get_all()
+        self.source.get_all()
+        self.assertEqual(self._count_extractions(failed_file_path), 1)
+        self.assertCountEqual(self.source.get_failed_origins().keys(), [failed_file_path])
+
+    def test_failure_does_not_keep_extraction_alive(self):
+        parsed = []
+
+        def extract_adapter(file_path: str) -> Any:
+            partially_parsed = _StubParsedData()
+            parsed.append(weakref.ref(partially_parsed))
+            try:
+                int("not an integer")
+            except ValueError as e:
+                raise RuntimeError(file_path) from e
+
+        self.source.extract_data_from_file = MagicMock(side_effect=extract_adapter)
+        failed_file_path = self._create_unparsable_file()
+        self.source.get_all()
+        gc.collect()
+        exception = self.source.get_failed_origins()[failed_file_path].exception
+        self.assertIsInstance(exception, RuntimeError)
+        self.assertIsNone(exception.__traceback__)
+        self.assertIsNone(exception.__cause__.__traceback__)
+        self.assertTrue(all(reference() is None for reference in parsed))
+
+    def test_get_all_does_not_retry_touched_failed_file(self):
+        failed_file_path = self._create_unparsable_file()
+        self.source.get_all()
+        stat = os.stat(failed_file_path)
+        os.utime(failed_file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.source.get_all()
+        self.source.get_all()
+        self.assertEqual(self._count_extractions(failed_file_path), 1)
+        self.assertCountEqual(self.source.get_failed_origins().keys(), [failed_file_path])
+
+    def test_get_all_retries_failed_file_changed_without_changing_size(self):
+        failed_file_path = self._create_unparsable_file()
+        self.source.get_all()
+        stat = os.stat(failed_file_path)
+        with open(failed_file_path, 'w') as file:
+            file.write("12345678901234")
+        os.utime(failed_file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertCountEqual(self.source.get_all(), self.data + [12345678901234])
+        self.assertEqual(self._count_extractions(failed_file_path), 2)
+
+    def test_get_all_retries_changed_failed_file(self):
+        failed_file_path = self._create_unparsable_file()
+        self.source.get_all()
+        with open(failed_file_path, 'w') as file:
+            file.write("100")
+        self.assertCountEqual(self.source.get_all(), self.data + [100])
+        self.assertEqual(self._count_extractions(failed_file_path), 2)
+        self.assertEqual(len(self.source.get_failed_origins()), 0)
+
+    def test_get_all_backs_off_retrying_changed_failed_file(self):
+        self.source.failure_backoff = 60
+        failed_file_path = self._create_unparsable_file()
+        self.source.get_all()
+        with open(failed_file_path, 'w') as file:
+            file.write("100")
+        self.assertCountEqual(self.source.get_all(), self.data)
+        self.assertEqual(self._count_extractions(failed_file_path), 1)
+        self.assertEqual(self.source.get_failed_origins()[failed_file_path].attempts, 1)
+
+    def _create_unparsable_file(self) -> str:
+        """
+        Creates a file in the temp directory that data cannot be extracted from.
+        :return: the path of the created file
+        """
+        logging.root.setLevel(level=logging.ERROR)
+        file_path = os.path.join(self.temp_directory, "unparsable")
+        with open(file_path, 'w') as file:
+            file.write("not an integer")
+        return file_path
+
+    def _count_extractions(self, file_path: str) -> int:
+        """
+        Counts the number of times data has been extracted from the file at the given path.
+        :param file_path: the path of the file
+        :return: the number of extractions
+        """
+        return [call[0][0] for call in self.source.extract_data_from_file.call_args_list].count(file_path)
+
     def tearDown(self):
         shutil.rmtree(self.temp_directory)
 
 
+class _StubParsedData:
+    """
+    Stub of data parsed from a file, which can be weakly referenced.
+    """
+
+
 class TestSynchronisedFilesDataSource(unittest.TestCase):
     """
     Tests for `SynchronisedFilesDataSource`.
@@ -112,6 +297,168 @@ class TestSynchronisedFilesDataSource(unittest.TestCase):
         self.source.stop()
         self.source.start()
 
+    def test_start_without_blocking(self):
+        loading_lock = threading.Lock()
+        loading_lock.acquire()
+        extract_adapter = self.source.extract_data_from_file.side_effect
+
+        def blocked_extract_adapter(file_path: str) -> Any:
+            with loading_lock:
+                return extract_adapter(file_path)
+
+        self.source.extract_data_from_file = MagicMock(side_effect=blocked_extract_adapter)
+        self.source.start(block=False)
+        self.assertFalse(self.source.is_ready())
+        self.assertEqual(self.source.get_load_progress()[0], 0)
+        self.assertEqual(len(self.source.get_all()), 0)
+
+        loading_lock.release()
+        self.assertTrue(self.source.wait_until_ready())
+        self.assertTrue(self.source.is_ready())
+        self.assertEqual(self.source.get_load_progress(), (10, 10))
+        self.assertCountEqual(self.source.get_all(), self.data)
+
+    def test_start_in_parallel(self):
+        self.source.max_workers = 4
+        self.source.start()
+        self.assertTrue(self.source.is_ready())
+        self.assertEqual(self.source.get_load_progress(), (10, 10))
+        self.assertCountEqual(self.source.get_all(), self.data)
+
+    def test_start_with_blocking(self):
+        self.source.start()
+        self.assertTrue(self.source.is_ready())
+        self.assertEqual(self.source.get_load_progress(), (10, 10))
+
+    def test_wait_until_ready_when_never_started(self):
+        self.assertRaises(RuntimeError, self.source.wait_until_ready)
+
+    def test_start_using_snapshot(self):
+        snapshot_directory = mkdtemp(suffix=self._testMethodName)
+        self.source.snapshot_location = os.path.join(snapshot_directory, "snapshot")
+        try:
+            self.source.start()
+            self.source.stop()
+            self.assertTrue(os.path.exists(self.source.snapshot_location))
+
+            to_modify_file_path = glob.glob("%s/*" % self.temp_directory)[0]
+            with open(to_modify_file_path, 'w') as file:
+                file.write("100")
+            self.source.extract_data_from_file.reset_mock()
+
+            self.source.start()
+            self.assertEqual(self.source.extract_data_from_file.call_count, 1)
+            self.source.extract_data_from_file.assert_called_once_with(to_modify_file_path)
+            modified = extract_data_from_file(to_modify_file_path, parser=lambda data: int(data), separator='\n')
+            self.assertIn(100, self.source.get_all())
+            self.assertEqual(len(self.source.get_all()), len(self.data) - 3 + len(modified))
+        finally:
+            self.source.stop()
+            shutil.rmtree(snapshot_directory)
+
+    def test_start_with_corrupt_snapshot(self):
+        snapshot_directory = mkdtemp(suffix=self._testMethodName)
+        self.source.snapshot_location = os.path.join(snapshot_directory, "snapshot")
+        with open(self.source.snapshot_location, 'w') as file:
+            file.write("corrupt")
+        logging.root.setLevel(level=logging.ERROR)
+        try:
+            self.source.start()
+            self.assertCountEqual(self.source.get_all(), self.data)
+        finally:
+            self.source.stop()
+            shutil.rmtree(snapshot_directory)
+
+    def test_start_without_blocking_when_file_modified_during_load(self):
+        to_modify_file_path = glob.glob("%s/*" % self.temp_directory)[0]
+        to_modify = extract_data_from_file(to_modify_file_path, parser=lambda data: int(data), separator='\n')
+        loading = threading.Event()
+        modified = threading.Event()
+        extract_adapter = self.source.extract_data_from_file.side_effect
+
+        def blocked_extract_adapter(file_path: str) -> Any:
+            if file_path == to_modify_file_path and not loading.is_set():
+                # Extracting the original contents then waiting for them to be reloaded
+                loading.set()
+                extracted = extract_adapter(file_path)
+                modified.wait()
+                return extracted
+            return extract_adapter(file_path)
+
+        self.source.extract_data_from_file = MagicMock(side_effect=blocked_extract_adapter)
+        # Not monitoring the file system so that the only events are those given by the test
+        with patch("hgicommon.data_source.static_from_file.Observer"):
+            self.source.start(block=False)
+        try:
+            self.assertTrue(loading.wait(timeout=10))
+            with open(to_modify_file_path, 'w') as file:
+                file.write("100")
+            self.source._on_file_modified(FileModifiedEvent(to_modify_file_path))
+            modified.set()
+
+            self.assertTrue(self.source.wait_until_ready(timeout=10))
+            self.assertCountEqual(self.source.get_all(), [x for x in self.data if x not in to_modify] + [100])
+        finally:
+            modified.set()
+            self.source.stop()
+
+    def test_start_using_snapshot_when_file_modified_during_load(self):
+        snapshot_directory = mkdtemp(suffix=self._testMethodName)
+        self.source.snapshot_location = os.path.join(snapshot_directory, "snapshot")
+        to_modify_file_path = glob.glob("%s/*" % self.temp_directory)[0]
+        to_modify = extract_data_from_file(to_modify_file_path, parser=lambda data: int(data), separator='\n')
+        source = self.source
+        modified = False
+
+        class ModifyingSnapshot(dict):
+            def get(self, file_path: str, default: Any=None) -> Any:
+                nonlocal modified
+                if file_path == to_modify_file_path and not modified:
+                    # Reloading the file after the loader has got its (now stale) identity
+                    modified = True
+                    with open(to_modify_file_path, 'w') as file:
+                        file.write("100")
+                    source._on_file_modified(FileModifiedEvent(to_modify_file_path))
+                return super().get(file_path, default)
+
+        try:
+            self.source.start()
+            self.source.stop()
+            snapshot = ModifyingSnapshot(self.source._load_snapshot())
+            # Not monitoring the file system so that the only events are those given by the test
+            with patch.object(self.source, "_load_snapshot", return_value=snapshot), \
+                    patch("hgicommon.data_source.static_from_file.Observer"):
+                self.source.start()
+            self.assertTrue(modified)
+            self.assertCountEqual(self.source.get_all(), [x for x in self.data if x not in to_modify] + [100])
+        finally:
+            self.source.stop()
+            shutil.rmtree(snapshot_directory)
+
+    def test_file_fixed_during_failure_backoff_is_retried_when_backoff_ends(self):
+        logging.root.setLevel(level=logging.ERROR)
+        self.source.failure_backoff = 0.2
+        self.source.start()
+        failed_file_path = os.path.join(self.temp_directory, "%s_unparsable" % self._FILE_PREFIX)
+        with open(failed_file_path, 'w') as file:
+            file.write("not an integer")
+        self.source._on_file_created(FileCreatedEvent(failed_file_path))
+        self.assertIn(failed_file_path, self.source.get_failed_origins())
+
+        retried = threading.Event()
+        self.source.add_listener(lambda change: retried.set() if 100 in self.source.get_all() else None)
+        with open(failed_file_path, 'w') as file:
+            file.write("100")
+        self.source._on_file_modified(FileModifiedEvent(failed_file_path))
+        self.assertNotIn(100, self.source.get_all())
+
+        self.assertTrue(retried.wait(timeout=10))
+        self.assertCountEqual(self.source.get_all(), self.data + [100])
+        self.assertEqual(len(self.source.get_failed_origins()), 0)
+
+    def test_save_snapshot_when_no_snapshot_location(self):
+        self.assertRaises(RuntimeError, self.source.save_snapshot)
+
     def test_get_all_when_never_started(self):
         self.assertRaises(RuntimeError, self.source.get_all)
 
@@ -21,13 +21,24 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import copy
+import gc
+import pickle
 import unittest
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Barrier
+from threading import Event
+from threading import Lock
 from threading import Semaphore
 from threading import Thread
 from time import sleep
+from typing import Any, Iterable, List
 
-from hgicommon.collections import Metadata, ThreadSafeDefaultdict
+from hgicommon.collections import Metadata, ThreadSafeDefaultdict, FrozenMetadata, MultiMetadata, \
+    LruThreadSafeDefaultdict, TtlThreadSafeDefaultdict, WeakValueThreadSafeDefaultdict, ShardedDict, MetadataTable
+from hgicommon.threading import CountingLock
+from hgicommon.enums import ComparisonOperator
+from hgicommon.models import SearchCriterion, MetadataPatch
 
 
 class TestThreadSafeDefaultdict(unittest.TestCase):
@@ -73,6 +84,287 @@ class TestThreadSafeDefaultdict(unittest.TestCase):
         assert len(values_of_foo) == number_of_threads
         for i in range(number_of_threads - 1):
             self.assertEqual(values_of_foo[i], values_of_foo[i + 1])
+        self.assertEqual(len(values), 1)
+
+    def test_getitem_creates_different_keys_concurrently(self):
+        creating_both = Barrier(2, timeout=10)
+
+        def factory() -> object:
+            # Only passes if the values for both keys are being created at the same time
+            creating_both.wait()
+            return object()
+
+        thread_safe_dict = ThreadSafeDefaultdict(factory)
+        threads = [Thread(target=thread_safe_dict.__getitem__, args=(key, )) for key in ("foo", "bar")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertCountEqual(thread_safe_dict.keys(), ["foo", "bar"])
+
+    def test_getitem_gives_factory_exception_to_all_waiters(self):
+        number_of_threads = 10
+        exceptions = []
+        fail = True
+
+        def factory() -> object:
+            sleep(0.1)
+            if fail:
+                raise RuntimeError()
+            return object()
+
+        thread_safe_dict = ThreadSafeDefaultdict(factory)
+
+        def get_foo():
+            try:
+                thread_safe_dict["foo"]
+            except RuntimeError as e:
+                exceptions.append(e)
+
+        threads = [Thread(target=get_foo) for _ in range(number_of_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(exceptions), number_of_threads)
+        self.assertNotIn("foo", thread_safe_dict)
+
+        fail = False
+        self.assertIsInstance(thread_safe_dict["foo"], object)
+        self.assertIn("foo", thread_safe_dict)
+
+    def test_pickle_with_locks(self):
+        thread_safe_dict = ThreadSafeDefaultdict(Lock)
+        thread_safe_dict["foo"].acquire()
+        unpickled = pickle.loads(pickle.dumps(thread_safe_dict))
+        self.assertCountEqual(unpickled.keys(), ["foo"])
+        self.assertFalse(unpickled["foo"].locked())
+        self.assertFalse(unpickled["bar"].locked())
+
+
+class _TestBoundedThreadSafeDefaultdict:
+    """
+    Tests for the bounded variants of `ThreadSafeDefaultdict`, to be mixed into a `TestCase`.
+    """
+    def create(self, default_factory=None):
+        """
+        Creates the mapping under test.
+        :param default_factory: factory of default values
+        :return: the mapping
+        """
+
+    def test_getitem_creates_default(self):
+        mapping = self.create(list)
+        value = mapping["foo"]
+        self.assertEqual(value, [])
+        self.assertIs(mapping["foo"], value)
+
+    def test_getitem_without_default_factory(self):
+        self.assertRaises(KeyError, self.create().__getitem__, "foo")
+
+    def test_get_does_not_create(self):
+        mapping = self.create(list)
+        self.assertIsNone(mapping.get("foo"))
+        self.assertNotIn("foo", mapping)
+
+    def test_set_and_delete(self):
+        mapping = self.create()
+        value = [1]
+        mapping["foo"] = value
+        self.assertIs(mapping["foo"], value)
+        del mapping["foo"]
+        self.assertNotIn("foo", mapping)
+
+    def test_getitem_is_threadsafe(self):
+        created = []
+
+        def factory() -> List:
+            sleep(0.1)
+            value = []
+            created.append(value)
+            return value
+
+        mapping = self.create(factory)
+        got = []
+        threads = [Thread(target=lambda: got.append(mapping["foo"])) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(created), 1)
+        self.assertTrue(all(value is created[0] for value in got))
+
+    def test_hold(self):
+        mapping = self.create(CountingLock)
+        with mapping.hold("foo") as lock:
+            self.assertTrue(lock.is_locked())
+            self.assertIs(mapping["foo"], lock)
+        self.assertFalse(lock.is_locked())
+
+    def test_items_and_values(self):
+        mapping = self.create(CountingLock)
+        lock = mapping["foo"]
+        self.assertEqual(list(mapping.items()), [("foo", lock)])
+        self.assertEqual(list(mapping.values()), [lock])
+
+    def test_pickle(self):
+        mapping = self.create(CountingLock)
+        lock = mapping["foo"]
+        lock.acquire()
+        unpickled = pickle.loads(pickle.dumps(mapping))
+        self.assertFalse(unpickled["foo"].is_locked())
+        self.assertIsInstance(unpickled["bar"], CountingLock)
+
+
+class TestLruThreadSafeDefaultdict(_TestBoundedThreadSafeDefaultdict, unittest.TestCase):
+    """
+    Tests for `LruThreadSafeDefaultdict`.
+    """
+    def create(self, default_factory=None):
+        return LruThreadSafeDefaultdict(default_factory, max_size=2)
+
+    def test_least_recently_used_evicted(self):
+        mapping = self.create(list)
+        mapping["a"], mapping["b"]
+        mapping["a"]
+        mapping["c"]
+        self.assertCountEqual(mapping.keys(), ["a", "c"])
+
+    def test_held_lock_not_evicted(self):
+        mapping = self.create(Lock)
+        with mapping["a"]:
+            mapping["b"], mapping["c"]
+            self.assertCountEqual(mapping.keys(), ["a", "c"])
+
+    def test_waited_on_lock_not_evicted(self):
+        mapping = self.create(CountingLock)
+        lock = mapping["a"]
+        lock._waiting = 1
+        mapping["b"], mapping["c"]
+        self.assertCountEqual(mapping.keys(), ["a", "c"])
+
+    def test_held_entry_not_evicted(self):
+        mapping = LruThreadSafeDefaultdict(Lock, max_size=2, is_in_use=lambda value: False)
+        with mapping.hold("a") as lock:
+            mapping["b"], mapping["c"], mapping["d"]
+            self.assertIs(mapping["a"], lock)
+        mapping["e"], mapping["f"]
+        self.assertNotIn("a", mapping)
+
+    def test_items_does_not_use_entries(self):
+        mapping = self.create(list)
+        mapping["a"], mapping["b"]
+        dict(mapping.items())
+        mapping["c"]
+        self.assertCountEqual(mapping.keys(), ["b", "c"])
+
+    def test_max_size_exceeded_when_all_in_use(self):
+        mapping = self.create(Lock)
+        with mapping["a"], mapping["b"], mapping["c"]:
+            self.assertEqual(len(mapping), 3)
+        mapping["d"]
+        self.assertEqual(len(mapping), 2)
+
+
+class TestTtlThreadSafeDefaultdict(_TestBoundedThreadSafeDefaultdict, unittest.TestCase):
+    """
+    Tests for `TtlThreadSafeDefaultdict`.
+    """
+    _TTL = 0.2
+
+    def create(self, default_factory=None):
+        return TtlThreadSafeDefaultdict(default_factory, ttl=TestTtlThreadSafeDefaultdict._TTL)
+
+    def test_expired_evicted(self):
+        mapping = self.create(list)
+        mapping["a"]
+        sleep(TestTtlThreadSafeDefaultdict._TTL * 1.5)
+        mapping["b"]
+        self.assertCountEqual(mapping.keys(), ["b"])
+
+    def test_held_lock_not_evicted(self):
+        mapping = self.create(Lock)
+        with mapping["a"]:
+            sleep(TestTtlThreadSafeDefaultdict._TTL * 1.5)
+            self.assertIn("a", mapping)
+        self.assertIn("a", mapping)
+
+    def test_held_entry_not_evicted(self):
+        mapping = TtlThreadSafeDefaultdict(Lock, ttl=TestTtlThreadSafeDefaultdict._TTL, is_in_use=lambda value: False)
+        with mapping.hold("a") as lock:
+            sleep(TestTtlThreadSafeDefaultdict._TTL * 1.5)
+            self.assertIs(mapping["a"], lock)
+
+
+class TestWeakValueThreadSafeDefaultdict(_TestBoundedThreadSafeDefaultdict, unittest.TestCase):
+    """
+    Tests for `WeakValueThreadSafeDefaultdict`.
+    """
+    def create(self, default_factory=None):
+        return WeakValueThreadSafeDefaultdict(default_factory)
+
+    def test_getitem_creates_default(self):
+        mapping = self.create(CountingLock)
+        value = mapping["foo"]
+        self.assertIs(mapping["foo"], value)
+
+    def test_set_and_delete(self):
+        mapping = self.create()
+        value = CountingLock()
+        mapping["foo"] = value
+        self.assertIs(mapping["foo"], value)
+        del mapping["foo"]
+        self.assertNotIn("foo", mapping)
+
+    def test_getitem_is_threadsafe(self):
+        mapping = self.create(CountingLock)
+        got = []
+        threads = [Thread(target=lambda: got.append(mapping["foo"])) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(value is got[0] for value in got))
+
+    def test_getitem_gives_set_exception_to_all_waiters(self):
+        creating = Event()
+        created = Event()
+
+        def factory() -> int:
+            creating.set()
+            created.wait()
+            return 5
+
+        mapping = self.create(factory)
+        exceptions = []
+
+        def get_foo():
+            try:
+                mapping["foo"]
+            except TypeError as e:
+                exceptions.append(e)
+
+        threads = [Thread(target=get_foo, daemon=True)]
+        threads[0].start()
+        creating.wait()
+        threads.append(Thread(target=get_foo, daemon=True))
+        threads[1].start()
+        sleep(0.1)
+        created.set()
+        for thread in threads:
+            thread.join(timeout=10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(len(exceptions), 2)
+        self.assertEqual(len(mapping._creations), 0)
+        self.assertRaises(TypeError, mapping.__getitem__, "foo")
+
+    def test_unreferenced_evicted(self):
+        mapping = self.create(CountingLock)
+        with mapping["a"]:
+            gc.collect()
+            self.assertIn("a", mapping)
+        gc.collect()
+        self.assertNotIn("a", mapping)
 
 
 class TestMetadata(unittest.TestCase):
@@ -151,6 +443,827 @@ class TestMetadata(unittest.TestCase):
     def test_deepcopy(self):
         self.assertEqual(copy.deepcopy(self.metadata), self.metadata)
 
+    def test_pickle(self):
+        self.metadata[5] = 6
+        self.assertEqual(pickle.loads(pickle.dumps(self.metadata)), self.metadata)
+
+    def test_pickle_keeps_index_and_change_tracking(self):
+        metadata = Metadata(TestMetadata._TEST_VALUES, index_values=True, track_changes=True)
+        metadata[5] = 2
+        unpickled = pickle.loads(pickle.dumps(metadata))
+        self.assertCountEqual(unpickled.get_keys_with_value(2), [1, 5])
+        self.assertIsNotNone(unpickled._journal)
+        self.assertIsNone(unpickled._frozen)
+
+    def test_pickle_with_highest_protocol(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.metadata, protocol=pickle.HIGHEST_PROTOCOL)), self.metadata)
+
+    def test_send_to_process(self):
+        self.metadata[5] = 6
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(dict, self.metadata).result(), {1: 2, 3: 4, 5: 6})
+
+    def test_copy_has_same_number_of_lock_stripes(self):
+        metadata = Metadata(TestMetadata._TEST_VALUES, lock_stripes=3)
+        self.assertEqual(copy.copy(metadata)._lock_stripes.number_of_stripes, 3)
+        self.assertEqual(copy.deepcopy(metadata)._lock_stripes.number_of_stripes, 3)
+
+    def test_init_with_invalid_number_of_lock_stripes(self):
+        self.assertRaises(ValueError, Metadata, lock_stripes=0)
+
+    def test_number_of_locks_is_bounded(self):
+        metadata = Metadata(lock_stripes=4)
+        for i in range(100):
+            metadata[i] = i
+            metadata.rename(i, -i - 1)
+        self.assertEqual(len(metadata), 100)
+        self.assertEqual(len(metadata._lock_stripes._locks), 4)
+
+    def test_rename_when_keys_share_lock_stripe(self):
+        metadata = Metadata(TestMetadata._TEST_VALUES, lock_stripes=1)
+        metadata.rename(1, 10)
+        self.assertEqual(metadata, Metadata({10: 2, 3: 4}))
+
+    def test_rename_in_opposite_directions_concurrently(self):
+        metadata = Metadata({"a": 1, "b": 2}, lock_stripes=2)
+
+        def rename(key: str, new_key: str):
+            for _ in range(1000):
+                try:
+                    metadata.rename(key, new_key)
+                except KeyError:
+                    pass
+
+        threads = [Thread(target=rename, args=("a", "b")), Thread(target=rename, args=("b", "a"))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(len(metadata), 1)
+
+    def test_update_many(self):
+        self.metadata.update_many({3: 5, 6: 7})
+        self.assertEqual(self.metadata, Metadata({1: 2, 3: 5, 6: 7}))
+
+    def test_update_many_with_items(self):
+        self.metadata.update_many([(6, 7)])
+        self.assertEqual(self.metadata, Metadata({1: 2, 3: 4, 6: 7}))
+
+    def test_delete_many(self):
+        self.metadata.delete_many([1, 10])
+        self.assertEqual(self.metadata, Metadata({3: 4}))
+
+    def test_transaction(self):
+        with self.metadata.transaction() as transaction:
+            transaction[5] = 6
+            del transaction[1]
+            self.assertNotIn(1, transaction)
+            self.assertEqual(transaction[5], 6)
+            self.assertEqual(transaction[3], 4)
+            self.assertEqual(self.metadata, Metadata(TestMetadata._TEST_VALUES))
+        self.assertEqual(self.metadata, Metadata({3: 4, 5: 6}))
+
+    def test_transaction_set_after_delete(self):
+        with self.metadata.transaction() as transaction:
+            del transaction[1]
+            transaction[1] = 10
+        self.assertEqual(self.metadata, Metadata({1: 10, 3: 4}))
+
+    def test_transaction_discarded_on_exception(self):
+        try:
+            with self.metadata.transaction() as transaction:
+                transaction[5] = 6
+                del transaction[1]
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(self.metadata, Metadata(TestMetadata._TEST_VALUES))
+
+    def test_readers_never_see_partial_batch(self):
+        metadata = Metadata({i: 0 for i in range(1000)})
+        finished = False
+        partial_reads = []
+
+        def read():
+            while not finished:
+                if len(set(metadata.values())) > 1:
+                    partial_reads.append(True)
+
+        reader = Thread(target=read)
+        reader.start()
+        for i in range(1, 50):
+            metadata.update_many({key: i for key in range(1000)})
+            with metadata.transaction() as transaction:
+                transaction.update({key: -i for key in range(1000)})
+                del transaction[1000]
+        finished = True
+        reader.join()
+        self.assertEqual(len(partial_reads), 0)
+
+    def test_readers_never_see_partial_deletions(self):
+        metadata = Metadata({i: 0 for i in range(1000)})
+        finished = False
+        partial_reads = []
+
+        def read():
+            while not finished:
+                if len(metadata) not in (0, 1000) or len(metadata.keys()) not in (0, 1000):
+                    partial_reads.append(True)
+
+        reader = Thread(target=read)
+        reader.start()
+        for _ in range(50):
+            metadata.delete_many(range(1000))
+            metadata.update_many({key: 0 for key in range(1000)})
+        finished = True
+        reader.join()
+        self.assertEqual(len(partial_reads), 0)
+
+    def test_readers_not_starved_by_batches(self):
+        metadata = Metadata({i: 0 for i in range(1000)})
+        finished = False
+
+        def change():
+            while not finished:
+                metadata.delete_many(range(1000))
+                metadata.update_many({key: 0 for key in range(1000)})
+
+        writers = [Thread(target=change) for _ in range(4)]
+        for writer in writers:
+            writer.start()
+        try:
+            for _ in range(100):
+                self.assertIn(len(metadata.keys()), (0, 1000))
+        finally:
+            finished = True
+            for writer in writers:
+                writer.join()
+
+    def test_readers_never_see_partial_rename(self):
+        metadata = Metadata({1: 2})
+        readers = []
+        reads = []
+
+        class ReadingOnDeletionDict(dict):
+            def __delitem__(self, key):
+                # Reading part way through the rename, once the item has been set with the new key
+                reader = Thread(target=lambda: reads.append(list(metadata.keys())))
+                reader.start()
+                readers.append(reader)
+                reader.join(timeout=0.1)
+                super().__delitem__(key)
+
+        metadata._data = ReadingOnDeletionDict(metadata._data)
+        metadata.rename(1, 10)
+        for reader in readers:
+            reader.join()
+        self.assertEqual(reads, [[10]])
+
+    def test_deletions_applied_in_place(self):
+        data = self.metadata._data
+        self.metadata.delete_many([1])
+        with self.metadata.transaction() as transaction:
+            transaction[5] = 6
+            del transaction[3]
+        self.assertIs(self.metadata._data, data)
+        self.assertEqual(self.metadata, Metadata({5: 6}))
+
+    def test_clear_releases_locks(self):
+        self.metadata.clear()
+        self.metadata[1] = 2
+        self.assertEqual(self.metadata, Metadata({1: 2}))
+
+    def test_freeze(self):
+        frozen = self.metadata.freeze()
+        self.assertEqual(frozen, FrozenMetadata(TestMetadata._TEST_VALUES))
+        self.assertIs(self.metadata.freeze(), frozen)
+
+    def test_freeze_after_change(self):
+        frozen = self.metadata.freeze()
+        self.metadata[5] = 6
+        self.assertEqual(frozen, FrozenMetadata(TestMetadata._TEST_VALUES))
+        self.assertEqual(self.metadata.freeze(), FrozenMetadata({1: 2, 3: 4, 5: 6}))
+
+    def test_freeze_after_each_kind_of_change(self):
+        self.metadata.freeze()
+        self.metadata[5] = 6
+        del self.metadata[1]
+        self.metadata.pop(3)
+        self.metadata.rename(5, 7)
+        self.metadata.update_many({8: 9, 10: 11})
+        self.metadata.delete_many([8])
+        with self.metadata.transaction() as transaction:
+            transaction[12] = 13
+            del transaction[10]
+        self.assertEqual(self.metadata.freeze(), FrozenMetadata({7: 6, 12: 13}))
+        self.metadata.clear()
+        self.assertEqual(self.metadata.freeze(), FrozenMetadata())
+
+    def test_freeze_shares_unchanged_structure(self):
+        metadata = Metadata({i: i for i in range(1000)})
+        frozen = metadata.freeze()
+        metadata[0] = -1
+        changed_frozen = metadata.freeze()
+        self.assertEqual(changed_frozen[0], -1)
+        self.assertEqual(frozen[0], 0)
+        shared_nodes = {id(node) for node in frozen._root.entries} & {id(node) for node in changed_frozen._root.entries}
+        self.assertGreater(len(shared_nodes), 0)
+
+    def test_freeze_after_more_changes_than_items(self):
+        self.metadata.freeze()
+        for i in range(5, 10):
+            self.metadata[i] = i
+            del self.metadata[i]
+        self.assertIsNone(self.metadata._frozen)
+        self.assertEqual(self.metadata.freeze(), FrozenMetadata(TestMetadata._TEST_VALUES))
+
+    def test_changes_not_applied_to_frozen_copy_until_frozen(self):
+        frozen = self.metadata.freeze()
+        self.metadata[5] = 6
+        del self.metadata[1]
+        self.assertIs(self.metadata._frozen, frozen)
+        self.assertEqual(self.metadata.freeze(), FrozenMetadata({3: 4, 5: 6}))
+
+    def test_freeze_after_pickled(self):
+        self.metadata.freeze()
+        unpickled = pickle.loads(pickle.dumps(self.metadata))
+        unpickled[5] = 6
+        self.assertEqual(unpickled.freeze(), FrozenMetadata({1: 2, 3: 4, 5: 6}))
+
+
+class TestMetadataValueQueries(unittest.TestCase):
+    """
+    Tests for finding keys by value in `Metadata`, with and without an index of values.
+    """
+    _TEST_VALUES = {"a": 1, "b": 2, "c": 2, "d": "x", "e": [1], "f": 1.5, "g": float("nan"), "h": (1, "x")}
+
+    def setUp(self):
+        self.metadata = Metadata(TestMetadataValueQueries._TEST_VALUES)
+        self.indexed_metadata = Metadata(TestMetadataValueQueries._TEST_VALUES, index_values=True)
+
+    def assertSameKeys(self, value: Any, comparison_operator: ComparisonOperator, expected_keys: Iterable[Any]):
+        for metadata in (self.metadata, self.indexed_metadata):
+            self.assertCountEqual(metadata.get_keys_with_value(value, comparison_operator), expected_keys)
+
+    def test_get_keys_with_equal_value(self):
+        self.assertSameKeys(2, ComparisonOperator.EQUALS, ["b", "c"])
+        self.assertSameKeys([1], ComparisonOperator.EQUALS, ["e"])
+        self.assertSameKeys(10, ComparisonOperator.EQUALS, [])
+
+    def test_get_keys_with_lesser_value(self):
+        self.assertSameKeys(2, ComparisonOperator.LESS_THAN, ["a", "f"])
+
+    def test_get_keys_with_greater_value(self):
+        self.assertSameKeys(1, ComparisonOperator.GREATER_THAN, ["b", "c", "f"])
+        self.assertSameKeys("a", ComparisonOperator.GREATER_THAN, ["d"])
+        self.assertSameKeys([0], ComparisonOperator.GREATER_THAN, ["e"])
+
+    def test_index_consistent_after_changes(self):
+        for metadata in (self.metadata, self.indexed_metadata):
+            metadata["a"] = 3
+            del metadata["b"]
+            metadata.pop("e")
+            metadata.rename("c", "f")
+            metadata.update_many({"i": 2, "d": 0})
+            metadata.delete_many(["h", "g"])
+            with metadata.transaction() as transaction:
+                transaction["j"] = 3
+                del transaction["i"]
+        self.assertSameKeys(2, ComparisonOperator.EQUALS, ["f"])
+        self.assertSameKeys(3, ComparisonOperator.EQUALS, ["a", "j"])
+        self.assertSameKeys(2, ComparisonOperator.GREATER_THAN, ["a", "j"])
+        self.assertSameKeys(2, ComparisonOperator.LESS_THAN, ["d"])
+        self.assertSameKeys("x", ComparisonOperator.EQUALS, [])
+        self.assertEqual(self.metadata, self.indexed_metadata)
+
+    def test_index_consistent_after_clear(self):
+        self.indexed_metadata.clear()
+        self.indexed_metadata["a"] = 0
+        self.assertEqual(self.indexed_metadata.get_keys_with_value(0), ["a"])
+        self.assertEqual(self.indexed_metadata.get_keys_with_value(1), [])
+
+    def test_index_consistent_under_concurrent_changes(self):
+        metadata = Metadata(index_values=True)
+
+        def change(offset: int):
+            for i in range(500):
+                metadata[offset + i] = i
+                metadata[offset + i] = i % 10
+                if i % 3 == 0:
+                    del metadata[offset + i]
+
+        threads = [Thread(target=change, args=(offset, )) for offset in range(0, 4000, 1000)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for value in range(10):
+            self.assertCountEqual(metadata.get_keys_with_value(value),
+                                  [key for key, other in metadata.items() if other == value])
+
+    def test_find(self):
+        for metadata in (self.metadata, self.indexed_metadata):
+            self.assertCountEqual(metadata.find(SearchCriterion(None, 1, ComparisonOperator.GREATER_THAN),
+                                                SearchCriterion(None, 2, ComparisonOperator.LESS_THAN)), ["f"])
+            self.assertEqual(metadata.find(SearchCriterion("a", 1, ComparisonOperator.EQUALS)), ["a"])
+            self.assertEqual(metadata.find(SearchCriterion("a", 0, ComparisonOperator.LESS_THAN)), [])
+            self.assertEqual(metadata.find(SearchCriterion("z", 0, ComparisonOperator.LESS_THAN)), [])
+            self.assertCountEqual(metadata.find(), TestMetadataValueQueries._TEST_VALUES.keys())
+
+    def test_copy_keeps_index(self):
+        self.assertIsNotNone(copy.copy(self.indexed_metadata)._value_index)
+        self.assertIsNotNone(copy.deepcopy(self.indexed_metadata)._value_index)
+
+
+class TestMetadataDiff(unittest.TestCase):
+    """
+    Tests for finding and applying the differences between `Metadata`.
+    """
+    _TEST_VALUES = {1: 2, 3: 4, 5: 6}
+
+    def setUp(self):
+        self.metadata = Metadata(TestMetadataDiff._TEST_VALUES, track_changes=True)
+
+    def _change(self, metadata: Metadata):
+        metadata[1] = 20
+        metadata[7] = 8
+        del metadata[3]
+        metadata[5] = 0
+        metadata[5] = 6
+
+    def test_diff_with_equal(self):
+        self.assertEqual(self.metadata.diff(copy.copy(self.metadata)), MetadataPatch())
+
+    def test_diff_with_unrelated(self):
+        other = Metadata({1: 20, 5: 6, 7: 8})
+        self.assertEqual(self.metadata.diff(other), MetadataPatch({7: 8}, {1: 20}, {3}))
+        self.assertEqual(other.diff(self.metadata), MetadataPatch({3: 4}, {1: 2}, {7}))
+
+    def test_diff_with_copy(self):
+        other = copy.copy(self.metadata)
+        self._change(other)
+        self.assertEqual(self.metadata.diff(other), MetadataPatch({7: 8}, {1: 20}, {3}))
+        self.assertEqual(other.diff(self.metadata), MetadataPatch({3: 4}, {1: 2}, {7}))
+
+    def test_diff_with_changed_original(self):
+        other = copy.deepcopy(self.metadata)
+        self._change(self.metadata)
+        self.assertEqual(other.diff(self.metadata), MetadataPatch({7: 8}, {1: 20}, {3}))
+
+    def test_diff_between_copies(self):
+        copy_1 = copy.copy(self.metadata)
+        self.metadata[9] = 10
+        copy_2 = copy.copy(self.metadata)
+        copy_3 = copy.copy(copy_2)
+        self._change(copy_1)
+        copy_3.pop(1)
+        self.assertEqual(copy_1.diff(copy_3), MetadataPatch({9: 10, 3: 4}, {}, {1, 7}))
+
+    def test_diff_only_compares_changed_keys(self):
+        metadata = Metadata({i: i for i in range(1000)}, track_changes=True)
+        other = copy.copy(metadata)
+        other[0] = -1
+        keys = []
+        original_get = dict.get
+
+        class RecordingDict(dict):
+            def get(self, key, default=None):
+                keys.append(key)
+                return original_get(self, key, default)
+
+        other._data = RecordingDict(other._data)
+        self.assertEqual(metadata.diff(other), MetadataPatch(changed={0: -1}))
+        self.assertEqual(keys, [0])
+
+    def test_diff_when_tracked_changes_forgotten(self):
+        metadata = Metadata(TestMetadataDiff._TEST_VALUES, track_changes=True, max_tracked_changes=2)
+        other = copy.copy(metadata)
+        self._change(other)
+        self.assertEqual(metadata.diff(other), MetadataPatch({7: 8}, {1: 20}, {3}))
+
+    def test_apply_patch(self):
+        other = copy.copy(self.metadata)
+        self._change(other)
+        self.metadata.apply_patch(self.metadata.diff(other))
+        self.assertEqual(self.metadata, other)
+        self.assertEqual(self.metadata.diff(other), MetadataPatch())
+
+
+class _CollidingKey:
+    """
+    Key where all instances have the same hash.
+    """
+    def __init__(self, name: str):
+        self.name = name
+
+    def __hash__(self) -> int:
+        return 1
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, _CollidingKey) and other.name == self.name
+
+
+class TestFrozenMetadata(unittest.TestCase):
+    """
+    Tests for `FrozenMetadata`.
+    """
+    _TEST_VALUES = {1: 2, 3: 4}
+
+    def setUp(self):
+        self.metadata = FrozenMetadata(TestFrozenMetadata._TEST_VALUES)
+
+    def test_init_with_no_values(self):
+        self.assertEqual(len(FrozenMetadata()), 0)
+
+    def test_init_with_values(self):
+        self.assertEqual(dict(self.metadata), TestFrozenMetadata._TEST_VALUES)
+
+    def test_get(self):
+        self.assertEqual(self.metadata[1], 2)
+        self.assertEqual(self.metadata.get(1), 2)
+        self.assertIsNone(self.metadata.get(10))
+        self.assertRaises(KeyError, self.metadata.__getitem__, 10)
+
+    def test_set(self):
+        modified = self.metadata.set(5, 6)
+        self.assertEqual(dict(modified), {1: 2, 3: 4, 5: 6})
+        self.assertEqual(dict(self.metadata), TestFrozenMetadata._TEST_VALUES)
+
+    def test_set_same_value(self):
+        self.assertIs(self.metadata.set(1, 2), self.metadata)
+
+    def test_update(self):
+        self.assertEqual(dict(self.metadata.update({1: 10, 5: 6})), {1: 10, 3: 4, 5: 6})
+
+    def test_delete(self):
+        modified = self.metadata.delete(1)
+        self.assertEqual(dict(modified), {3: 4})
+        self.assertEqual(len(modified.delete(3)), 0)
+        self.assertRaises(KeyError, self.metadata.delete, 10)
+
+    def test_many_items(self):
+        values = {"key_%d" % i: i for i in range(5000)}
+        metadata = FrozenMetadata(values)
+        self.assertEqual(len(metadata), len(values))
+        self.assertEqual(dict(metadata), values)
+        for i in range(0, 5000, 2):
+            metadata = metadata.delete("key_%d" % i)
+        self.assertEqual(dict(metadata), {key: value for key, value in values.items() if value % 2 == 1})
+
+    def test_colliding_keys(self):
+        keys = [_CollidingKey(str(i)) for i in range(3)]
+        metadata = FrozenMetadata({key: i for i, key in enumerate(keys)}).set(10, 10)
+        self.assertEqual(len(metadata), 4)
+        self.assertEqual(metadata[_CollidingKey("1")], 1)
+        metadata = metadata.delete(keys[0]).delete(keys[2])
+        self.assertEqual(dict(metadata), {keys[1]: 1, 10: 10})
+        self.assertNotIn(keys[0], metadata)
+
+    def test_structure_shared_with_modified_version(self):
+        metadata = FrozenMetadata({i: i for i in range(1000)})
+        modified = metadata.set(0, -1)
+        shared = set(map(id, metadata._root.entries)) & set(map(id, modified._root.entries))
+        self.assertEqual(len(shared), len(metadata._root.entries) - 1)
+
+    def test_hashable(self):
+        self.assertEqual(hash(self.metadata), hash(FrozenMetadata(TestFrozenMetadata._TEST_VALUES)))
+        self.assertIn(FrozenMetadata(TestFrozenMetadata._TEST_VALUES), {self.metadata})
+
+    def test_eq_when_equal(self):
+        self.assertEqual(self.metadata, FrozenMetadata({3: 4}).set(1, 2))
+
+    def test_eq_when_not_equal(self):
+        self.assertNotEqual(self.metadata, FrozenMetadata({1: 2, 3: 5}))
+        self.assertNotEqual(self.metadata, Metadata(TestFrozenMetadata._TEST_VALUES))
+
+    def test_copy(self):
+        self.assertIs(copy.copy(self.metadata), self.metadata)
+
+    def test_deepcopy(self):
+        self.assertEqual(copy.deepcopy(self.metadata), self.metadata)
+
+    def test_thaw(self):
+        metadata = self.metadata.thaw()
+        self.assertEqual(metadata, Metadata(TestFrozenMetadata._TEST_VALUES))
+        self.assertIs(metadata.freeze(), self.metadata)
+        metadata[1] = 10
+        self.assertEqual(self.metadata[1], 2)
+
+    def test_pickle(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.metadata)), self.metadata)
+
+
+class TestMultiMetadata(unittest.TestCase):
+    """
+    Tests for `MultiMetadata`.
+    """
+    _TEST_VALUES = {"a": [1, 2], "b": [3]}
+
+    def setUp(self):
+        self.metadata = MultiMetadata(TestMultiMetadata._TEST_VALUES)
+
+    def test_init_with_no_values(self):
+        self.assertEqual(len(MultiMetadata()), 0)
+
+    def test_init_with_pairs(self):
+        self.assertEqual(MultiMetadata([("a", 1), ("b", 3), ("a", 2), ("a", 1)]), self.metadata)
+
+    def test_get(self):
+        self.assertEqual(self.metadata["a"], (1, 2))
+        self.assertRaises(KeyError, self.metadata.__getitem__, "c")
+
+    def test_add(self):
+        self.assertTrue(self.metadata.add("a", 0))
+        self.assertTrue(self.metadata.add("c", 4))
+        self.assertEqual(self.metadata["a"], (1, 2, 0))
+        self.assertEqual(self.metadata["c"], (4, ))
+
+    def test_add_existing(self):
+        self.assertFalse(self.metadata.add("a", 1))
+        self.assertEqual(self.metadata["a"], (1, 2))
+
+    def test_remove(self):
+        self.metadata.remove("a", 1)
+        self.metadata.remove("b", 3)
+        self.assertEqual(self.metadata, MultiMetadata({"a": [2]}))
+
+    def test_remove_non_existent(self):
+        self.assertRaises(KeyError, self.metadata.remove, "a", 3)
+        self.assertRaises(KeyError, self.metadata.remove, "c", 1)
+
+    def test_discard(self):
+        self.metadata.discard("a", 1)
+        self.metadata.discard("a", 3)
+        self.assertEqual(self.metadata["a"], (2, ))
+
+    def test_contains(self):
+        self.assertTrue(self.metadata.contains("a", 1))
+        self.assertFalse(self.metadata.contains("a", 3))
+        self.assertFalse(self.metadata.contains("c", 1))
+        self.assertIn("a", self.metadata)
+
+    def test_pairs(self):
+        self.assertCountEqual(self.metadata.pairs(), [("a", 1), ("a", 2), ("b", 3)])
+
+    def test_delete(self):
+        del self.metadata["a"]
+        self.assertEqual(self.metadata, MultiMetadata({"b": [3]}))
+
+    def test_update(self):
+        self.metadata.update(MultiMetadata({"a": [2, 5], "c": [6]}))
+        self.assertEqual(self.metadata["a"], (1, 2, 5))
+        self.assertEqual(self.metadata["c"], (6, ))
+
+    def test_difference_update(self):
+        self.metadata.difference_update([("a", 2), ("b", 3), ("c", 1)])
+        self.assertEqual(self.metadata, MultiMetadata({"a": [1]}))
+
+    def test_union(self):
+        union = self.metadata.union({"b": [4]})
+        self.assertEqual(union, MultiMetadata({"a": [1, 2], "b": [3, 4]}))
+        self.assertEqual(self.metadata, MultiMetadata(TestMultiMetadata._TEST_VALUES))
+
+    def test_difference(self):
+        difference = self.metadata.difference({"a": [1, 2]})
+        self.assertEqual(difference, MultiMetadata({"b": [3]}))
+        self.assertEqual(self.metadata, MultiMetadata(TestMultiMetadata._TEST_VALUES))
+
+    def test_clear(self):
+        self.metadata.clear()
+        self.assertEqual(len(self.metadata), 0)
+
+    def test_copy(self):
+        metadata_copy = copy.copy(self.metadata)
+        self.assertEqual(metadata_copy, self.metadata)
+        metadata_copy.add("a", 10)
+        self.assertFalse(self.metadata.contains("a", 10))
+
+    def test_deepcopy(self):
+        self.assertEqual(copy.deepcopy(self.metadata), self.metadata)
+
+    def test_pickle(self):
+        self.metadata.add("c", 1)
+        self.assertEqual(pickle.loads(pickle.dumps(self.metadata)), self.metadata)
+
+    def test_concurrent_adds(self):
+        metadata = MultiMetadata(lock_stripes=2)
+
+        def add(offset: int):
+            for i in range(1000):
+                metadata.add(i % 10, offset + i)
+
+        threads = [Thread(target=add, args=(offset, )) for offset in range(0, 4000, 1000)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(metadata.pairs()), 4000)
+
+
+class TestShardedDict(unittest.TestCase):
+    """
+    Tests for `ShardedDict`.
+    """
+    _TEST_VALUES = {i: str(i) for i in range(100)}
+
+    def setUp(self):
+        self.sharded_dict = ShardedDict(TestShardedDict._TEST_VALUES, shards=4)
+
+    def test_init_with_invalid_number_of_shards(self):
+        self.assertRaises(ValueError, ShardedDict, shards=0)
+
+    def test_init_with_values(self):
+        self.assertEqual(dict(self.sharded_dict), TestShardedDict._TEST_VALUES)
+        self.assertEqual(len(self.sharded_dict), len(TestShardedDict._TEST_VALUES))
+
+    def test_get_set_and_delete(self):
+        self.sharded_dict["a"] = 1
+        self.assertEqual(self.sharded_dict["a"], 1)
+        self.assertEqual(self.sharded_dict.get("b", 2), 2)
+        del self.sharded_dict["a"]
+        self.assertNotIn("a", self.sharded_dict)
+        self.assertRaises(KeyError, self.sharded_dict.__getitem__, "a")
+
+    def test_pop(self):
+        self.assertEqual(self.sharded_dict.pop(1), "1")
+        self.assertIsNone(self.sharded_dict.pop(1, None))
+        self.assertRaises(KeyError, self.sharded_dict.pop, 1)
+
+    def test_compute_if_absent(self):
+        self.assertEqual(self.sharded_dict.compute_if_absent(1, lambda key: "other"), "1")
+        self.assertEqual(self.sharded_dict.compute_if_absent("a", lambda key: key * 2), "aa")
+        self.assertEqual(self.sharded_dict["a"], "aa")
+
+    def test_compute_if_absent_is_atomic(self):
+        created = []
+
+        def factory(key: Any) -> object:
+            sleep(0.05)
+            value = object()
+            created.append(value)
+            return value
+
+        threads = [Thread(target=self.sharded_dict.compute_if_absent, args=("a", factory)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(created), 1)
+        self.assertIs(self.sharded_dict["a"], created[0])
+
+    def test_compute_if_present(self):
+        self.assertEqual(self.sharded_dict.compute_if_present(1, lambda key, value: value * 2), "11")
+        self.assertEqual(self.sharded_dict[1], "11")
+        self.assertIsNone(self.sharded_dict.compute_if_present("a", lambda key, value: value * 2))
+        self.assertNotIn("a", self.sharded_dict)
+
+    def test_compute_if_present_removes_when_none(self):
+        self.assertIsNone(self.sharded_dict.compute_if_present(1, lambda key, value: None))
+        self.assertNotIn(1, self.sharded_dict)
+
+    def test_concurrent_compute_if_present(self):
+        self.sharded_dict["count"] = 0
+
+        def increment():
+            for _ in range(1000):
+                self.sharded_dict.compute_if_present("count", lambda key, value: value + 1)
+
+        threads = [Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.sharded_dict["count"], 4000)
+
+    def test_update(self):
+        self.sharded_dict.update({1: "a", "b": 2}, c=3)
+        self.assertEqual(self.sharded_dict[1], "a")
+        self.assertEqual(self.sharded_dict["b"], 2)
+        self.assertEqual(self.sharded_dict["c"], 3)
+
+    def test_snapshot(self):
+        snapshot = self.sharded_dict.snapshot()
+        self.sharded_dict[1] = "changed"
+        self.assertEqual(snapshot, TestShardedDict._TEST_VALUES)
+
+    def test_iterate_whilst_changing(self):
+        keys = []
+        for key in self.sharded_dict:
+            keys.append(key)
+            self.sharded_dict[key + 1000] = None
+        self.assertTrue(set(TestShardedDict._TEST_VALUES.keys()).issubset(keys))
+
+    def test_clear(self):
+        self.sharded_dict.clear()
+        self.assertEqual(len(self.sharded_dict), 0)
+
+    def test_copy(self):
+        sharded_dict_copy = copy.copy(self.sharded_dict)
+        self.assertEqual(sharded_dict_copy, self.sharded_dict)
+        sharded_dict_copy[1] = "changed"
+        self.assertEqual(self.sharded_dict[1], "1")
+
+    def test_deepcopy(self):
+        self.assertEqual(copy.deepcopy(self.sharded_dict), self.sharded_dict)
+
+    def test_pickle(self):
+        self.sharded_dict["lock"] = Lock()
+        unpickled = pickle.loads(pickle.dumps(self.sharded_dict))
+        self.assertEqual(len(unpickled), len(self.sharded_dict))
+        self.assertFalse(unpickled["lock"].locked())
+        unpickled["a"] = 1
+        self.assertEqual(unpickled["a"], 1)
+
+
+class TestMetadataTable(unittest.TestCase):
+    """
+    Tests for `MetadataTable`.
+    """
+    _TEST_RECORDS = [
+        {"name": "a", "size": 10, "score": 0.5},
+        {"name": "b", "size": 20, "tags": ["x"]},
+        {"name": "a", "size": 30, "score": 1.5},
+        {"size": 40, "score": 2.5}
+    ]
+
+    def setUp(self):
+        self.table = MetadataTable(Metadata(record) for record in TestMetadataTable._TEST_RECORDS)
+
+    def _find_indices(self, *search_criteria: SearchCriterion) -> List[int]:
+        return self.table.get_indices(self.table.get_mask(*search_criteria))
+
+    def test_init_with_no_records(self):
+        self.assertEqual(len(MetadataTable()), 0)
+
+    def test_get_record(self):
+        self.assertEqual(len(self.table), len(TestMetadataTable._TEST_RECORDS))
+        for i, record in enumerate(TestMetadataTable._TEST_RECORDS):
+            self.assertEqual(self.table[i], Metadata(record))
+        self.assertEqual(self.table[-1], Metadata(TestMetadataTable._TEST_RECORDS[-1]))
+        self.assertRaises(IndexError, self.table.__getitem__, len(TestMetadataTable._TEST_RECORDS))
+
+    def test_keys(self):
+        self.assertCountEqual(self.table.keys(), ["name", "size", "score", "tags"])
+
+    def test_get_column(self):
+        self.assertEqual(self.table.get_column("name"), ["a", "b", "a", None])
+        self.assertEqual(self.table.get_column("other", 0), [0, 0, 0, 0])
+
+    def test_columns_stored_compactly(self):
+        self.assertEqual(self.table._columns["size"].values.typecode, "q")
+        self.assertEqual(self.table._columns["score"].values.typecode, "d")
+        self.assertEqual(self.table._columns["name"].strings, ["a", "b"])
+
+    def test_many_distinct_strings(self):
+        table = MetadataTable({"name": str(i)} for i in range(1000))
+        self.assertEqual(table.get_column("name"), [str(i) for i in range(1000)])
+        self.assertEqual(table.get_indices(table.get_mask(SearchCriterion("name", "999", ComparisonOperator.EQUALS))),
+                         [999])
+
+    def test_values_not_changed_when_column_has_mixed_types(self):
+        self.table.append({"size": 1.5, "score": 2 ** 70, "name": 1})
+        self.assertEqual(self.table.get_column("size"), [10, 20, 30, 40, 1.5])
+        self.assertIsInstance(self.table[0]["size"], int)
+        self.assertEqual(self.table[4], Metadata({"size": 1.5, "score": 2 ** 70, "name": 1}))
+
+    def test_large_column_with_mixed_types(self):
+        values = [(i, str(i), i / 2, None)[i % 4] for i in range(100000)]
+        table = MetadataTable({"value": value} for value in values)
+        self.assertIsInstance(table._columns["value"].values, list)
+        self.assertEqual(table.get_column("value"), values)
+
+    def test_get_mask(self):
+        self.assertEqual(self.table.get_mask(SearchCriterion("size", 20, ComparisonOperator.GREATER_THAN)),
+                         bytearray([0, 0, 1, 1]))
+
+    def test_find_with_equals(self):
+        self.assertEqual(self._find_indices(SearchCriterion("name", "a", ComparisonOperator.EQUALS)), [0, 2])
+        self.assertEqual(self._find_indices(SearchCriterion("size", 20, ComparisonOperator.EQUALS)), [1])
+        self.assertEqual(self._find_indices(SearchCriterion("tags", ["x"], ComparisonOperator.EQUALS)), [1])
+        self.assertEqual(self._find_indices(SearchCriterion("other", 1, ComparisonOperator.EQUALS)), [])
+
+    def test_find_with_less_than(self):
+        self.assertEqual(self._find_indices(SearchCriterion("score", 2, ComparisonOperator.LESS_THAN)), [0, 2])
+        self.assertEqual(self._find_indices(SearchCriterion("name", "b", ComparisonOperator.LESS_THAN)), [0, 2])
+
+    def test_find_with_greater_than(self):
+        self.assertEqual(self._find_indices(SearchCriterion("size", 20, ComparisonOperator.GREATER_THAN)), [2, 3])
+
+    def test_find_with_incomparable_value(self):
+        self.assertEqual(self._find_indices(SearchCriterion("size", "a", ComparisonOperator.GREATER_THAN)), [])
+
+    def test_find_with_multiple_criteria(self):
+        self.assertEqual(self._find_indices(SearchCriterion("name", "a", ComparisonOperator.EQUALS),
+                                            SearchCriterion("size", 20, ComparisonOperator.GREATER_THAN)), [2])
+
+    def test_find_with_any_attribute(self):
+        self.assertEqual(self._find_indices(SearchCriterion(None, 25, ComparisonOperator.GREATER_THAN)), [2, 3])
+
+    def test_find(self):
+        self.assertEqual(list(self.table.find(SearchCriterion("score", 1, ComparisonOperator.GREATER_THAN))),
+                         [Metadata(TestMetadataTable._TEST_RECORDS[2]), Metadata(TestMetadataTable._TEST_RECORDS[3])])
+
 
 if __name__ == "__main__":
     unittest.main()
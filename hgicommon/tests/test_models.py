@@ -21,9 +21,16 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import copy
+import pickle
+import tracemalloc
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
+from hgicommon.collections import Metadata
+from hgicommon.enums import ComparisonOperator
+from hgicommon.models import Model, SlottedModel, SearchCriterion, ModelSerialiser, get_serialiser, \
+    InterningCache
 from hgicommon.tests._stubs import StubModel
 
 
@@ -70,6 +77,382 @@ class TestModel(unittest.TestCase):
         string_representation = repr(self._model)
         self.assertTrue(isinstance(string_representation, str))
 
+    def test_equal_when_property_differs(self):
+        model = copy.copy(self._model)
+        model.property_1 = 2
+        self.assertNotEqual(self._model, model)
+
+    def test_equal_when_different_properties(self):
+        model = copy.copy(self._model)
+        del model.property_1
+        model.property_5 = 1
+        self.assertNotEqual(self._model, model)
+        self.assertEqual(model, copy.copy(model))
+
+    def test_hash_of_equal_models(self):
+        self.assertEqual(hash(self._model), hash(copy.copy(self._model)))
+
+    def test_hash_of_different_models(self):
+        model = copy.copy(self._model)
+        model.property_2 = "b"
+        self.assertNotEqual(hash(self._model), hash(model))
+
+    def test_hash_when_different_properties(self):
+        model = StubModel()
+        model.property_1 = {"a": [1, 2]}
+        self.assertEqual(hash(model), hash(copy.copy(model)))
+
+    def test_can_be_set_member(self):
+        models = {self._model, copy.copy(self._model)}
+        self.assertEqual(len(models), 1)
+
+    def test_hash_with_unhashable_property_values(self):
+        model = _StubPlainModel(Metadata({"a": 1, "b": [2]}), _StubUnhashable())
+        self.assertEqual(hash(model), hash(_StubPlainModel(Metadata({"b": [2], "a": 1}), _StubUnhashable())))
+        self.assertEqual(len({model, copy.copy(model)}), 1)
+        self.assertNotEqual(hash(model), hash(_StubPlainModel(Metadata({"a": 2, "b": [2]}), _StubUnhashable())))
+        slotted_model = _StubSlottedModel(Metadata({"a": 1}), _StubUnhashable())
+        self.assertEqual(hash(slotted_model), hash(_StubSlottedModel(Metadata({"a": 1}), _StubUnhashable())))
+
+    def test_subclass_equality(self):
+        model = _StubModelSubclass(1)
+        self.assertEqual(model, _StubModelSubclass(1))
+        self.assertNotEqual(model, _StubModelSubclass(2))
+        self.assertEqual(hash(model), hash(_StubModelSubclass(1)))
+
+    def test_subclass_with_own_equality(self):
+        model = _StubModelWithOwnEquality(1)
+        self.assertEqual(model, _StubModelWithOwnEquality(1))
+        self.assertNotEqual(model, _StubModelWithOwnEquality(2))
+        self.assertEqual(_StubModelWithOwnEquality.equality_checks, 2)
+
+
+class TestModelWithCachedHash(unittest.TestCase):
+    """
+    Test cases for `Model` subclasses that cache their hash.
+    """
+    def setUp(self):
+        self._model = _StubModelWithCachedHash([1, 2])
+
+    def test_hash_cached(self):
+        model_hash = hash(self._model)
+        self.assertEqual(hash(self._model), model_hash)
+        self.assertEqual(vars(self._model)["_Model__hash"], model_hash)
+
+    def test_hash_discarded_when_property_set(self):
+        hash(self._model)
+        self._model.value = [3]
+        self.assertEqual(hash(self._model), hash(_StubModelWithCachedHash([3])))
+
+    def test_equal_when_hash_cached(self):
+        hash(self._model)
+        self.assertEqual(self._model, _StubModelWithCachedHash([1, 2]))
+        self.assertEqual(_StubModelWithCachedHash([1, 2]), self._model)
+
+    def test_cached_hash_not_copied(self):
+        hash(self._model)
+        for model in (copy.copy(self._model), copy.deepcopy(self._model), pickle.loads(pickle.dumps(self._model))):
+            self.assertEqual(model, self._model)
+            self.assertNotIn("_Model__hash", vars(model))
+
+    def test_string_representation_excludes_cached_hash(self):
+        hash(self._model)
+        self.assertNotIn("hash", str(self._model))
+
+
+class TestSlottedModel(unittest.TestCase):
+    """
+    Test cases for `SlottedModel`.
+    """
+    def setUp(self):
+        self._model = _StubSlottedModel(1, [2, 3])
+
+    def test_no_instance_dictionary(self):
+        self.assertFalse(hasattr(self._model, "__dict__"))
+        self.assertRaises(AttributeError, setattr, self._model, "other", 1)
+
+    def test_equal(self):
+        self.assertEqual(self._model, _StubSlottedModel(1, [2, 3]))
+        self.assertNotEqual(self._model, _StubSlottedModel(1, [2]))
+        self.assertNotEqual(self._model, _StubModelSubclass(1))
+        self.assertNotEqual(self._model, None)
+
+    def test_equal_when_property_not_set(self):
+        model = _StubSlottedModel(1, [2, 3])
+        del model.property_2
+        self.assertNotEqual(self._model, model)
+        self.assertEqual(model, copy.copy(model))
+
+    def test_hash_of_equal_models(self):
+        self.assertEqual(hash(self._model), hash(_StubSlottedModel(1, [2, 3])))
+        self.assertEqual(len({self._model, _StubSlottedModel(1, [2, 3])}), 1)
+
+    def test_string_representation(self):
+        self.assertEqual(str(self._model), str(_StubPlainModel(1, [2, 3])))
+        self.assertIn(str(self._model), repr(self._model))
+
+    def test_fields_inherited(self):
+        model = _StubSlottedModelSubclass(1, [2, 3], 4)
+        self.assertEqual(_StubSlottedModelSubclass.__slots__, ("property_3", "_Model__hash"))
+        self.assertEqual(str(model), "{ property_1: 1, property_2: [2, 3], property_3: 4 }")
+        self.assertNotEqual(model, _StubSlottedModelSubclass(1, [2, 3], 5))
+        self.assertNotEqual(self._model, model)
+
+    def test_hash_cached(self):
+        model = _StubSlottedModelSubclass(1, [2, 3], 4)
+        model_hash = hash(model)
+        self.assertEqual(getattr(model, "_Model__hash"), model_hash)
+        model.property_3 = 5
+        self.assertEqual(hash(model), hash(_StubSlottedModelSubclass(1, [2, 3], 5)))
+
+    def test_copy_and_pickle(self):
+        self.assertEqual(copy.deepcopy(self._model), self._model)
+        self.assertEqual(pickle.loads(pickle.dumps(self._model)), self._model)
+
+    def test_cached_hash_not_copied(self):
+        model = _StubSlottedModelSubclass(1, [2, 3], 4)
+        hash(model)
+        for copied in (copy.copy(model), pickle.loads(pickle.dumps(model)), pickle.loads(pickle.dumps(model, 0))):
+            self.assertEqual(copied, model)
+            self.assertFalse(hasattr(copied, "_Model__hash"))
+
+    def test_uses_less_memory_than_model(self):
+        number_of_models = 10000
+        tracemalloc.start()
+        try:
+            plain_models = [_StubPlainModel(None, None) for _ in range(number_of_models)]
+            plain_memory = tracemalloc.get_traced_memory()[0]
+            slotted_models = [_StubSlottedModel(None, None) for _ in range(number_of_models)]
+            slotted_memory = tracemalloc.get_traced_memory()[0] - plain_memory
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(plain_models), len(slotted_models))
+        self.assertLess(slotted_memory, plain_memory * 0.75)
+
+
+class TestModelSerialiser(unittest.TestCase):
+    """
+    Test cases for `ModelSerialiser`.
+    """
+    def setUp(self):
+        self._serialiser = ModelSerialiser(SearchCriterion)
+        self._models = [SearchCriterion("attribute_%d" % i, i, ComparisonOperator.LESS_THAN) for i in range(10)]
+        self._model = self._models[0]
+
+    def test_fields_from_constructor(self):
+        self.assertEqual(self._serialiser.fields, ("attribute", "value", "comparison_operator"))
+
+    def test_fields_of_slotted_model(self):
+        self.assertEqual(ModelSerialiser(_StubSlottedModelSubclass).fields, ("property_1", "property_2", "property_3"))
+
+    def test_encode(self):
+        self.assertEqual(self._serialiser.encode(self._model), ("attribute_0", 0, "LESS_THAN"))
+        self.assertEqual(self._serialiser.decode(("attribute_0", 0, "LESS_THAN")), self._model)
+
+    def test_encode_many(self):
+        rows = self._serialiser.encode_many(self._models)
+        self.assertEqual(len(rows), len(self._models))
+        self.assertEqual(self._serialiser.decode_many(rows), self._models)
+
+    def test_to_dict(self):
+        serialised = self._serialiser.to_dict(self._model)
+        self.assertEqual(serialised, {"attribute": "attribute_0", "value": 0, "comparison_operator": "LESS_THAN"})
+        self.assertEqual(self._serialiser.from_dict(serialised), self._model)
+
+    def test_to_json(self):
+        self.assertEqual(self._serialiser.from_json(self._serialiser.to_json(self._model)), self._model)
+        self.assertEqual(self._serialiser.from_json_many(self._serialiser.to_json_many(self._models)), self._models)
+
+    def test_to_bytes(self):
+        self.assertEqual(self._serialiser.from_bytes(self._serialiser.to_bytes(self._model)), self._model)
+        self.assertEqual(self._serialiser.from_bytes_many(self._serialiser.to_bytes_many(self._models)), self._models)
+
+    def test_from_bytes_when_invalid(self):
+        self.assertRaises(ValueError, self._serialiser.from_bytes, b"")
+        self.assertRaises(ValueError, self._serialiser.from_bytes, b"invalid" * 10)
+        self.assertRaises(ValueError, self._serialiser.from_bytes, self._serialiser.to_bytes_many(self._models))
+
+    def test_from_serialised_with_other_fields(self):
+        serialiser = ModelSerialiser(SearchCriterion, ("attribute", "value"))
+        self.assertRaises(ValueError, self._serialiser.from_bytes_many, serialiser.to_bytes_many(self._models))
+        self.assertRaises(ValueError, self._serialiser.from_json_many, serialiser.to_json_many(self._models))
+
+    def test_slotted_model(self):
+        serialiser = ModelSerialiser(_StubSlottedModelSubclass)
+        model = _StubSlottedModelSubclass(1, [2, 3], None)
+        self.assertEqual(serialiser.from_bytes(serialiser.to_bytes(model)), model)
+        self.assertEqual(serialiser.from_dict(serialiser.to_dict(model)), model)
+
+    def test_get_serialiser(self):
+        serialiser = get_serialiser(SearchCriterion)
+        self.assertIs(get_serialiser(SearchCriterion), serialiser)
+        self.assertIsNot(get_serialiser(SearchCriterion, ("attribute", )), serialiser)
+
+
+class TestInterningCache(unittest.TestCase):
+    """
+    Test cases for `InterningCache`.
+    """
+    def setUp(self):
+        self._cache = InterningCache(SearchCriterion, max_size=3)
+
+    def test_create(self):
+        model = self._cache.create("attribute", 1, ComparisonOperator.LESS_THAN)
+        self.assertEqual(model, SearchCriterion("attribute", 1, ComparisonOperator.LESS_THAN))
+        self.assertIs(self._cache.create("attribute", 1, ComparisonOperator.LESS_THAN), model)
+        self.assertIs(self._cache.create("attribute", 1, comparison_operator=ComparisonOperator.LESS_THAN), model)
+        self.assertIsNot(self._cache.create("attribute", 2, ComparisonOperator.LESS_THAN), model)
+
+    def test_create_with_equal_arguments_of_different_types(self):
+        models = [self._cache.create("attribute", value) for value in (1, 1.0, True)]
+        self.assertEqual([type(model.value) for model in models], [int, float, bool])
+        models = [self._cache.create("attribute", value=value) for value in (1, 1.0, True)]
+        self.assertEqual([type(model.value) for model in models], [int, float, bool])
+
+    def test_intern_equal_models_with_values_of_different_types(self):
+        models = [SearchCriterion("attribute", value) for value in (1, 1.0, True)]
+        for model in models:
+            self.assertIs(self._cache.intern(model), model)
+        models = [SearchCriterion("attribute", [value]) for value in (1, 1.0, True)]
+        for model in models:
+            self.assertIs(self._cache.intern(model), model)
+
+    def test_create_with_unhashable_arguments(self):
+        model = self._cache.create("attribute", [1])
+        self.assertIs(self._cache.create("attribute", [1]), model)
+        self.assertIsNot(self._cache.create("attribute", (1, )), model)
+
+    def test_create_with_unhashable_field_values(self):
+        metadata = Metadata({"a": 1})
+        model = self._cache.create("attribute", metadata)
+        self.assertIs(model.value, metadata)
+        self.assertIsNot(self._cache.create("attribute", metadata), model)
+        self.assertIs(self._cache.intern(model), model)
+        self.assertNotIn(model, self._cache)
+        self.assertEqual(len(self._cache), 0)
+        self.assertEqual(self._cache.bypasses, 3)
+        self.assertEqual(self._cache.hits + self._cache.misses, 0)
+
+    def test_intern(self):
+        model = SearchCriterion("attribute", 1)
+        self.assertIs(self._cache.intern(model), model)
+        self.assertIs(self._cache.intern(SearchCriterion("attribute", 1)), model)
+        self.assertIn(model, self._cache)
+        self.assertNotIn(SearchCriterion("attribute", 1), self._cache)
+
+    def test_least_recently_used_removed(self):
+        model = self._cache.create("attribute", 0)
+        for i in range(1, 3):
+            self._cache.create("attribute", i)
+        self._cache.create("attribute", 0)
+        for i in range(3, 5):
+            self._cache.create("attribute", i)
+        self.assertLessEqual(len(self._cache), 3)
+        self.assertGreater(self._cache.evictions, 0)
+        self.assertIs(self._cache.create("attribute", 0), model)
+
+    def test_statistics(self):
+        self.assertEqual(self._cache.hit_rate, 0.0)
+        for _ in range(4):
+            self._cache.create("attribute", 1)
+        self.assertEqual(self._cache.misses, 1)
+        self.assertEqual(self._cache.hits, 3)
+        self.assertEqual(self._cache.hit_rate, 0.75)
+        self.assertGreater(self._cache.estimated_bytes_saved, 0)
+
+    def test_clear(self):
+        model = self._cache.create("attribute", 1)
+        self._cache.clear()
+        self.assertEqual(len(self._cache), 0)
+        self.assertIsNot(self._cache.create("attribute", 1), model)
+
+    def test_create_concurrently(self):
+        cache = InterningCache(SearchCriterion)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            models = list(executor.map(lambda i: cache.create("attribute", i % 10), range(1000)))
+        for model in models:
+            self.assertIs(cache.create("attribute", model.value), model)
+
+
+class _StubModelSubclass(StubModel):
+    """
+    Subclass of `StubModel`.
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+class _StubModelWithOwnEquality(StubModel):
+    """
+    Stub `Model` with its own equality method, which uses the superclass' implementation.
+    """
+    equality_checks = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        type(self).equality_checks += 1
+        return super().__eq__(other)
+
+    __hash__ = StubModel.__hash__
+
+
+class _StubModelWithCachedHash(Model):
+    """
+    Stub `Model` that caches its hash.
+    """
+    _cache_hash = True
+
+    def __init__(self, value):
+        self.value = value
+
+
+
+class _StubUnhashable:
+    """
+    Stub unhashable type, equal to all other instances of the type.
+    """
+    __hash__ = None
+
+    def __eq__(self, other):
+        return isinstance(other, _StubUnhashable)
+
+    def __str__(self):
+        return "unhashable"
+
+
+class _StubPlainModel(Model):
+    """
+    Stub `Model` with two properties.
+    """
+    def __init__(self, property_1, property_2):
+        self.property_1 = property_1
+        self.property_2 = property_2
+
+
+class _StubSlottedModel(SlottedModel):
+    """
+    Stub `SlottedModel` with two properties.
+    """
+    _fields = ("property_1", "property_2")
+
+    def __init__(self, property_1, property_2):
+        self.property_1 = property_1
+        self.property_2 = property_2
+
+
+class _StubSlottedModelSubclass(_StubSlottedModel):
+    """
+    Stub subclass of `SlottedModel` that declares another property and caches its hash.
+    """
+    _fields = ("property_3", )
+    _cache_hash = True
+
+    def __init__(self, property_1, property_2, property_3):
+        super().__init__(property_1, property_2)
+        self.property_3 = property_3
+
 
 if __name__ == "__main__":
     unittest.main()
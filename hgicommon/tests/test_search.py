@@ -0,0 +1,104 @@
+"""
+Legalese
+--------
+Copyright (c) 2017 Genome Research Ltd.
+
+Author: Colin Nolan <cn13@sanger.ac.uk>
+
+This file is part of HGI's common Python library
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation; either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import unittest
+from operator import itemgetter
+
+from hgicommon.enums import ComparisonOperator
+from hgicommon.models import SearchCriterion
+from hgicommon.search import compile_search_criteria
+
+
+class TestCompileSearchCriteria(unittest.TestCase):
+    """
+    Tests for `compile_search_criteria`.
+    """
+    def setUp(self):
+        self._records = [_StubRecord(i, "name_%d" % (i % 3)) for i in range(10)]
+        self._search_criteria = [
+            SearchCriterion("number", 2, ComparisonOperator.GREATER_THAN),
+            SearchCriterion("number", 8, ComparisonOperator.LESS_THAN),
+            SearchCriterion("name", "name_1")
+        ]
+
+    def test_predicate(self):
+        predicate = compile_search_criteria(self._search_criteria)
+        self.assertTrue(predicate(_StubRecord(4, "name_1")))
+        self.assertFalse(predicate(_StubRecord(4, "name_2")))
+        self.assertFalse(predicate(_StubRecord(8, "name_1")))
+
+    def test_predicate_with_no_criteria(self):
+        self.assertTrue(compile_search_criteria([])(_StubRecord(1, "name")))
+
+    def test_predicate_when_attribute_missing(self):
+        self.assertFalse(compile_search_criteria(self._search_criteria)(object()))
+
+    def test_predicate_when_values_cannot_be_compared(self):
+        self.assertFalse(compile_search_criteria(self._search_criteria)(_StubRecord("4", "name_1")))
+
+    def test_filter(self):
+        matched = compile_search_criteria(self._search_criteria).filter(self._records)
+        self.assertEqual([record.number for record in matched], [4, 7])
+
+    def test_filter_iterable(self):
+        matched = compile_search_criteria(self._search_criteria).filter(iter(self._records))
+        self.assertEqual([record.number for record in matched], [4, 7])
+
+    def test_filter_when_attribute_missing(self):
+        records = self._records + [object(), _StubRecord(None, "name_1")]
+        matched = compile_search_criteria(self._search_criteria).filter(records)
+        self.assertEqual([record.number for record in matched], [4, 7])
+
+    def test_filter_mappings(self):
+        records = [vars(record) for record in self._records]
+        matched = compile_search_criteria(self._search_criteria, itemgetter).filter(records)
+        self.assertEqual([record["number"] for record in matched], [4, 7])
+
+    def test_equality_checked_first(self):
+        predicate = compile_search_criteria(self._search_criteria)
+        self.assertEqual(predicate.search_criteria[0], self._search_criteria[2])
+
+    def test_ordered_by_selectivity_of_sample(self):
+        predicate = compile_search_criteria(self._search_criteria, sample=self._records)
+        self.assertEqual(predicate.search_criteria,
+                         (self._search_criteria[2], self._search_criteria[0], self._search_criteria[1]))
+        self.assertEqual([record.number for record in predicate.filter(self._records)], [4, 7])
+
+    def test_duplicate_criteria_checked_once(self):
+        predicate = compile_search_criteria(self._search_criteria + [SearchCriterion("name", "name_1")])
+        self.assertEqual(len(predicate.search_criteria), 3)
+
+    def test_criterion_without_attribute(self):
+        self.assertRaises(ValueError, compile_search_criteria, [SearchCriterion(None, 1)])
+
+
+class _StubRecord:
+    """
+    Stub record.
+    """
+    def __init__(self, number, name):
+        self.number = number
+        self.name = name
+
+
+if __name__ == "__main__":
+    unittest.main()